@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import platform
+import tempfile
+import functools
+import tracemalloc
+import argparse
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from parse import DiffParser
+from models import LineChange
+from blame import BlameParser, parse_columns
+from marvin import Marvin
+import generate
+
+module = sys.modules['__main__'].__file__
+log = logging.getLogger(module)
+
+TEST_DATA_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'test_data')
+BLAME_FIXTURES = [
+    'test_blame_20180215.html',
+    'test_app_controllers_application_controller_20180215.html',
+    'test_config_initializers_devise_add_20180215.html',
+    'test_config_initializers_devise_deleted_20180215.html',
+]
+
+# A result more than this fraction worse than its baseline is a regression
+DEFAULT_THRESHOLD = 0.1
+
+# Name -> (function of the parsed arguments, unit, per), lower results are better.
+# With per, like 'lines', the function returns its time and the number of
+# items it processed, which is reported as throughput next to the time.
+BENCHMARKS = OrderedDict()
+
+def benchmark(name, unit='s', per=None):
+    def register(function):
+        BENCHMARKS[name] = (function, unit, per)
+        return function
+    return register
+
+def best_time(function, repeat):
+    """Best of `repeat` runs of function, in seconds"""
+    best = float('inf')
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def retained_memory(function):
+    """Bytes still allocated when function returns, and its result"""
+    tracemalloc.start()
+    result = function()
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return retained, result
+
+@functools.lru_cache()
+def synthetic_pr(n_lines):
+    return generate.with_changed_lines(n_lines)
+
+def blamer_of(lines):
+    """BlameParser of the given [(text, LineBlame)], without a page to parse"""
+    blamer = BlameParser('')
+    for line_number, (text, blame) in enumerate(lines, 1):
+        blamer.blame_data[line_number] = blame
+        blamer.file_data[line_number] = text
+    blamer.line_count = len(lines)
+    return blamer
+
+def synthetic_marvin(patch, blame_of):
+    """Marvin with a parsed and blamed patch, blame_of(file, commit_sha) is [(text, LineBlame)] of the file"""
+    marvin = Marvin('', 0)
+    marvin.raw_diff = patch
+    marvin.parse_diff()
+
+    for file, commit_sha in marvin.blame_pairs():
+        marvin.blame_data.setdefault(file, OrderedDict())[commit_sha] = blamer_of(blame_of(file, commit_sha))
+    marvin.blame_lines()
+    return marvin
+
+def dense_marvin(n_lines):
+    patch, content = generate.dense_patch(n_lines)
+    blame = generate.SyntheticPR(files=0).base_blames[0]
+    lines = [(text, blame) for text in content]
+    return synthetic_marvin(patch, lambda file, commit_sha: lines)
+
+def many_files_marvin(n_lines):
+    pr = synthetic_pr(n_lines)
+    return synthetic_marvin(pr.patch(), lambda file, commit_sha: pr.blame(commit_sha, file))
+
+def load_html(path):
+    blamer = BlameParser('')
+    blamer.load_html_file(path)
+    return blamer
+
+@benchmark('parse/pr_338', per='lines')
+def bench_parse_pr_338(args):
+    with open(os.path.join(TEST_DATA_DIR, 'pr_338.diff')) as f:
+        lines = f.readlines()
+    return best_time(lambda: DiffParser(diff_content=lines).parse(), args.repeat * 10), len(lines)
+
+@benchmark('parse/synthetic', per='lines')
+def bench_parse_synthetic(args):
+    lines = synthetic_pr(args.lines).patch()
+    return best_time(lambda: DiffParser(diff_content=lines).parse(), args.repeat), len(lines)
+
+@benchmark('parse/memory', 'bytes/change')
+def bench_parse_memory(args):
+    # Built before measuring, only what the parser keeps of it counts
+    lines = synthetic_pr(args.lines).patch()
+
+    def parse():
+        parser = DiffParser(diff_content=lines)
+        for section in parser.iter_file_rows():
+            pass
+        parser.compact()
+        parser.lines = None
+        return parser
+
+    retained, parser = retained_memory(parse)
+    return retained / len(parser.change_set)
+
+@benchmark('linechange/memory', 'bytes/object')
+def bench_linechange_memory(args):
+    retained, changes = retained_memory(
+        lambda: [LineChange(i, LineChange.ChangeType.added, 'file.rb', 'sha') for i in range(10**5)])
+    return retained / len(changes)
+
+def bench_blame_fixture(fixture, args):
+    path = os.path.join(TEST_DATA_DIR, fixture)
+    return best_time(lambda: load_html(path), args.repeat * 10)
+
+for fixture in BLAME_FIXTURES:
+    benchmark('blame/' + fixture)(functools.partial(bench_blame_fixture, fixture))
+
+@benchmark('blame/synthetic')
+def bench_blame_synthetic(args):
+    with tempfile.NamedTemporaryFile(suffix='.html') as f:
+        pr = generate.SyntheticPR(files=1, file_length=args.blame_lines, hunks=0)
+        f.write(pr.blame_page(*next(iter(pr.revisions))))
+        f.flush()
+        return best_time(lambda: load_html(f.name), args.repeat)
+
+@benchmark('blame/memory', 'bytes/line')
+def bench_blame_memory(args):
+    """Memory taken by the blame of a parsed page per line, without the text of the lines"""
+    pr = generate.SyntheticPR(files=1, file_length=args.blame_lines, hunks=0)
+    page = pr.blame_page(*next(iter(pr.revisions)))
+    blamer = BlameParser('')
+    blamer.parse_html(page)
+    # The hunks are shared with the page, only the line -> hunk mapping is measured
+    retained, blame_data = retained_memory(lambda: type(blamer.blame_data)(blamer.blame_data.items()))
+    return retained / len(blame_data)
+
+def bench_blame_processes(processes, args):
+    """Time to parse args.pages blame pages, fetching threads handing them to `processes` worker processes.
+
+    With 0 processes the pages are parsed in the fetching threads themselves.
+    """
+    with open(os.path.join(TEST_DATA_DIR, BLAME_FIXTURES[0]), 'rb') as f:
+        pages = [f.read()] * args.pages
+
+    def parse(content):
+        blamer = BlameParser('')
+        blamer.parse_html(content, pool)
+        return blamer
+
+    pool = ProcessPoolExecutor(processes) if processes > 0 else None
+    try:
+        if pool != None:
+            # Start the workers before measuring
+            list(pool.map(parse_columns, [BlameParser] * processes, [''] * processes, pages[:processes]))
+
+        def run():
+            with ThreadPoolExecutor(max(1, processes)) as threads:
+                list(threads.map(parse, pages))
+        return best_time(run, args.repeat)
+    finally:
+        if pool != None:
+            pool.shutdown()
+
+for processes in [0, 1, 2, 4, 8]:
+    benchmark('blame/pages/{}_processes'.format(processes))(functools.partial(bench_blame_processes, processes))
+
+@benchmark('marvin/additional_lines/dense')
+def bench_additional_lines_dense(args):
+    marvin = dense_marvin(args.lines // 10)
+    return best_time(marvin.load_additional_lines, args.repeat)
+
+@benchmark('marvin/additional_lines/many_files')
+def bench_additional_lines_many_files(args):
+    marvin = many_files_marvin(args.lines)
+    return best_time(marvin.load_additional_lines, args.repeat)
+
+@benchmark('marvin/reviewers/many_files')
+def bench_reviewers_many_files(args):
+    marvin = many_files_marvin(args.lines)
+    marvin.load_additional_lines()
+    return best_time(marvin.reviewers, args.repeat)
+
+def regressions(results, baseline, threshold):
+    """Names of the results more than threshold worse than their baseline"""
+    names = []
+    for name, (value, unit) in results.items():
+        base = baseline.get('benchmarks', {}).get(name)
+        if base != None and base['unit'] == unit and value > base['value'] * (1 + threshold):
+            names.append(name)
+    return names
+
+def run(names, args, baseline={}):
+    """Name -> (value, unit) of the benchmarks, and name -> throughput of those measured per item"""
+    results, rates = OrderedDict(), OrderedDict()
+    for name in names:
+        function, unit, per = BENCHMARKS[name]
+        log.info('Running {}'.format(name))
+        value = function(args)
+        rate = ''
+        if per != None:
+            value, items = value
+            rates[name] = (items / value if value > 0 else float('inf'), '{}/s'.format(per))
+            rate = '\t{:,.0f} {}'.format(*rates[name])
+        results[name] = (value, unit)
+
+        base = baseline.get('benchmarks', {}).get(name)
+        change = ''
+        if base != None and base['value'] > 0:
+            change = '\t{:+.1%}'.format(results[name][0] / base['value'] - 1)
+        print('{}\t{:.6g} {}{}{}'.format(name, results[name][0], unit, rate, change))
+        sys.stdout.flush()
+    return results, rates
+
+def save_baseline(filename, results, args, rates={}):
+    baseline = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'arguments': {'lines': args.lines, 'blame_lines': args.blame_lines, 'pages': args.pages, 'repeat': args.repeat},
+        'benchmarks': OrderedDict((name, {'value': value, 'unit': unit}) for name, (value, unit) in results.items()),
+    }
+    for name, (rate, unit) in rates.items():
+        baseline['benchmarks'][name]['rate'] = {'value': rate, 'unit': unit}
+    with open(filename, 'w') as f:
+        json.dump(baseline, f, indent=2)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks marvin hot paths, lower results are better')
+    parser.add_argument('-k', '--select', type=str, action='append', help='only run the benchmarks whose name contains this, may be repeated')
+    parser.add_argument('--list', action='store_true', help='list the benchmarks and exit')
+    parser.add_argument('--lines', type=int, default=10**6, help='the number of changed lines of the synthetic PR, its patch has more lines in all')
+    parser.add_argument('--blame-lines', type=int, default=20000, help='the number of lines of the synthetic blame page')
+    parser.add_argument('--pages', type=int, default=64, help='the number of blame pages parsed by the process pool benchmarks')
+    parser.add_argument('--repeat', type=int, default=3, help='the number of runs per benchmark, the best one counts')
+    parser.add_argument('--baseline', type=str, help='JSON file of earlier results to compare with')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, help='the fraction a result may be worse than its baseline')
+    parser.add_argument('--save', type=str, help='write the results to this JSON file, to be used as a baseline')
+    parser.add_argument('-v', '--verbose', action='count', default=0, help="increases log verbosity for each occurence.")
+
+    args = parser.parse_args(argv)
+    log.setLevel([logging.WARNING, logging.INFO, logging.DEBUG][min(2, args.verbose)])
+
+    names = [name for name in BENCHMARKS if not args.select or any(s in name for s in args.select)]
+    if args.list:
+        print('\n'.join(names))
+        return 0
+
+    baseline = {}
+    if args.baseline != None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results, rates = run(names, args, baseline)
+    if args.save != None:
+        save_baseline(args.save, results, args, rates)
+
+    failed = regressions(results, baseline, args.threshold)
+    for name in failed:
+        log.error('{} is more than {:.0%} worse than the baseline'.format(name, args.threshold))
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    logging.basicConfig(stream=sys.stderr, format='%(name)s %(levelname)s %(message)s')
+    sys.exit(main())
@@ -1,23 +1,194 @@
 #!/usr/bin/env python3
 
-import json, sys, logging
+import os, json, sys, logging, bisect
+from array import array
+from io import BytesIO
 from collections import OrderedDict
-import requests
-from lxml import html
-from models import LineBlame
+from lxml import html, etree
+from models import LineBlame, BlameRanges, epoch
+from http_client import default_client
+from stats import NULL_STATS
 
 module = sys.modules['__main__'].__file__
 log = logging.getLogger(module)
 
+# The only elements the streaming parser looks at
+STREAMING_TAGS = ('div', 'a', 'img', 'time-ago')
+
+# Lines materialized around every wanted line in range-restricted mode
+DEFAULT_CONTEXT = 8
+
+# Lines consisting of nothing but one of these tokens are not interesting
+DEFAULT_SKIP_TOKENS = frozenset(['', '{', '}', 'begin', 'end'])
+BRACE_SKIP_TOKENS = frozenset(['', '{', '}', '};', '});', '})', ')', ');'])
+
+# Skip tokens by file extension, used when passed as overrides to skip_tokens_for,
+# e.g. with --skip-tokens languages
+SKIP_TOKENS = {
+    '.py': frozenset(['', 'pass', 'else:', 'try:', 'finally:', ')', ']']),
+    '.js': BRACE_SKIP_TOKENS,
+    '.ts': BRACE_SKIP_TOKENS,
+    '.java': BRACE_SKIP_TOKENS,
+    '.c': BRACE_SKIP_TOKENS,
+    '.h': BRACE_SKIP_TOKENS,
+    '.cpp': BRACE_SKIP_TOKENS,
+    '.go': BRACE_SKIP_TOKENS,
+}
+
+def skip_tokens_for(path, overrides=None):
+    """Skip tokens of a file by its extension in overrides, DEFAULT_SKIP_TOKENS for any other file"""
+    extension = os.path.splitext(path)[1]
+    if overrides != None and extension in overrides:
+        return frozenset(overrides[extension])
+    return DEFAULT_SKIP_TOKENS
+
+def parse_columns(parser_class, project_link, content, parse_ranges=None, streaming=True):
+    """Parse a page in a worker process, returning BlameParser.to_columns()"""
+    blamer = parser_class(project_link, streaming=streaming)
+    blamer._parse_ranges = parse_ranges
+    blamer._parse_page(content)
+    return blamer.to_columns()
+
 def get_first(lst, default=None):
     return lst[0] if lst else default
 
+def merge_ranges(ranges):
+    """Sorted list of non-overlapping (start, end) ranges covering the given ones"""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def in_ranges(ranges, line):
+    i = bisect.bisect_right(ranges, (line, float('inf'))) - 1
+    return i >= 0 and ranges[i][1] >= line
+
 class BlameParser:
-    def __init__(self, project_link, logger = None):
+    def __init__(self, project_link, logger = None, cache = None, http = None, streaming = True, skip_tokens = None,
+            stats = None):
         self.project_link = project_link
+        self.stats = stats if stats != None else NULL_STATS
         self.logger = logger or logging
-        self.blame_data = OrderedDict()
+        self.cache = cache
+        # The default client is only created once it is needed
+        self.http = http
+        self.streaming = streaming
+        # Line number -> LineBlame, stored as ranges of lines sharing a hunk
+        self.blame_data = BlameRanges()
         self.file_data = OrderedDict()
+        self.line_count = 0
+        # None until the file is known, see get_blame_page()
+        self.skip_tokens = skip_tokens
+        self._interesting = None
+
+        # Range-restricted mode, see restrict()
+        self._ranges = None
+        self._parse_ranges = None
+        self._source = None
+
+    def restrict(self, lines, context=DEFAULT_CONTEXT):
+        """Only materialize the given lines and `context` lines around them.
+
+        Must be called before the page is loaded. Lines outside of these
+        ranges are loaded on demand by line_text() and blame_line().
+        """
+        self.context = context
+        self._ranges = merge_ranges((n - context, n + context) for n in lines)
+        self._parse_ranges = self._ranges
+
+    def complete(self):
+        """Whether every line of the page is loaded, which it is not in range-restricted mode"""
+        return self._ranges == None
+
+    def _wants(self, line_number):
+        return self._parse_ranges == None or in_ranges(self._parse_ranges, line_number)
+
+    def _ensure_line(self, line_number):
+        if self._ranges == None or self._source == None or in_ranges(self._ranges, line_number) \
+            or line_number < 1 or line_number > self.line_count:
+            return
+
+        # Widen geometrically, so a long walk away from the wanted lines
+        # only needs a logarithmic number of passes over the page
+        new_range = (line_number - self.context, line_number + self.context)
+        self.context *= 2
+        log.debug("Widening blame to lines {}-{}".format(*new_range))
+
+        self._parse_ranges = [new_range]
+        self.parse_html(self._source)
+        self._ranges = merge_ranges(self._ranges + [new_range])
+        self._parse_ranges = self._ranges
+
+    def line_text(self, line_number):
+        self._ensure_line(line_number)
+        return self.file_data.get(line_number)
+
+    def interesting_lines(self):
+        """Sorted numbers of the loaded lines which are not just a skip token.
+
+        Built once after the page is parsed, and again after it is widened.
+        """
+        if self._interesting == None:
+            skip_tokens = self.skip_tokens if self.skip_tokens != None else DEFAULT_SKIP_TOKENS
+            self._interesting = sorted(line_number for line_number, text in self.file_data.items()
+                if not text.strip() in skip_tokens)
+        return self._interesting
+
+    def _first_unloaded(self, line_number, step):
+        """First line from line_number on in direction step that has not been loaded yet"""
+        if self._ranges == None or self._source == None:
+            return None
+        i = bisect.bisect_right(self._ranges, (line_number, float('inf'))) - 1
+        if i >= 0 and self._ranges[i][1] >= line_number:
+            return self._ranges[i][1] + 1 if step > 0 else self._ranges[i][0] - 1
+        return line_number
+
+    def find_interesting(self, start, stop, step=1):
+        """Nearest interesting line from start on in direction step, stopping before stop.
+
+        Lines that have not been loaded in range-restricted mode are loaded
+        as the search reaches them. Returns None if there is no such line.
+        """
+        while True:
+            interesting = self.interesting_lines()
+            if step > 0:
+                i = bisect.bisect_left(interesting, start)
+                found = interesting[i] if i < len(interesting) else None
+            else:
+                i = bisect.bisect_right(interesting, start)
+                found = interesting[i - 1] if i > 0 else None
+            if found != None and (stop - found) * step <= 0:
+                found = None
+
+            # Only trust the result if no line before it is missing
+            unloaded = self._first_unloaded(start, step)
+            limit = found if found != None else stop
+            if unloaded == None or (limit - unloaded) * step <= 0 or not 1 <= unloaded <= self.line_count:
+                return found
+            self._ensure_line(unloaded)
+
+    def parse_html(self, content, pool=None):
+        if self._ranges != None:
+            self._source = content
+        self._interesting = None
+        loaded = len(self.blame_data)
+        with self.stats.stage('blame_parse'):
+            if pool != None:
+                self.load_columns(pool.submit(parse_columns, type(self), self.project_link, content,
+                    self._parse_ranges, self.streaming).result())
+            else:
+                self._parse_page(content)
+        self.stats.count('blame_lines_parsed', len(self.blame_data) - loaded)
+
+    def _parse_page(self, content):
+        # Backends for other sources of blame override this
+        if self.streaming:
+            self._parse_gh_blame_html_streaming(content)
+        else:
+            self._parse_gh_blame_html(content)
 
     def _parse_gh_blame_html(self, string):
         html_tree = html.fromstring(string)
@@ -30,40 +201,173 @@ class BlameParser:
                     # is followed by the corresponding lines in a
                     # <div class="width-full">line info</div> element
                     if 'blame-commit' in e.get('class'):
-                        blame = LineBlame(*[None]*6)
                         message_anchor = e.xpath(".//a[contains(@class, 'message')]").pop()
-                        blame.commit_url = message_anchor.get('href')
-                        blame.short_sha = message_anchor.get('href').rsplit('/', 1)[-1]
-                        blame.commit_message = message_anchor.get('title')
-                        blame.user_name = e.xpath(".//div[contains(@class, 'AvatarStack-body')]").pop().get('aria-label')
-                        blame.avatar_url = get_first(e.xpath('.//a[@class="avatar"]/img/@src'))
-                        if blame.avatar_url is None:
-                            log.info('Avatar for ' + blame.user_name + ' not found')
-                        blame.time = e.xpath(".//time-ago").pop().get('datetime')
+                        user_name = e.xpath(".//div[contains(@class, 'AvatarStack-body')]").pop().get('aria-label')
+                        avatar_url = get_first(e.xpath('.//a[@class="avatar"]/img/@src'))
+                        if avatar_url is None:
+                            log.info('Avatar for ' + user_name + ' not found')
+                        time = e.xpath(".//time-ago").pop().get('datetime')
+                        blame = LineBlame(
+                            short_sha=message_anchor.get('href').rsplit('/', 1)[-1],
+                            commit_url=message_anchor.get('href'),
+                            avatar_url=avatar_url,
+                            commit_message=message_anchor.get('title'),
+                            user_name=user_name,
+                            time=time,
+                            timestamp=epoch(time))
                     if e.get('class') == 'width-full':
                         # Contains divs containing line number and text
                         for line_element in e.iterchildren():
-                            line_number = line_element.xpath(".//div[contains(@class, 'blob-num')]").pop().text
-                            self.blame_data[int(line_number)] = blame
+                            line_number = int(line_element.xpath(".//div[contains(@class, 'blob-num')]").pop().text)
+                            self.line_count = max(self.line_count, line_number)
+                            if not self._wants(line_number):
+                                continue
+                            self.blame_data[line_number] = blame
                             line_contents = line_element.xpath(".//div[contains(@class, 'blob-code')]").pop().text_content()
-                            self.file_data[int(line_number)] = line_contents
+                            self.file_data[line_number] = line_contents
+
+    def _parse_gh_blame_html_streaming(self, content):
+        # Single pass over the document: commit info and lines are picked up
+        # when their elements end, and every hunk is freed once it is done
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+
+        in_container = False
+        commit = {}
+        blame = None
+        line_number = None
+
+        for event, e in etree.iterparse(BytesIO(content), events=('start', 'end'), html=True,
+                encoding='utf-8', tag=STREAMING_TAGS):
+            classes = e.get('class') or ''
+
+            if not in_container:
+                if event == 'start' and e.tag == 'div' and 'blame-container' in classes:
+                    in_container = True
+                continue
+            if event == 'start':
+                continue
+
+            if e.tag == 'div':
+                if 'blob-num' in classes:
+                    line_number = int(e.text)
+                    self.line_count = max(self.line_count, line_number)
+                elif 'blob-code' in classes:
+                    if self._wants(line_number):
+                        self.blame_data[line_number] = blame
+                        self.file_data[line_number] = ''.join(e.itertext())
+                    e.clear()
+                elif 'AvatarStack-body' in classes:
+                    commit['user_name'] = e.get('aria-label')
+                elif 'blame-commit' in classes.split():
+                    if commit.get('avatar_url') is None:
+                        log.info('Avatar for ' + commit['user_name'] + ' not found')
+                    blame = LineBlame(
+                        short_sha=commit['commit_url'].rsplit('/', 1)[-1],
+                        commit_url=commit['commit_url'],
+                        avatar_url=commit.get('avatar_url'),
+                        commit_message=commit['commit_message'],
+                        user_name=commit['user_name'],
+                        time=commit['time'],
+                        timestamp=epoch(commit['time']))
+                    commit = {}
+                elif 'blame-hunk' in classes:
+                    e.clear()
+                    while e.getprevious() is not None:
+                        del e.getparent()[0]
+                elif 'blame-container' in classes:
+                    break
+            elif e.tag == 'a' and 'message' in classes:
+                commit['commit_url'] = e.get('href')
+                commit['commit_message'] = e.get('title')
+            elif e.tag == 'img' and not 'avatar_url' in commit and e.getparent().get('class') == 'avatar':
+                commit['avatar_url'] = e.get('src')
+            elif e.tag == 'time-ago':
+                commit['time'] = e.get('datetime')
+
+    def get_blame_page(self, commit, file, pool=None):
+        """Load the blame of file at commit, parsing it in the given process pool, if any"""
+        if self.skip_tokens == None:
+            self.skip_tokens = skip_tokens_for(file)
+
+        if self.cache != None:
+            cached = self.cache.get(self.project_link, commit, file)
+            if cached != None:
+                self.stats.count('blame_pages_cached')
+                self.load_compact(cached)
+                return
 
-    def get_blame_page(self, commit, file):
         blame_url = self.project_link + "/blame/" + commit + "/" + file
-        print('Blame URL', blame_url)
-        response = requests.get(blame_url)
-        self._parse_gh_blame_html(response.content)
+        log.info('Blame URL {}'.format(blame_url))
+        with self.stats.stage('blame_fetch'):
+            response = (self.http or default_client()).get(blame_url)
+        self.stats.count('blame_pages_fetched')
+        self.stats.count('blame_bytes', len(response.content))
+        self.parse_html(response.content, pool)
+
+        # A range-restricted page is incomplete and must not be cached
+        if self.cache != None and self._ranges == None:
+            self.cache.put(self.project_link, commit, file, self.to_compact())
+
+    def to_compact(self):
+        """JSON serializable form of the parsed page, storing every hunk once"""
+        hunks, hunk_index, lines = [], {}, []
+        for line_number, blame in self.blame_data.items():
+            if not blame in hunk_index:
+                hunk_index[blame] = len(hunks)
+                hunks.append(list(blame))
+            lines.append([line_number, hunk_index[blame], self.file_data[line_number]])
+
+        return {'hunks': hunks, 'lines': lines}
+
+    def to_columns(self):
+        """Parsed page as (line_count, line numbers, hunk indices, hunks, texts).
+
+        Cheap to pickle, the lines are arrays and every hunk is stored once.
+        """
+        hunks, hunk_index = [], {}
+        hunk_ids = array('i')
+        for blame in self.blame_data.values():
+            if not blame in hunk_index:
+                hunk_index[blame] = len(hunks)
+                hunks.append(tuple(blame))
+            hunk_ids.append(hunk_index[blame])
+
+        return self.line_count, array('i', self.blame_data.keys()), hunk_ids, hunks, list(self.file_data.values())
+
+    def load_columns(self, columns):
+        line_count, line_numbers, hunk_ids, hunks, texts = columns
+        hunks = [LineBlame.from_fields(hunk) for hunk in hunks]
+        for line_number, hunk, text in zip(line_numbers, hunk_ids, texts):
+            self.blame_data[line_number] = hunks[hunk]
+            self.file_data[line_number] = text
+        self.line_count = max(self.line_count, line_count)
+
+    def load_compact(self, compact):
+        hunks = [LineBlame.from_fields(hunk) for hunk in compact['hunks']]
+        self._interesting = None
+        for line_number, hunk, line_contents in compact['lines']:
+            self.blame_data[line_number] = hunks[hunk]
+            self.file_data[line_number] = line_contents
+            self.line_count = max(self.line_count, line_number)
+        # Cached pages are complete
+        self._ranges = None
 
     def load_html_file(self, html_path):
-        with open(html_path) as f:
-            self._parse_gh_blame_html(f.read())
+        with open(html_path, 'rb') as f:
+            self.parse_html(f.read())
 
     def print_blame_data(self, attribute):
         print('Length', len(self.blame_data))
         for k, v in self.blame_data.items():
-            print(k, v.get(attribute))
+            print(k, getattr(v, attribute))
+
+    def authors(self, start, end):
+        """Every hunk of the loaded lines from start to end once, in line order"""
+        return list(OrderedDict.fromkeys(hunk for first, last, hunk in self.blame_data.span(start, end)))
 
     def blame_line(self, line):
+        self._ensure_line(line)
         if len(self.blame_data) == 0:
             self.logger.error("HTML not loaded before requesting lines")
             return None
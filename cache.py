@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import zlib
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+module = sys.modules['__main__'].__file__
+log = logging.getLogger(module)
+
+# 256 MB of compressed blame pages
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+# Entries kept by an in-memory cache
+DEFAULT_MAX_ENTRIES = 1024
+
+def default_cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'marvin')
+
+class BlameCache:
+    """Persistent store of parsed blame pages, keyed by (project_link, commit, file).
+
+    A blame page of a given commit never changes, so entries are never
+    invalidated, only evicted least recently used first once the cache grows
+    beyond max_size bytes. Other immutable results, such as the analysis of
+    a commit, are stored in a separate database by passing another name.
+    """
+
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE, name='blame'):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.name = name
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(directory, name + '.sqlite3'), check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS blame ('
+            'key TEXT PRIMARY KEY, data BLOB NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS blame_accessed ON blame (accessed)')
+        self._db.commit()
+
+    @staticmethod
+    def key(project_link, commit, file):
+        return hashlib.sha1('\0'.join([project_link, str(commit), file]).encode('utf-8')).hexdigest()
+
+    def get(self, project_link, commit, file):
+        key = self.key(project_link, commit, file)
+        with self._lock:
+            row = self._db.execute('SELECT data FROM blame WHERE key = ?', (key,)).fetchone()
+            if row == None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._db.execute('UPDATE blame SET accessed = ? WHERE key = ?', (time.time(), key))
+            self._db.commit()
+
+        return json.loads(zlib.decompress(row[0]).decode('utf-8'))
+
+    def put(self, project_link, commit, file, value):
+        data = zlib.compress(json.dumps(value, separators=(',', ':')).encode('utf-8'))
+        key = self.key(project_link, commit, file)
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO blame (key, data, size, accessed) VALUES (?, ?, ?, ?)',
+                (key, sqlite3.Binary(data), len(data), time.time()))
+            self._evict()
+            self._db.commit()
+
+    def size(self):
+        with self._lock:
+            return self._db.execute('SELECT COALESCE(SUM(size), 0) FROM blame').fetchone()[0]
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM blame').fetchone()[0]
+
+    def _evict(self):
+        total = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM blame').fetchone()[0]
+        if total <= self.max_size:
+            return
+
+        evicted = []
+        for key, size in self._db.execute('SELECT key, size FROM blame ORDER BY accessed, rowid'):
+            if total <= self.max_size:
+                break
+            evicted.append((key,))
+            total -= size
+
+        self._db.executemany('DELETE FROM blame WHERE key = ?', evicted)
+        log.debug("Evicted {} blame pages from cache".format(len(evicted)))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+class MemoryCache:
+    """In-memory LRU cache with the interface of BlameCache, for long-running processes.
+
+    Values are kept as they are, so they must not be modified by the caller.
+    Misses fall through to the backing cache, if any, and are kept in memory
+    from then on. Entries older than ttl seconds are treated as missing.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=None, backing=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.backing = backing
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, *key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry != None and self.ttl != None and time.time() - entry[1] > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry != None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        if self.backing == None:
+            return None
+        value = self.backing.get(*key)
+        if value != None:
+            self._store(key, value)
+        return value
+
+    def put(self, *key_and_value):
+        key, value = key_and_value[:-1], key_and_value[-1]
+        self._store(key, value)
+        if self.backing != None:
+            self.backing.put(*key_and_value)
+
+    def _store(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def close(self):
+        if self.backing != None:
+            self.backing.close()
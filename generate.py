@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import random
+import argparse
+import logging
+from html import escape
+from datetime import datetime, timedelta, timezone
+from collections import OrderedDict
+
+from models import LineBlame
+
+module = sys.modules['__main__'].__file__
+log = logging.getLogger(module)
+
+# Lines of unchanged context around every hunk, as written by git
+CONTEXT = 3
+# Fraction of generated lines that are blank or a lone keyword, which are not interesting
+SKIP_RATIO = 0.3
+SKIP_LINES = ['', 'end', '  end', '}']
+PR_AUTHOR = 'contributor'
+# Version in the signature git format-patch ends every commit with
+GIT_VERSION = '2.16.1'
+BASE_TIME = datetime(2018, 2, 15, 10, 0, 0, tzinfo=timezone.utc)
+
+class SyntheticPR:
+    """Generated pull request: a git format-patch series and the blame pages of every revision it touches.
+
+    Every file starts out with file_length lines blamed on `authors`
+    earlier commits, in runs of up to blame_run lines. Each of the `commits`
+    commits of the PR changes `hunks` places of every file it touches,
+    removing and adding up to hunk_size lines each. The first commit
+    touches every file, later ones each file with probability `touch`.
+    The blame pages are in GitHub's markup, as read by BlameParser, and
+    match the patch line by line.
+    """
+
+    def __init__(self, project_link='https://github.com/marvin/project', files=10, commits=1, hunks=10,
+            hunk_size=8, file_length=400, authors=5, blame_run=10, touch=0.5, seed=0):
+        self.project_link = project_link
+        self.random = random.Random(seed)
+        self.n_lines = 0
+        self.base_blames = [self._blame(self._sha(), 'author{}'.format(i), 'Earlier change {}'.format(i),
+            BASE_TIME - timedelta(days=30 * (authors - i))) for i in range(authors)]
+        self.files = ['dir{}/file{}{}'.format(f % 7, f, ['.rb', '.py', '.js'][f % 3]) for f in range(files)]
+
+        # (revision, file) -> [(text, LineBlame)] of the file at that revision
+        self.revisions = OrderedDict()
+        state = OrderedDict((file, self._base_file(file_length, blame_run)) for file in self.files)
+        self.commits = []
+        self.sections = []
+        for c in range(commits):
+            sha = self._sha()
+            blame = self._blame(sha, PR_AUTHOR, 'Change {}'.format(c + 1), BASE_TIME + timedelta(hours=c))
+            self.commits.append(sha)
+            for file in self.files:
+                if c > 0 and self.random.random() >= touch:
+                    continue
+                before = state[file]
+                self.revisions.setdefault((sha + '~1', file), before)
+                after, hunk_lines = self._change(before, blame, hunks, hunk_size)
+                self.revisions[(sha, file)] = state[file] = after
+                self.sections.append((sha, file, hunk_lines))
+
+    def _sha(self):
+        return '{:040x}'.format(self.random.getrandbits(160))
+
+    def _blame(self, sha, user_name, message, time):
+        return LineBlame(
+            short_sha=sha,
+            commit_url=self.project_link + '/commit/' + sha,
+            avatar_url='https://avatars.example.com/' + user_name,
+            commit_message=message,
+            user_name=user_name,
+            time=time.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            timestamp=int(time.timestamp()))
+
+    def _text(self):
+        self.n_lines += 1
+        if self.random.random() < SKIP_RATIO:
+            return self.random.choice(SKIP_LINES)
+        return '  code line {}'.format(self.n_lines)
+
+    def _base_file(self, length, blame_run):
+        lines = []
+        while len(lines) < length:
+            blame = self.random.choice(self.base_blames)
+            for i in range(min(self.random.randint(1, blame_run), length - len(lines))):
+                lines.append((self._text(), blame))
+        return lines
+
+    def _change(self, before, blame, hunks, hunk_size):
+        """File after changing `hunks` places of it, and the hunks as diff lines"""
+        # Every change keeps its context away from the file boundaries and
+        # from the other changes, so that it is a hunk of its own
+        edits = []
+        slots = max(0, (len(before) - 2 * CONTEXT) // (hunk_size + 2 * CONTEXT + 1))
+        for slot in sorted(self.random.sample(range(slots), min(hunks, slots))):
+            start = CONTEXT + slot * (hunk_size + 2 * CONTEXT + 1)
+            removed = self.random.randint(0, hunk_size)
+            added = self.random.randint(0 if removed > 0 else 1, hunk_size)
+            edits.append((start, removed, [(self._text(), blame) for i in range(added)]))
+
+        after, diff, offset, position = [], [], 0, 0
+        for start, removed, added in edits:
+            after += before[position:start]
+            after += added
+            context = before[start - CONTEXT:start]
+            trailing = before[start + removed:start + removed + CONTEXT]
+            old_start = start - CONTEXT + 1
+            diff.append('@@ -{},{} +{},{} @@\n'.format(old_start, len(context) + removed + len(trailing),
+                old_start + offset, len(context) + len(added) + len(trailing)))
+            diff += [' ' + text + '\n' for text, line_blame in context]
+            diff += ['-' + text + '\n' for text, line_blame in before[start:start + removed]]
+            diff += ['+' + text + '\n' for text, line_blame in added]
+            diff += [' ' + text + '\n' for text, line_blame in trailing]
+            offset += len(added) - removed
+            position = start + removed
+        after += before[position:]
+        return after, diff
+
+    def patch(self):
+        """Lines of the series as written by git format-patch"""
+        lines = []
+        sections = {}
+        for sha, file, hunk_lines in self.sections:
+            sections.setdefault(sha, []).append((file, hunk_lines))
+
+        for c, sha in enumerate(self.commits):
+            lines += [
+                'From {} Mon Sep 17 00:00:00 2001\n'.format(sha),
+                'From: {0} <{0}@example.com>\n'.format(PR_AUTHOR),
+                'Date: Thu, 15 Feb 2018 10:00:00 +0000\n',
+                'Subject: [PATCH {}/{}] Change {}\n'.format(c + 1, len(self.commits), c + 1),
+                '\n',
+                '---\n',
+                '\n',
+            ]
+            for file, hunk_lines in sections.get(sha, []):
+                lines += [
+                    'diff --git a/{0} b/{0}\n'.format(file),
+                    'index 1234567..89abcde 100644\n',
+                    '--- a/{}\n'.format(file),
+                    '+++ b/{}\n'.format(file),
+                ]
+                lines += hunk_lines
+            lines += ['-- \n', GIT_VERSION + '\n', '\n']
+        return lines
+
+    def changed_lines(self):
+        """Number of added and removed lines of the series"""
+        return sum(1 for sha, file, hunk_lines in self.sections for line in hunk_lines if line[:1] in '+-')
+
+    def blame(self, revision, file):
+        """[(text, LineBlame)] of every line of file at revision"""
+        return self.revisions[(revision, file)]
+
+    def blame_page(self, revision, file):
+        """Blame page of file at revision, in GitHub's markup"""
+        parts = ['<html><body><div class="blob-wrapper"><div class="blame-container highlight">\n']
+        lines = self.blame(revision, file)
+        start = 0
+        while start < len(lines):
+            blame = lines[start][1]
+            end = start
+            while end < len(lines) and lines[end][1] is blame:
+                end += 1
+            parts.append('<div class="blame-hunk d-flex">\n'
+                '<div class="blame-commit flex-self-stretch">'
+                '<div class="AvatarStack-body" aria-label="{user}"><a href="#" class="avatar"><img src="{avatar}"></a></div>'
+                '<a href="{url}" class="message" title="{message}">{message}</a>'
+                '<time-ago datetime="{time}">{time}</time-ago></div>\n'
+                '<div class="width-full">\n'.format(user=escape(blame.user_name), avatar=blame.avatar_url,
+                    url=blame.commit_url, message=escape(blame.commit_message), time=blame.time))
+            for n in range(start, end):
+                parts.append('<div class="d-flex"><div class="blob-num js-line-number">{0}</div>'
+                    '<div class="blob-code blob-code-inner">{1}</div></div>\n'.format(n + 1, escape(lines[n][0])))
+            parts.append('</div>\n</div>\n')
+            start = end
+        parts.append('</div></div></body></html>\n')
+        return ''.join(parts).encode('utf-8')
+
+    def pages(self, pr_n=1):
+        """URL path -> content of the patch and of every blame page, as served by GitHub"""
+        pages = OrderedDict([('/pull/{}.patch'.format(pr_n), ''.join(self.patch()).encode('utf-8'))])
+        for revision, file in self.revisions:
+            pages['/blame/{}/{}'.format(revision, file)] = self.blame_page(revision, file)
+        return pages
+
+    def write(self, directory, pr_n=1):
+        """Write pages() below directory, by URL path. Returns URL path -> written file"""
+        written = OrderedDict()
+        for path, content in self.pages(pr_n).items():
+            filename = os.path.join(directory, *path.lstrip('/').split('/'))
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(filename, 'wb') as f:
+                f.write(content)
+            written[path] = filename
+        return written
+
+def with_changed_lines(n_lines, hunks=10, hunk_size=8, commits=1, **kwargs):
+    """SyntheticPR of roughly n_lines added and removed lines, spread over as many files as needed"""
+    # Every hunk adds and removes hunk_size / 2 lines each on average
+    per_file = hunks * hunk_size * (1 + (commits - 1) * kwargs.get('touch', 0.5))
+    return SyntheticPR(files=max(1, int(n_lines / per_file)), hunks=hunks, hunk_size=hunk_size, commits=commits,
+        **kwargs)
+
+def dense_patch(n_lines, block=10):
+    """A single file patch adding blocks of code between equally long runs of blank lines.
+
+    Every changed line is far from the next interesting line which is not
+    changed. Returns the patch and the resulting content of the file.
+    """
+    content, body = [], []
+    while len(content) < n_lines:
+        for i in range(block):
+            content.append('  code {}\n'.format(len(content)))
+            body.append('+' + content[-1])
+        for i in range(block):
+            content.append('\n')
+            body.append(' \n')
+    context = len(content) // 2
+    lines = [
+        'From {:040x} Mon Sep 17 00:00:00 2001\n'.format(1),
+        'Subject: [PATCH] Dense change\n',
+        '\n',
+        'diff --git a/dense.rb b/dense.rb\n',
+        '--- a/dense.rb\n',
+        '+++ b/dense.rb\n',
+        '@@ -1,{} +1,{} @@\n'.format(context, len(content)),
+    ]
+    return lines + body, content
+
+def main():
+    parser = argparse.ArgumentParser(description='Generates a pull request and its blame pages for scale testing')
+    parser.add_argument('directory', type=str, help='the directory the pages are written to, by URL path')
+    parser.add_argument('--files', type=int, default=10, help='the number of files changed by the PR')
+    parser.add_argument('--commits', type=int, default=1, help='the number of commits of the PR')
+    parser.add_argument('--hunks', type=int, default=10, help='the number of hunks per file and commit')
+    parser.add_argument('--hunk-size', type=int, default=8, help='the maximum number of lines removed and added by a hunk')
+    parser.add_argument('--file-length', type=int, default=400, help='the number of lines of every file before the PR')
+    parser.add_argument('--authors', type=int, default=5, help='the number of authors of the files before the PR')
+    parser.add_argument('--seed', type=int, default=0, help='the seed of the random generator')
+    parser.add_argument('-v', '--verbose', action='count', default=0, help="increases log verbosity for each occurence.")
+
+    args = parser.parse_args()
+    log.setLevel([logging.WARNING, logging.INFO, logging.DEBUG][min(2, args.verbose)])
+
+    pr = SyntheticPR(files=args.files, commits=args.commits, hunks=args.hunks, hunk_size=args.hunk_size,
+        file_length=args.file_length, authors=args.authors, seed=args.seed)
+    written = pr.write(args.directory)
+    log.warning("Wrote {} pages, {} changed lines".format(len(written), pr.changed_lines()))
+
+if __name__ == "__main__":
+    logging.basicConfig(stream=sys.stderr, format='%(name)s %(levelname)s %(message)s')
+    main()
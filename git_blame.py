@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+import re
+import sys
+import logging
+import subprocess
+from datetime import datetime, timezone
+
+from models import LineBlame
+from blame import BlameParser, skip_tokens_for
+
+module = sys.modules['__main__'].__file__
+log = logging.getLogger(module)
+
+# First line of every group of lines in git blame --porcelain output
+PORCELAIN_HEADER_RE = re.compile(r'^([0-9a-f]{40}) [0-9]+ ([0-9]+)')
+
+class GitError(Exception):
+    pass
+
+class GitBlameParser(BlameParser):
+    """Blame from a local clone of the project instead of GitHub's blame pages.
+
+    Runs git blame --porcelain and fills the same blame_data and file_data
+    as BlameParser, so it can be used wherever a BlameParser is expected.
+    Blaming locally is fast enough that the blame cache is not used.
+    """
+
+    def __init__(self, project_link, repository='.', logger = None, cache = None, http = None, streaming = True,
+            skip_tokens = None, git = 'git', stats = None):
+        super().__init__(project_link, logger=logger, http=http, streaming=streaming, skip_tokens=skip_tokens,
+            stats=stats)
+        self.repository = repository
+        self.git = git
+
+    def get_blame_page(self, commit, file, pool=None):
+        if self.skip_tokens == None:
+            self.skip_tokens = skip_tokens_for(file)
+
+        command = [self.git, '-C', self.repository, 'blame', '--porcelain', commit, '--', file]
+        log.info('Blame {}'.format(' '.join(command)))
+        with self.stats.stage('blame_fetch'):
+            result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            raise GitError("git blame {} {} failed: {}".format(commit, file, result.stderr.decode('utf-8', 'replace').strip()))
+        self.stats.count('blame_pages_fetched')
+        self.stats.count('blame_bytes', len(result.stdout))
+        self.parse_html(result.stdout, pool)
+
+    def _parse_page(self, content):
+        if isinstance(content, bytes):
+            content = content.decode('utf-8', 'replace')
+
+        # Commit information is only given for the first line of a commit
+        commits = {}
+        commit, line_number = None, None
+        for line in content.split('\n'):
+            if line.startswith('\t'):
+                if line_number == None:
+                    raise GitError("Malformed git blame output, line without a header: {!r}".format(line))
+                self.line_count = max(self.line_count, line_number)
+                if self._wants(line_number):
+                    self.blame_data[line_number] = self._line_blame(commit)
+                    self.file_data[line_number] = line[1:]
+                # Every line has a header of its own
+                line_number = None
+                continue
+
+            match = PORCELAIN_HEADER_RE.match(line)
+            if match != None:
+                commit = commits.setdefault(match.group(1), {'sha': match.group(1)})
+                line_number = int(match.group(2))
+            elif line:
+                if commit == None:
+                    raise GitError("Malformed git blame output, commit information without a header: {!r}".format(line))
+                key, _, value = line.partition(' ')
+                commit[key] = value
+
+    def _line_blame(self, commit):
+        if not 'blame' in commit:
+            commit['blame'] = LineBlame(
+                short_sha=commit['sha'],
+                commit_url=self.project_link + '/commit/' + commit['sha'],
+                avatar_url=None,
+                commit_message=commit.get('summary'),
+                user_name=commit.get('author'),
+                time=datetime.fromtimestamp(int(commit.get('author-time', 0)), timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+                timestamp=int(commit.get('author-time', 0)))
+        return commit['blame']
+
+
+if __name__ == "__main__":
+    logging.basicConfig(stream=sys.stderr, format='%(name)s %(levelname)s %(message)s')
+
+    blamer = GitBlameParser(project_link='', logger=log)
+    blamer.get_blame_page('HEAD', sys.argv[1])
+    blamer.print_blame_data('user_name')
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+import logging
+import threading
+from collections import deque
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+module = sys.modules['__main__'].__file__
+log = logging.getLogger(module)
+
+DEFAULT_POOL_SIZE = 8
+# Seconds to wait for connecting to and reading from GitHub
+DEFAULT_TIMEOUT = (5, 30)
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+RETRY_STATUS = (429, 500, 502, 503, 504)
+# Requests whose latency is kept for the percentiles of summary()
+DEFAULT_RECENT = 1000
+
+class HttpClient:
+    """Pooled keep-alive session shared by everything that talks to GitHub.
+
+    Requests answered with 429 or 5xx are retried with exponential backoff.
+    Requests are counted and timed so slow runs can be explained, the
+    latencies of the last `recent` ones are kept for percentiles.
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+            retries=DEFAULT_RETRIES, backoff_factor=DEFAULT_BACKOFF, recent=DEFAULT_RECENT):
+        self.timeout = timeout
+        self.session = requests.Session()
+        retry = Retry(total=retries, backoff_factor=backoff_factor,
+            status_forcelist=RETRY_STATUS, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._lock = threading.Lock()
+        # (url, status, seconds) of the last requests
+        self.latencies = deque(maxlen=recent)
+        self.requests = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.bytes_received = 0
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        start = time.perf_counter()
+        response = self.session.get(url, **kwargs)
+        elapsed = time.perf_counter() - start
+
+        with self._lock:
+            self.latencies.append((url, response.status_code, elapsed))
+            self.requests += 1
+            self.total_time += elapsed
+            self.max_time = max(self.max_time, elapsed)
+            if not kwargs.get('stream'):
+                self.bytes_received += len(response.content)
+        log.debug("GET {} {} {:.3f}s".format(url, response.status_code, elapsed))
+
+        response.raise_for_status()
+        return response
+
+    def summary(self):
+        with self._lock:
+            recent = sorted(elapsed for url, status, elapsed in self.latencies)
+            return {
+                'requests': self.requests,
+                'bytes': self.bytes_received,
+                'total_time': self.total_time,
+                'mean_time': self.total_time / self.requests if self.requests else 0.0,
+                'max_time': self.max_time,
+                'recent_median_time': recent[len(recent) // 2] if recent else 0.0,
+                'recent_p95_time': recent[int(len(recent) * 0.95)] if recent else 0.0,
+            }
+
+    def close(self):
+        self.session.close()
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+def default_client():
+    """Client used by code that was not handed one explicitly"""
+    global _default_client
+    with _default_client_lock:
+        if _default_client == None:
+            _default_client = HttpClient()
+        return _default_client
@@ -1,209 +1,868 @@
 #!/usr/bin/env python3
 # pylint: disable=invalid-name
 
-import os
 import argparse
 import logging
 import sys
 import operator
-from collections import OrderedDict
-import requests
-
-from models import LineChange
-from blame import BlameParser
+import json
+import functools
+import bisect
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, as_completed, wait, FIRST_COMPLETED
+
+from models import LineChange, LineBlame, ChangeSet, ChangeIndex
+from blame import BlameParser, DEFAULT_SKIP_TOKENS, SKIP_TOKENS, skip_tokens_for
+from git_blame import GitBlameParser
 from parse import DiffParser
+from cache import BlameCache, default_cache_dir, DEFAULT_MAX_SIZE
+from http_client import HttpClient, DEFAULT_TIMEOUT, DEFAULT_RETRIES
+from stats import Stats, NULL_STATS
+from scoring import WeightTable, DEFAULT_WEIGHTS, RunningScores, score, highest_scores
+from ownership import OwnershipIndexes, IndexedBlame
 
 module = sys.modules['__main__'].__file__
 log = logging.getLogger(module)
 
+# Number of blame pages fetched in parallel
+DEFAULT_WORKERS = 8
+# Number of reviewers recommended by top_k
+DEFAULT_TOP_K = 3
+# Characters of a streamed diff decoded at once
+DIFF_CHUNK_SIZE = 2**16
+
+def split_lines(chunks):
+    """Lines of text chunks without their line ending, split at '\\n' only.
+
+    Unlike str.splitlines, which response.iter_lines uses, form feeds and
+    other separators inside a line do not end it, and a '\\r\\n' ending
+    is one line ending even if a chunk ends between '\\r' and '\\n'.
+    """
+    pending = ''
+    for chunk in chunks:
+        lines = (pending + chunk).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line[:-1] if line[-1:] == '\r' else line
+    if pending:
+        yield pending[:-1] if pending[-1] == '\r' else pending
+
+class HunkTable:
+    """Blame hunks of a stored result, every hunk is stored once and referred to by index"""
+
+    def __init__(self, hunks=()):
+        self.hunks = [LineBlame.from_fields(hunk) for hunk in hunks]
+        self.index = dict((hunk, i) for i, hunk in enumerate(self.hunks))
+
+    def encode(self, blame):
+        if blame == None:
+            return -1
+        if not blame in self.index:
+            self.index[blame] = len(self.hunks)
+            self.hunks.append(blame)
+        return self.index[blame]
+
+    def decode(self, i):
+        return self.hunks[i] if i >= 0 else None
+
+    def to_list(self):
+        return [list(hunk) for hunk in self.hunks]
+
 class Marvin(object):
     """Merely a ReView INcentiviser"""
 
-    def __init__(self, project_link, pr_n):
+    def __init__(self, project_link, pr_n, workers=DEFAULT_WORKERS, cache=None, http=None, partial_blame=False,
+            skip_tokens=None, store=None, reuse_parents=True, blame_factory=BlameParser, parse_pool=None, stats=None,
+            weights=None, ownership=None):
         self.project_link = project_link
         self.pr_n = pr_n
+        self.workers = max(1, workers)
+        self.cache = cache
+        self.http = http or HttpClient(pool_size=self.workers)
+        # Only materialize the blame of changed lines and their surroundings
+        self.partial_blame = partial_blame
+        # File extension -> tokens of uninteresting lines, overriding blame.DEFAULT_SKIP_TOKENS, e.g. blame.SKIP_TOKENS
+        self.skip_tokens = skip_tokens
+        # Persistent per-commit results for incremental re-analysis, see save_analysis
+        self.store = store
+        # Blame the parent of a commit at an equivalent revision of the series, see blame_revision
+        self.reuse_parents = reuse_parents
+        # Creates the blame backend of a pair, called like BlameParser
+        self.blame_factory = blame_factory
+        # Process pool blame pages are parsed in, so parsing is not bound to one core
+        self.parse_pool = parse_pool
+        # Timings and counters of the run, see stats.Stats
+        self.stats = stats if stats != None else NULL_STATS
+        # Relevance of a changed line by kind of change and file, see scoring.WeightTable
+        self.weights = weights if weights != None else DEFAULT_WEIGHTS
+        # Index of the blame of the project, fed by the pages of the base revision and answering when a fetch
+        # fails, see ownership.py
+        self.ownership = ownership
+        self.saved_fetches = 0
+        # Pairs left unblamed by blame_top_k, and the most relevance their lines could add
+        self.skipped_pairs = set([])
+        self.bound = None
 
         self.raw_diff = None
         self.diff_parser = None
+        self.additional_changes = ChangeSet()
         self.additional_lines = OrderedDict()
         self.blame_data = {}
-
-    def load_diff_from_project(self):
+        # (file, commit_sha) -> (set, sorted list) of changed line numbers
+        self.changed_index = None
+        # (file, commit_sha) -> {line_n: (previous, next) interesting line}
+        self.neighbours = {}
+        # Pairs whose neighbours have been computed in this run, not loaded from the store
+        self.computed_neighbours = set([])
+
+    def load_diff_from_project(self, stream=False):
         diff_url = self.project_link + "/pull/" + str(self.pr_n) + ".patch"
-        response = requests.get(diff_url)
-        self.raw_diff = response.text.split('\n')
+        with self.stats.stage('diff_fetch'):
+            response = self.http.get(diff_url, stream=stream)
+        if stream:
+            # Lines are only downloaded as the parser asks for them
+            if response.encoding == None:
+                response.encoding = 'utf-8'
+            lines = split_lines(response.iter_content(DIFF_CHUNK_SIZE, decode_unicode=True))
+            self.raw_diff = self.stats.counted('diff_bytes', lines, lambda line: len(line.encode('utf-8')) + 1)
+        else:
+            self.stats.count('diff_bytes', len(response.content))
+            self.raw_diff = list(split_lines([response.text]))
 
     def load_diff_from_filename(self, filename):
         with open(filename) as f:
             self.raw_diff = f.readlines()
 
+    def _new_diff_parser(self):
+        return DiffParser(diff_content=self.raw_diff, replay=self._replay if self.store != None else None,
+            stats=self.stats)
+
+    def _replay(self, commit_sha):
+        stored = self.store.get(self.project_link, commit_sha, '')
+        if stored == None:
+            return None
+
+        hunks = HunkTable(stored['hunks'])
+        return [(file,) + tuple([(line_n, hunks.decode(hunk)) for line_n, hunk in lines] for lines in sections)
+            for file, *sections in stored['sections']]
+
     def parse_diff(self):
-        self.diff_parser = DiffParser(diff_content=self.raw_diff)
-        self.diff_parser.parse()
+        self.diff_parser = self._new_diff_parser()
+        with self.stats.stage('diff_parse'):
+            for section in self.diff_parser.iter_file_rows():
+                pass
+            self.diff_parser.compact()
+            self.build_changed_index()
 
     def load_blame_from_html(self, file, commit_sha, filepath):
         if not file in self.blame_data:
             self.blame_data[file] = {}
 
-        self.blame_data[file][commit_sha] = BlameParser(self.project_link)
+        self.blame_data[file][commit_sha] = BlameParser(self.project_link,
+            skip_tokens=skip_tokens_for(file, self.skip_tokens))
         self.blame_data[file][commit_sha].load_html_file(filepath)
 
+    def blame_pairs(self, unblamed_only=False):
+        """Unique (file, commit_sha) pairs in the order they appear in the diff"""
+        change_set = self.diff_parser.change_set
+        pairs = OrderedDict()
+        for file in self.diff_parser.changes.keys():
+            for i in range(3):
+                for row in self.diff_parser.changes[file][i].rows.values():
+                    if not unblamed_only or change_set.author_id(row) < 0:
+                        pairs[(file, change_set.commit_sha(row))] = None
+        return list(pairs.keys())
+
+    def changed_lines(self, file, commit_sha):
+        change_set = self.diff_parser.change_set
+        return [line_n for i in range(3) for line_n, row in self.diff_parser.changes[file][i].rows.items()
+            if change_set.commit_sha(row) == commit_sha]
+
+    def _fetch_blame(self, pair, lines=None):
+        file, commit_sha = pair
+        blamer = self.blame_factory(self.project_link, cache=self.cache, http=self.http,
+            skip_tokens=skip_tokens_for(file, self.skip_tokens), stats=self.stats)
+        if lines != None:
+            blamer.restrict(lines)
+        blamer.get_blame_page(commit_sha, file, self.parse_pool)
+        return blamer
+
+    def base_revision(self):
+        """Parent of the first commit of the series, the revision the PR is based on"""
+        first = next(iter(self.diff_parser.commits), None) if self.diff_parser != None else None
+        return first + '~1' if first != None else None
+
+    def _index_blame(self, file, commit_sha, blamer):
+        """Add a page to the ownership index, if it is the complete blame of the file the PR is based on.
+
+        Pages of the commits of the PR may never be merged, and restricted
+        pages miss most lines, so neither is taken as the ownership of a file.
+        """
+        revision = self.blame_revision(file, commit_sha)
+        if self.ownership != None and revision == self.base_revision() and blamer.complete():
+            self.ownership.update(file, revision, blamer.blame_data)
+
+    def blame_revision(self, file, commit_sha):
+        """Revision of the series with the same blame page of file as commit_sha.
+
+        The series of a PR is linear, so the parent of a commit holds a file
+        as the latest earlier commit touching it left it, or as the parent of
+        the first commit if no earlier commit touched it.
+        """
+        if not self.reuse_parents or commit_sha == None or not commit_sha.endswith('~1'):
+            return commit_sha
+
+        commits = list(self.diff_parser.commits)
+        commit = commit_sha[:-len('~1')]
+        if not commit in commits or commits[0] == None:
+            return commit_sha
+        for earlier in reversed(commits[:commits.index(commit)]):
+            if file in self.diff_parser.commits[earlier]:
+                return earlier
+        return commits[0] + '~1'
+
+    def _submit_blame(self, executor, futures, fetches, pair, lines):
+        """Fetch the blame page of a pair, unless the page of an equivalent revision is already there"""
+        file, commit_sha = pair
+        revision = (file, self.blame_revision(file, commit_sha))
+        loaded = self.blame_data.get(file, {}).get(revision[1])
+        if loaded != None:
+            futures[pair] = Future()
+            futures[pair].set_result(loaded)
+        elif revision in fetches:
+            futures[pair] = fetches[revision]
+        else:
+            futures[pair] = fetches[revision] = executor.submit(self._fetch_blame, revision, lines)
+            return
+
+        log.debug("Blame of {} at {} taken from {}".format(file, commit_sha, revision[1]))
+        self.saved_fetches += 1
+        self.stats.count('blame_pages_reused')
+
+    def _store_blames(self, futures):
+        # Pages are downloaded concurrently, but stored in diff order so the
+        # result does not depend on which request finishes first
+        for (file, commit_sha), future in futures.items():
+            if not file in self.blame_data:
+                self.blame_data[file] = OrderedDict()
+            self.blame_data[file][commit_sha] = self._blame_result(file, commit_sha, future)
+
+    def _blame_result(self, file, commit_sha, future):
+        """Blame page of a fetch, taken from the ownership index if the fetch failed"""
+        try:
+            blamer = future.result()
+            self._index_blame(file, commit_sha, blamer)
+            return blamer
+        except Exception as error:
+            if self.ownership == None or self.ownership.line_count(file) == 0:
+                raise
+            log.warning("Blaming {} at {} failed, falling back to the ownership index: {}".format(file, commit_sha, error))
+            self.stats.count('ownership_fallbacks')
+            return self.ownership.blamer(file)
+
+    def fetch_blames(self):
+        futures, fetches = OrderedDict(), {}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for pair in self.blame_pairs(unblamed_only=True):
+                file, commit_sha = pair
+                if not commit_sha in self.blame_data.get(file, {}):
+                    lines = self.changed_lines(file, commit_sha) if self.partial_blame else None
+                    self._submit_blame(executor, futures, fetches, pair, lines)
+            self._store_blames(futures)
+
+    def parse_and_blame(self):
+        """Parse the diff, fetching the blame pages of every file section as soon as it ends"""
+        self.diff_parser = self._new_diff_parser()
+
+        futures, fetches = OrderedDict(), {}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            # Includes submitting the fetches, but not waiting for them
+            with self.stats.stage('diff_parse'):
+                for file, change_set, rows in self.diff_parser.iter_file_rows():
+                    section_lines = OrderedDict()
+                    for row in rows:
+                        if change_set.author_id(row) >= 0:
+                            # Replayed from an earlier run
+                            continue
+                        section_lines.setdefault(change_set.commit_sha(row), []).append(change_set.line_numbers[row])
+
+                    for commit_sha, lines in section_lines.items():
+                        pair = (file, commit_sha)
+                        if not pair in futures and not commit_sha in self.blame_data.get(file, {}):
+                            self._submit_blame(executor, futures, fetches, pair, lines if self.partial_blame else None)
+                self.diff_parser.compact()
+                self.build_changed_index()
+
+            with self.stats.stage('blame_wait'):
+                self._store_blames(futures)
+
+        self.blame_lines()
+
     def blame_lines(self):
         if self.diff_parser == None:
             log.error("Diff not parsed before blaming")
             return
 
+        with self.stats.stage('blame_lines'):
+            for file in self.diff_parser.changes.keys():
+                if not file in self.blame_data:
+                    self.blame_data[file] = OrderedDict()
+
+            self.fetch_blames()
+
+            change_set = self.diff_parser.change_set
+            for file in self.diff_parser.changes.keys():
+                for i in range(3):
+                    for line, row in self.diff_parser.changes[file][i].rows.items():
+                        if change_set.author_id(row) < 0:
+                            blamer = self.blame_data[file][change_set.commit_sha(row)]
+                            change_set.set_author(row, blamer.blame_line(line))
+
+    def blame_top_k(self, k=DEFAULT_TOP_K):
+        """Blame pairs until the order of the k most relevant reviewers cannot change anymore.
+
+        Pairs with the most relevant changed lines are fetched first. Once the
+        lines not blamed yet could not change the order of the top k, even if
+        all of their relevance and the one of their interesting lines went to
+        a single reviewer, the remaining pairs are skipped. Returns that
+        bound, 0 if every pair has been blamed.
+        """
+        if self.diff_parser == None:
+            log.error("Diff not parsed before blaming")
+            return None
+
+        with self.stats.stage('blame_lines'):
+            change_set = self.diff_parser.change_set
+            running = RunningScores(self.weights)
+            # Rows of every pair, with their position in the order of load_additional_lines
+            pair_rows = OrderedDict()
+            position = 0
+            for file in self.diff_parser.changes.keys():
+                for i in range(3):
+                    for line_n, row in self.diff_parser.changes[file][i].rows.items():
+                        pair_rows.setdefault((file, change_set.commit_sha(row)), []).append((position, line_n, row))
+                        position += 1
+
+            bounds = OrderedDict()
+            for (file, commit_sha), rows in pair_rows.items():
+                if not commit_sha in self.blame_data.get(file, {}) \
+                    and any(change_set.author_id(row) < 0 for position, line_n, row in rows):
+                    bounds[(file, commit_sha)] = sum(running.upper_bound(change_set.view(row))
+                        for position, line_n, row in rows)
+                    running.expect(file, bounds[(file, commit_sha)])
+            for pair, rows in pair_rows.items():
+                if not pair in bounds:
+                    self._blame_pair(running, pair, rows)
+
+            pending = deque(sorted(bounds, key=bounds.get, reverse=True))
+            futures, fetches, waiting = OrderedDict(), {}, OrderedDict()
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                while pending or waiting:
+                    # Pages already being fetched are used, but no more are requested once settled
+                    settled = running.settled(k)
+                    while pending and not settled and len(waiting) < self.workers:
+                        pair = pending.popleft()
+                        lines = self.changed_lines(*pair) if self.partial_blame else None
+                        self._submit_blame(executor, futures, fetches, pair, lines)
+                        waiting.setdefault(futures[pair], []).append(pair)
+                    if not waiting:
+                        break
+
+                    done, not_done = wait(list(waiting), return_when=FIRST_COMPLETED)
+                    for future in done:
+                        for file, commit_sha in waiting.pop(future):
+                            self.blame_data.setdefault(file, OrderedDict())[commit_sha] = \
+                                self._blame_result(file, commit_sha, future)
+                            self._blame_pair(running, (file, commit_sha), pair_rows[(file, commit_sha)])
+                            running.finish(file, bounds[(file, commit_sha)])
+
+            self.skipped_pairs = set(pending)
+            self.bound = running.bound()
+            self.stats.count('blame_pairs_skipped', len(pending))
+            log.info("Skipped blaming {} pairs, adding at most {}".format(len(pending), self.bound))
+            return self.bound
+
+    def _blame_pair(self, running, pair, rows):
+        """Blame the rows of a pair, adding them and their interesting lines to running"""
+        file, commit_sha = pair
+        change_set = self.diff_parser.change_set
+        blamer = self.blame_data.get(file, {}).get(commit_sha)
+        for position, line_n, row in rows:
+            if change_set.author_id(row) < 0:
+                change_set.set_author(row, blamer.blame_line(line_n))
+            running.add_change(change_set.view(row))
+
+        neighbours = self.find_neighbours(file, commit_sha)
+        if neighbours == None:
+            return
+        for position, line_n, row in rows:
+            for line in neighbours[line_n]:
+                if line != None:
+                    running.add_interesting(position, line)
+
+    def blamer(self, file, commit_sha):
+        """Blame page of a pair, fetched on demand if it was not needed for blaming"""
+        blamer = self.blame_data.get(file, {}).get(commit_sha)
+        if blamer == None and self.store != None:
+            revision = self.blame_revision(file, commit_sha)
+            blamer = self.blame_data.get(file, {}).get(revision)
+            if blamer == None:
+                blamer = self._fetch_blame((file, revision))
+                self._index_blame(file, revision, blamer)
+            self.blame_data.setdefault(file, OrderedDict())[commit_sha] = blamer
+        return blamer
+
+    def is_interesting(self, line):
+        return not line.strip() in DEFAULT_SKIP_TOKENS
+
+    def build_changed_index(self):
+        """Index the changed line numbers of every (file, commit_sha) pair once, after parsing"""
+        change_set = self.diff_parser.change_set
+        changed = OrderedDict()
         for file in self.diff_parser.changes.keys():
-            if not file in self.blame_data:
-                self.blame_data[file] = OrderedDict()
             for i in range(3):
-                for line, linechange in self.diff_parser.changes[file][i].items():
-                    if not linechange.commit_sha in self.blame_data[file]:
-                        self.blame_data[file][linechange.commit_sha] = BlameParser(self.project_link)
-                        self.blame_data[file][linechange.commit_sha].get_blame_page(linechange.commit_sha, file)
-                    linechange.author = self.blame_data[file][linechange.commit_sha].blame_line(line)
+                for line_n, row in self.diff_parser.changes[file][i].rows.items():
+                    changed.setdefault((file, change_set.commit_sha(row)), set()).add(line_n)
 
-    def is_interesting(self, line):
-        to_skip = set(["", "{", "}", "begin", "end"])
+        self.changed_index = dict((pair, (lines, sorted(lines))) for pair, lines in changed.items())
+        self.neighbours = {}
+        self.computed_neighbours = set([])
 
-        return not line.strip() in to_skip
+    def _changed(self, file, commit):
+        if self.changed_index == None:
+            self.build_changed_index()
+        return self.changed_index.get((file, commit), (frozenset(), []))
 
     def has_been_changed(self, line_n, file, commit):
         if self.diff_parser == None:
             log.error("Diff not parsed before checking for changes")
             return
 
-        for i in range(3):
-            if line_n in self.diff_parser.changes[file][i] and \
-                self.diff_parser.changes[file][i][line_n].commit_sha == commit:
-                return True
+        return line_n in self._changed(file, commit)[0]
 
-        return False
+    def _find_intersing_line(self, file, line_n, commit_sha, step):
+        blamer = self.blame_data[file][commit_sha]
+        if not 1 <= line_n + step <= blamer.line_count:
+            return None
 
-    def _find_intersing_line(self, file, line_n, linechange, offset, step):
-        p = offset
-        while not self.has_been_changed(line_n + p, file, linechange.commit_sha) and \
-            not self.is_interesting(self.blame_data[file][linechange.commit_sha].file_data[line_n + p]):
-            p += step
+        # The search ends at the nearest changed line in that direction at the
+        # latest, so only the interesting lines before it are candidates
+        changed, ordered = self._changed(file, commit_sha)
+        if step > 0:
+            i = bisect.bisect_right(ordered, line_n)
+            stop = min(ordered[i] if i < len(ordered) else blamer.line_count + 1, blamer.line_count + 1)
+        else:
+            i = bisect.bisect_left(ordered, line_n)
+            stop = max(ordered[i - 1] if i > 0 else 0, 0)
+
+        n = blamer.find_interesting(line_n + step, stop, step)
+        if self.stats.enabled:
+            self.stats.count('neighbour_searches')
+            self.stats.count('neighbour_search_steps', abs((n if n != None else stop) - line_n))
+        if n == None:
+            return None
+        return LineChange(n, LineChange.ChangeType.interesting, file, commit_sha)
 
-            if line_n + p < 1 or line_n + p > len(self.blame_data[file][linechange.commit_sha].file_data):
+    def _find_previous_intersing_line(self, file, line_n, commit_sha):
+        return self._find_intersing_line(file, line_n, commit_sha, -1)
+
+    def _find_next_intersing_line(self, file, line_n, commit_sha):
+        return self._find_intersing_line(file, line_n, commit_sha, 1)
+
+    def find_neighbours(self, file, commit_sha):
+        """Previous and next interesting line around every changed line of a (file, commit_sha) pair"""
+        pair = (file, commit_sha)
+        if pair in self.neighbours:
+            return self.neighbours[pair]
+
+        neighbours = self._stored_neighbours(file, commit_sha)
+        if neighbours == None:
+            blamer = self.blamer(file, commit_sha)
+            if blamer == None:
+                log.error("Blame not loaded before blaming line")
                 return None
 
-        if not self.has_been_changed(line_n + p, file, linechange.commit_sha):
-            return LineChange(line_n + p, LineChange.ChangeType.interesting, file, linechange.commit_sha)
-        else:
+            neighbours = {}
+            for line_n in self._changed(file, commit_sha)[1]:
+                prev_line = self._find_previous_intersing_line(file, line_n, commit_sha)
+                next_line = self._find_next_intersing_line(file, line_n, commit_sha)
+                for line in [prev_line, next_line]:
+                    if line != None:
+                        line.author = blamer.blame_line(line.line_number)
+                neighbours[line_n] = (prev_line, next_line)
+            # Neighbours of the index are no result of the commit to be stored
+            if not isinstance(blamer, IndexedBlame):
+                self.computed_neighbours.add(pair)
+
+        self.neighbours[pair] = neighbours
+        return neighbours
+
+    def _stored_neighbours(self, file, commit_sha):
+        if self.store == None:
+            return None
+        stored = self.store.get(self.project_link, commit_sha, file)
+        # Only valid for the same changed lines and skip tokens
+        if stored == None or stored['changed'] != self._changed(file, commit_sha)[1] \
+            or stored['skip'] != sorted(skip_tokens_for(file, self.skip_tokens)):
             return None
 
-    def _find_previous_intersing_line(self, file, line_n, linechange):
-        return self._find_intersing_line(file, line_n, linechange, -1, -1)
+        hunks = HunkTable(stored['hunks'])
+        def line(line_n, hunk):
+            if line_n == None:
+                return None
+            change = LineChange(line_n, LineChange.ChangeType.interesting, file, commit_sha)
+            change.author = hunks.decode(hunk)
+            return change
 
-    def _find_next_intersing_line(self, file, line_n, linechange):
-        return self._find_intersing_line(file, line_n, linechange, 1, 1)
+        return dict((line_n, (line(prev_n, prev_hunk), line(next_n, next_hunk)))
+            for line_n, prev_n, prev_hunk, next_n, next_hunk in stored['neighbours'])
 
     def load_additional_lines(self):
         if self.diff_parser == None:
             log.error("Diff not parsed before loading additional lines")
             return
 
-        for file in self.diff_parser.changes.keys():
-            self.additional_lines[file] = {}
-            for i in range(3):
-                for line_n, linechange in self.diff_parser.changes[file][i].items():
-                    prev_line = self._find_previous_intersing_line(file, line_n, linechange)
-                    next_line = self._find_next_intersing_line(file, line_n, linechange)
-                    if self.blame_data[file][linechange.commit_sha] == None:
-                        log.error("Blame not loaded before blaming line")
-                        return
-
-                    if prev_line != None:
-                        prev_line.author = self.blame_data[file][linechange.commit_sha].blame_line(prev_line.line_number)
-                        self.additional_lines[file][prev_line.line_number] = prev_line
-                    if next_line != None:
-                        next_line.author = self.blame_data[file][linechange.commit_sha].blame_line(next_line.line_number)
-                        self.additional_lines[file][next_line.line_number] = next_line
+        with self.stats.stage('additional_lines'):
+            change_set = self.diff_parser.change_set
+            self.additional_changes = ChangeSet()
+            for file in self.diff_parser.changes.keys():
+                self.additional_lines[file] = ChangeIndex(self.additional_changes)
+                for i in range(3):
+                    for line_n, row in self.diff_parser.changes[file][i].rows.items():
+                        if (file, change_set.commit_sha(row)) in self.skipped_pairs:
+                            continue
+                        neighbours = self.find_neighbours(file, change_set.commit_sha(row))
+                        if neighbours == None:
+                            return
+
+                        for line in neighbours[line_n]:
+                            if line != None:
+                                self.additional_lines[file][line.line_number] = line
+
+    def save_analysis(self):
+        """Store the results of all commits parsed and pairs searched in this run.
+
+        A commit never changes, so when a PR gets new commits, only those are
+        parsed and blamed again. Neighbours of a pair are reused as long as
+        the changed lines of the pair are the same.
+        """
+        if self.ownership != None:
+            self.ownership.save()
+        if self.store == None or self.diff_parser == None:
+            return
+
+        with self.stats.stage('save_analysis'):
+            commits = OrderedDict()
+            for commit_sha, file, sections in self.diff_parser.sections:
+                if commit_sha != None:
+                    commits.setdefault(commit_sha, []).append((file, sections))
+
+            for commit_sha, files in commits.items():
+                hunks = HunkTable()
+                stored = []
+                for file, (added, removed, modified) in files:
+                    def encode(lines, commit):
+                        blamer = self.blame_data.get(file, {}).get(commit)
+                        return [[line_n, hunks.encode(blamer.blame_data.get(line_n) if blamer != None else None)]
+                            for line_n in lines]
+                    stored.append([file, encode(added, commit_sha), encode(removed, commit_sha + '~1'),
+                        encode(modified, commit_sha)])
+                self.store.put(self.project_link, commit_sha, '', {'hunks': hunks.to_list(), 'sections': stored})
+
+            for file, commit_sha in self.computed_neighbours:
+                hunks = HunkTable()
+                neighbours = []
+                for line_n, (prev_line, next_line) in self.neighbours[(file, commit_sha)].items():
+                    row = [line_n]
+                    for line in [prev_line, next_line]:
+                        row += [line.line_number, hunks.encode(line.author)] if line != None else [None, -1]
+                    neighbours.append(row)
+                self.store.put(self.project_link, commit_sha, file, {'changed': self._changed(file, commit_sha)[1],
+                    'skip': sorted(skip_tokens_for(file, self.skip_tokens)), 'hunks': hunks.to_list(), 'neighbours': neighbours})
 
     def relevanceOfChange(self, change):
-        if change.change_type == LineChange.ChangeType.deleted:
-            val = 2
-        if change.change_type == LineChange.ChangeType.modified:
-            val = 3
-        if change.change_type in [LineChange.ChangeType.added, LineChange.ChangeType.interesting]:
-            val = 1
+        return self.weights.relevance(change)
+
+    def reviewers(self):
+        # Most simple approach to obtaining reviewer
+        if self.diff_parser == None:
+            log.error("Diff not parsed before requesting reviewer")
+            return None
 
-        filename, file_extension = os.path.splitext('change.file_path')
-        if file_extension in set(['.conf', '.txt', '.md', '.cfg']):
-            val /= 3
+        with self.stats.stage('reviewers'):
+            reviewer_stats = score([self.diff_parser.change_set, self.additional_changes], self.weights)
+            if reviewer_stats == None:
+                log.error("Author data not fully loaded before requesting reviewer")
+                return None
 
-        # TODO parse time
+            sorted_reviewer = sorted(reviewer_stats.items(), key=operator.itemgetter(1))
+            return sorted_reviewer
 
-        return val
+    def top_k(self, k=DEFAULT_TOP_K):
+        """The k most relevant reviewers, most relevant first.
 
-    def reviewers(self):
-        # Most simple approach to obtaining reviewer
+        Selected with a heap instead of sorting every reviewer. The lines of
+        pairs skipped by blame_top_k are not counted.
+        """
         if self.diff_parser == None:
             log.error("Diff not parsed before requesting reviewer")
             return None
 
-        reviewer_stats = {}
-        for file in self.diff_parser.changes.keys():
-            for i in range(3):
-                for line_n, linechange in self.diff_parser.changes[file][i].items():
-                    if linechange.author == None:
-                        log.error("Author data not fully loaded before requesting reviewer")
-                        return None
-                    else:
-                        if not linechange.author.user_name in reviewer_stats:
-                            reviewer_stats[linechange.author.user_name] = 0
-                        else:
-                            reviewer_stats[linechange.author.user_name] += self.relevanceOfChange(linechange)
-
-            for line_n, linechange in self.additional_lines[file].items():
-                if not linechange.author.user_name in reviewer_stats:
-                    reviewer_stats[linechange.author.user_name] = 0
-                else:
-                    reviewer_stats[linechange.author.user_name] += self.relevanceOfChange(linechange)
-
-        sorted_reviewer = sorted(reviewer_stats.items(), key=operator.itemgetter(1))
-        return sorted_reviewer
+        with self.stats.stage('reviewers'):
+            reviewer_stats = score([self.diff_parser.change_set, self.additional_changes], self.weights,
+                blamed_only=bool(self.skipped_pairs))
+            if reviewer_stats == None:
+                log.error("Author data not fully loaded before requesting reviewer")
+                return None
+            return highest_scores(reviewer_stats, k)
+
+    def print_top(self, k=DEFAULT_TOP_K):
+        print('Top {} reviewers:\nNAME\t\tRELEVANCE'.format(k))
+        for name, relevance in self.top_k(k) or []:
+            print('{}\t\t{}'.format(name, relevance))
+        if self.skipped_pairs:
+            print('Skipped blaming {} pairs, their lines add at most {:g}'.format(len(self.skipped_pairs), self.bound))
 
     def print_summary(self):
         for file in self.diff_parser.changes:
             print('\n> Changes for "{}"'.format(file))
             for line, change in self.diff_parser.changes[file][0].items():
                 print('{} L{} added "{}", {}:'.format(change.commit_sha[0:4], line, change.author.user_name, change.author.time),
-                    self.blame_data[file][change.commit_sha].file_data[line].rstrip())
+                    self.blamer(file, change.commit_sha).line_text(line).rstrip())
             for line, change in self.diff_parser.changes[file][1].items():
                 print('{} L{} deleted "{}", {}:'.format(change.commit_sha[0:4], line, change.author.user_name, change.author.time),
-                    self.blame_data[file][change.commit_sha].file_data[line].rstrip())
+                    self.blamer(file, change.commit_sha).line_text(line).rstrip())
             for line, change in self.diff_parser.changes[file][2].items():
                 print('{} L{} modified "{}", {}:'.format(change.commit_sha[0:4], line, change.author.user_name, change.author.time),
-                    self.blame_data[file][change.commit_sha].file_data[line].rstrip())
+                    self.blamer(file, change.commit_sha).line_text(line).rstrip())
             print('>> Interesting lines:')
             for line, change in self.additional_lines[file].items():
                 print('{} L{} created "{}", {}:'.format(change.commit_sha[0:4], line, change.author.user_name, change.author.time),
-                    self.blame_data[file][change.commit_sha].file_data[line].rstrip())
+                    self.blamer(file, change.commit_sha).line_text(line).rstrip())
 
         print('Possible reviewers:\nNAME\t\tRELEVANCE')
         reviewers = self.reviewers()
         for name, lines in reviewers:
             print('{}\t\t{}'.format(name, lines))
 
-def main():
-    parser = argparse.ArgumentParser(description='Parses a pull request, returns recommendation for reviewer')
-    parser.add_argument('project_link', type=str, help='the link to the project')
-    parser.add_argument('pr_n', type=int, help='the number of the PR to parse')
+def recommend(project_link, pr_n, top_k=None, early_exit=False, ownership_indexes=None, **kwargs):
+    """Ranked reviewers of a pull request, see Marvin.reviewers.
+
+    With top_k, only the top_k most relevant ones, most relevant first, see
+    Marvin.top_k. With early_exit as well, blaming stops once their order is
+    settled, see Marvin.blame_top_k. ownership_indexes, an
+    ownership.OwnershipIndexes, provides the ownership index of the project.
+    """
+    if ownership_indexes != None:
+        kwargs['ownership'] = ownership_indexes.index(project_link)
+    marvin = Marvin(project_link, pr_n, **kwargs)
+    marvin.load_diff_from_project(stream=True)
+    if top_k != None and early_exit:
+        marvin.parse_diff()
+        marvin.blame_top_k(top_k)
+    else:
+        marvin.parse_and_blame()
+    marvin.load_additional_lines()
+    marvin.save_analysis()
+    return marvin.top_k(top_k) if top_k != None else marvin.reviewers()
+
+def read_batch(lines, invalid=None):
+    """(project_link, pr_n) of every "project_link pr_n" line, skipping blank lines and # comments.
+
+    Malformed lines are logged and skipped, their line numbers are appended
+    to invalid if it is given.
+    """
+    prs = []
+    for line_n, line in enumerate(lines, 1):
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+        fields = line.split()
+        if len(fields) != 2 or not fields[1].isdigit():
+            log.error("Skipping line {} of the batch, expected \"project_link pr_n\": {}".format(line_n, line))
+            if invalid != None:
+                invalid.append(line_n)
+            continue
+        prs.append((fields[0], int(fields[1])))
+    return prs
+
+def run_batch(prs, output, parallel=1, **kwargs):
+    """Recommend reviewers for every PR, writing one JSON line to output as each one finishes.
+
+    The keyword arguments are passed on to Marvin, so a single HTTP client
+    and blame cache are shared by all PRs.
+    """
+    failed = 0
+    with ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+        futures = OrderedDict((executor.submit(recommend, project_link, pr_n, **kwargs), (project_link, pr_n))
+            for project_link, pr_n in prs)
+        for future in as_completed(futures):
+            project_link, pr_n = futures[future]
+            result = OrderedDict([('project_link', project_link), ('pr_n', pr_n)])
+            try:
+                result['reviewers'] = future.result()
+            except Exception as error:
+                log.error("Recommending reviewers for {} #{} failed: {}".format(project_link, pr_n, error))
+                result['error'] = str(error)
+                failed += 1
+            output.write(json.dumps(result) + '\n')
+            output.flush()
+    return failed
+
+def add_common_arguments(parser):
+    parser.add_argument('-j', '--jobs', type=int, default=DEFAULT_WORKERS, help='the number of blame pages fetched in parallel')
+    parser.add_argument('--cache-dir', type=str, default=default_cache_dir(), help='the directory parsed blame pages are cached in')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_MAX_SIZE // 2**20, help='the maximum size of the blame cache in MB')
+    parser.add_argument('--no-cache', action='store_true', help='always download blame pages')
+    parser.add_argument('--partial-blame', action='store_true', help='only parse the blame of changed lines and their surroundings; such pages are not cached')
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT[1], help='seconds to wait for a response from GitHub')
+    parser.add_argument('--retries', type=int, default=DEFAULT_RETRIES, help='how often failed requests are retried')
+    parser.add_argument('--no-parent-reuse', action='store_true', help='fetch the blame of the parent of every commit, even if an earlier commit of the PR has the same one')
+    parser.add_argument('--parse-processes', type=int, default=0, help='the number of processes blame pages are parsed in, 0 parses them in this process')
+    parser.add_argument('--git-repo', type=str, help='blame with git in this local clone of the project instead of scraping GitHub')
+    parser.add_argument('--incremental', action='store_true', help='keep the results of every commit in the cache directory, so only new commits of a PR are analysed again')
+    parser.add_argument('--ownership', action='store_true', help='keep an index of who wrote which lines of every project in the cache directory, answering from it when a blame page cannot be fetched')
+    parser.add_argument('--skip-tokens', type=str, help='"languages" for built-in tokens of uninteresting lines per file extension, or a JSON file of them like {".py": ["", "pass"]}; by default every file uses the same tokens')
+    parser.add_argument('--weights', type=str, help='JSON file of the weights of kinds of changes and file classes, see scoring.WeightTable.from_dict')
+    parser.add_argument('--half-life', type=float, help='days after which the relevance of a blamed line halves, by default lines do not age')
+    parser.add_argument('--top', type=int, help='only recommend this many reviewers, most relevant first')
+    parser.add_argument('--early-exit', action='store_true', help='with --top, stop blaming once the lines not blamed yet cannot change the top reviewers')
+    parser.add_argument('--stats', type=str, nargs='?', const='-', help='write the time spent per stage and counters as JSON to this file, stderr by default')
     parser.add_argument('-v', '--verbose', action='count', default=0, help="increases log verbosity for each occurence.")
 
-    args = parser.parse_args()
+def setup_from_arguments(args, pool_size):
+    """Logging, blame cache, HTTP client and analysis store as configured by add_common_arguments"""
     log.setLevel([logging.WARNING, logging.INFO, logging.DEBUG][min(2, args.verbose)])
-
-    marvin = Marvin(args.project_link, args.pr_n)
-    marvin.load_diff_from_project()
-    marvin.parse_diff()
-    marvin.blame_lines()
+    cache = None if args.no_cache else BlameCache(args.cache_dir, max_size=args.cache_size * 2**20)
+    http = HttpClient(pool_size=pool_size, timeout=(DEFAULT_TIMEOUT[0], args.timeout), retries=args.retries)
+    store = BlameCache(args.cache_dir, max_size=args.cache_size * 2**20, name='analysis') if args.incremental else None
+    return cache, http, store
+
+def parse_pool_from_arguments(args):
+    return ProcessPoolExecutor(args.parse_processes) if args.parse_processes > 0 else None
+
+def stats_from_arguments(args):
+    return Stats() if args.stats != None else None
+
+def emit_stats(args, stats):
+    if stats == None:
+        return
+    if args.stats == '-':
+        stats.emit(sys.stderr)
+    else:
+        with open(args.stats, 'w') as f:
+            stats.emit(f)
+
+def ownership_from_arguments(args):
+    if not args.ownership:
+        return None
+    return OwnershipIndexes(BlameCache(args.cache_dir, max_size=args.cache_size * 2**20, name='ownership'))
+
+def skip_tokens_from_arguments(args):
+    if args.skip_tokens == None:
+        return None
+    if args.skip_tokens == 'languages':
+        return SKIP_TOKENS
+    with open(args.skip_tokens) as f:
+        return dict((extension, frozenset(tokens)) for extension, tokens in json.load(f).items())
+
+def weights_from_arguments(args):
+    if args.weights == None and args.half_life == None:
+        return None
+    table = {}
+    if args.weights != None:
+        with open(args.weights) as f:
+            table = json.load(f)
+    if args.half_life != None:
+        table['half_life'] = args.half_life
+    return WeightTable.from_dict(table)
+
+def blame_factory_from_arguments(args):
+    if args.git_repo != None:
+        return functools.partial(GitBlameParser, repository=args.git_repo)
+    return BlameParser
+
+def batch_main(argv):
+    parser = argparse.ArgumentParser(prog='marvin.py batch',
+        description='Recommends reviewers for many PRs, writing one JSON line per PR')
+    parser.add_argument('input', type=argparse.FileType('r'), nargs='?', default='-',
+        help='file of "project_link pr_n" lines, stdin by default')
+    parser.add_argument('-p', '--parallel', type=int, default=1, help='the number of PRs processed in parallel')
+    add_common_arguments(parser)
+
+    args = parser.parse_args(argv)
+    cache, http, store = setup_from_arguments(args, pool_size=args.jobs * max(1, args.parallel))
+    parse_pool = parse_pool_from_arguments(args)
+    stats = stats_from_arguments(args)
+    invalid = []
+    with args.input:
+        prs = read_batch(args.input, invalid)
+
+    failed = run_batch(prs, sys.stdout, parallel=args.parallel, workers=args.jobs, cache=cache, http=http,
+        partial_blame=args.partial_blame, store=store, reuse_parents=not args.no_parent_reuse,
+        blame_factory=blame_factory_from_arguments(args), parse_pool=parse_pool, stats=stats,
+        weights=weights_from_arguments(args), top_k=args.top, early_exit=args.early_exit,
+        ownership_indexes=ownership_from_arguments(args), skip_tokens=skip_tokens_from_arguments(args))
+    emit_stats(args, stats)
+    log.info("HTTP {}".format(http.summary()))
+    if cache != None:
+        log.info("Blame cache {} hits, {} misses".format(cache.hits, cache.misses))
+    return 1 if failed or invalid else 0
+
+def owners_main(argv):
+    parser = argparse.ArgumentParser(prog='marvin.py owners',
+        description='Ranks the authors of the lines below a directory, as kept by --ownership')
+    parser.add_argument('project_link', type=str, help='the link to the project')
+    parser.add_argument('directory', type=str, nargs='?', default='', help='a directory or file of the project, all of it by default')
+    parser.add_argument('--cache-dir', type=str, default=default_cache_dir(), help='the directory the index is kept in')
+    parser.add_argument('--weights', type=str, help='JSON file of the weights of file classes, see scoring.WeightTable.from_dict')
+    parser.add_argument('--half-life', type=float, help='days after which the weight of a line halves, by default lines do not age')
+
+    args = parser.parse_args(argv)
+    index = OwnershipIndexes(BlameCache(args.cache_dir, name='ownership')).index(args.project_link)
+    print('NAME\t\tWEIGHT')
+    for name, weight in index.owners(args.directory, weights_from_arguments(args) or DEFAULT_WEIGHTS).items():
+        print('{}\t\t{:g}'.format(name, weight))
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv == None else argv
+    if argv[:1] == ['batch']:
+        return batch_main(argv[1:])
+    if argv[:1] == ['owners']:
+        return owners_main(argv[1:])
+
+    parser = argparse.ArgumentParser(description='Parses a pull request, returns recommendation for reviewer',
+        epilog='Use "%(prog)s batch -h" to process many PRs at once, "%(prog)s owners -h" to query the ownership index.')
+    parser.add_argument('project_link', type=str, help='the link to the project')
+    parser.add_argument('pr_n', type=int, help='the number of the PR to parse')
+    add_common_arguments(parser)
+
+    args = parser.parse_args(argv)
+    cache, http, store = setup_from_arguments(args, pool_size=args.jobs)
+    parse_pool = parse_pool_from_arguments(args)
+    stats = stats_from_arguments(args)
+    indexes = ownership_from_arguments(args)
+    marvin = Marvin(args.project_link, args.pr_n, workers=args.jobs, cache=cache, http=http,
+        partial_blame=args.partial_blame, store=store, reuse_parents=not args.no_parent_reuse,
+        blame_factory=blame_factory_from_arguments(args), parse_pool=parse_pool, stats=stats,
+        weights=weights_from_arguments(args), ownership=indexes.index(args.project_link) if indexes != None else None,
+        skip_tokens=skip_tokens_from_arguments(args))
+    marvin.load_diff_from_project(stream=True)
+    if args.top != None and args.early_exit:
+        marvin.parse_diff()
+        marvin.blame_top_k(args.top)
+    else:
+        marvin.parse_and_blame()
     marvin.load_additional_lines()
-    marvin.print_summary()
+    marvin.save_analysis()
+    if args.top != None:
+        marvin.print_top(args.top)
+    else:
+        marvin.print_summary()
+    log.info("Blame planner saved {} fetches".format(marvin.saved_fetches))
+    log.info("HTTP {}".format(http.summary()))
+    emit_stats(args, stats)
 
 if __name__ == "__main__":
     logging.basicConfig(stream=sys.stderr, format='%(name)s %(levelname)s %(message)s')
-    main()
+    sys.exit(main())
@@ -1,42 +1,508 @@
 #!/usr/bin/env python3
 
+import bisect
+from abc import ABCMeta
 from enum import Enum
-from recordclass import recordclass
+from array import array
+from datetime import datetime
+from typing import NamedTuple
+from collections.abc import MutableMapping, ItemsView, ValuesView
+
+class BaseLineChange:
+    """What LineChange and LineChangeView have in common, without any slots of its own"""
 
-class LineChange:
     class ChangeType(Enum):
         added = 1
         deleted = 2
         modified = 3
         interesting = 4
 
-    def __init__(self, line_number=None, change_type=None, file_path=None, commit_sha=None):
-        self.line_number = line_number
-        self.change_type = change_type
-        self.file_path = file_path
-        self.commit_sha = commit_sha
-        self.author = None
+    FIELDS = ('line_number', 'change_type', 'file_path', 'commit_sha', 'author')
+    __slots__ = ()
 
     def __str__(self):
-        return ', '.join("{}: {}".format(k, str(v)) for k,v in vars(self).items())
+        return ', '.join("{}: {}".format(k, str(getattr(self, k))) for k in self.FIELDS)
 
     def __repr__(self):
         return "<{klass} {str}>".format(klass=self.__class__.__name__, str=str(self))
 
+    def _fields(self):
+        return (self.line_number, self.change_type, self.file_path, self.commit_sha, self.author)
+
     def __eq__(self, other):
-        if isinstance(other, self.__class__):
-            return self.__dict__ == other.__dict__
+        if isinstance(other, BaseLineChange):
+            return self._fields() == other._fields()
         else:
             return False
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
-LineBlame = recordclass('LineBlame', [
-    'short_sha',
-    'commit_url',
-    'avatar_url',
-    'commit_message',
-    'user_name',
-    'time'
-])
+    def __hash__(self):
+        # The author is assigned after parsing, so it is not part of the hash
+        return hash((self.line_number, self.change_type, self.file_path, self.commit_sha))
+
+class LineChange(BaseLineChange, metaclass=ABCMeta):
+    """A line change holding its own fields; a LineChangeView is registered as one, too"""
+    __slots__ = BaseLineChange.FIELDS
+
+    def __init__(self, line_number=None, change_type=None, file_path=None, commit_sha=None):
+        self.line_number = line_number
+        self.change_type = change_type
+        self.file_path = file_path
+        self.commit_sha = commit_sha
+        self.author = None
+
+def epoch(time):
+    """Seconds since the epoch of an ISO 8601 time like 2018-02-15T10:00:00Z, None if it is not one"""
+    try:
+        return int(datetime.strptime(time.replace('Z', '+0000'), '%Y-%m-%dT%H:%M:%S%z').timestamp())
+    except (AttributeError, ValueError):
+        return None
+
+class LineBlame(NamedTuple):
+    """Commit information of a blame hunk, one instance is shared by all of its lines"""
+    short_sha: str
+    commit_url: str
+    avatar_url: str
+    commit_message: str
+    user_name: str
+    time: str
+    # time in seconds since the epoch, parsed once per hunk
+    timestamp: int = None
+
+    @classmethod
+    def from_fields(cls, fields):
+        """LineBlame of stored fields, which lack the timestamp if stored before it existed"""
+        blame = cls(*fields)
+        if blame.timestamp == None and blame.time != None:
+            blame = blame._replace(timestamp=epoch(blame.time))
+        return blame
+
+class LineChangeView(BaseLineChange):
+    """A line change backed by one row of a ChangeSet, comparing equal to the LineChange of the same fields"""
+    __slots__ = ('change_set', 'row')
+
+    def __init__(self, change_set, row):
+        self.change_set = change_set
+        self.row = row
+
+    line_number = property(lambda self: self.change_set.line_numbers[self.row])
+    change_type = property(lambda self: self.change_set.change_type(self.row))
+    file_path = property(lambda self: self.change_set.file_path(self.row))
+    commit_sha = property(lambda self: self.change_set.commit_sha(self.row))
+
+    @property
+    def author(self):
+        return self.change_set.author(self.row)
+
+    @author.setter
+    def author(self, blame):
+        self.change_set.set_author(self.row, blame)
+
+LineChange.register(LineChangeView)
+
+class ChangeSet:
+    """Columnar storage of line changes, one row per changed line.
+
+    File paths and commits are interned, authors are indices into a table
+    of the (hunk-shared) LineBlame objects, -1 if not blamed yet. The author
+    column is only allocated once the first line is blamed. Rows that were
+    superseded while parsing are marked dead instead of being removed, so
+    row numbers stay valid. The ChangeIndexes of the files map line numbers
+    to rows in array columns as well, see RowIndex.
+    """
+
+    CHANGE_TYPES = {t.value: t for t in LineChange.ChangeType}
+
+    def __init__(self):
+        self.line_numbers = array('i')
+        self.change_types = array('b')
+        self.file_ids = array('i')
+        self.commit_ids = array('i')
+        self.author_ids = array('i')
+        self.dead = set()
+
+        self.files, self._file_index = [], {}
+        self.commits, self._commit_index = [], {}
+        self.authors, self._author_index = [], {}
+
+    @staticmethod
+    def _intern(table, ids, value):
+        value_id = ids.get(value)
+        if value_id == None:
+            value_id = ids[value] = len(table)
+            table.append(value)
+        return value_id
+
+    def file_id(self, file_path):
+        return self._intern(self.files, self._file_index, file_path)
+
+    def commit_id(self, commit_sha):
+        return self._intern(self.commits, self._commit_index, commit_sha)
+
+    def append_row(self, line_number, change_type_value, file_id, commit_id):
+        row = len(self.line_numbers)
+        self.line_numbers.append(line_number)
+        self.change_types.append(change_type_value)
+        self.file_ids.append(file_id)
+        self.commit_ids.append(commit_id)
+        return row
+
+    def set_row(self, row, line_number, change_type_value, file_id, commit_id):
+        self.line_numbers[row] = line_number
+        self.change_types[row] = change_type_value
+        self.file_ids[row] = file_id
+        self.commit_ids[row] = commit_id
+
+    def append(self, line_number, change_type, file_path, commit_sha, author=None):
+        row = self.append_row(line_number, change_type.value, self.file_id(file_path), self.commit_id(commit_sha))
+        if author != None:
+            self.set_author(row, author)
+        return row
+
+    def append_change(self, change):
+        return self.append(change.line_number, change.change_type, change.file_path, change.commit_sha, change.author)
+
+    def discard(self, row):
+        self.dead.add(row)
+
+    def change_type(self, row):
+        return self.CHANGE_TYPES[self.change_types[row]]
+
+    def file_path(self, row):
+        return self.files[self.file_ids[row]]
+
+    def commit_sha(self, row):
+        return self.commits[self.commit_ids[row]]
+
+    def author_id(self, row):
+        return self.author_ids[row] if row < len(self.author_ids) else -1
+
+    def author(self, row):
+        author_id = self.author_id(row)
+        return self.authors[author_id] if author_id >= 0 else None
+
+    def set_author(self, row, blame):
+        missing = len(self.line_numbers) - len(self.author_ids)
+        if missing > 0:
+            self.author_ids.extend([-1] * missing)
+
+        if blame == None:
+            self.author_ids[row] = -1
+        else:
+            # Equal hunks of different blame pages share one entry
+            author_id = self._author_index.get(blame)
+            if author_id == None:
+                author_id = self._author_index[blame] = len(self.authors)
+                self.authors.append(blame)
+            self.author_ids[row] = author_id
+
+    def compact(self, indexes):
+        """Drop dead rows, renumbering the rows held by the given ChangeIndexes.
+
+        Views handed out before are invalidated.
+        """
+        if not self.dead:
+            return
+
+        live = list(self.rows())
+        remap = {row: new_row for new_row, row in enumerate(live)}
+        for name in ('line_numbers', 'change_types', 'file_ids', 'commit_ids'):
+            column = getattr(self, name)
+            setattr(self, name, array(column.typecode, [column[row] for row in live]))
+        if self.author_ids:
+            self.author_ids = array('i', [self.author_id(row) for row in live])
+        self.dead = set()
+        for index in indexes:
+            index.rows.remap(remap)
+
+    def view(self, row):
+        return LineChangeView(self, row)
+
+    def rows(self):
+        dead = self.dead
+        return (row for row in range(len(self.line_numbers)) if not row in dead)
+
+    def __len__(self):
+        return len(self.line_numbers) - len(self.dead)
+
+    def __iter__(self):
+        return (self.view(row) for row in self.rows())
+
+class ChangeIndex(MutableMapping):
+    """Line number -> LineChange mapping for one kind of change in one file, backed by a ChangeSet"""
+
+    def __init__(self, change_set, rows=None):
+        self.change_set = change_set
+        self.rows = RowIndex()
+        if rows != None:
+            self.update_rows(rows)
+
+    def update_rows(self, rows):
+        items = sorted(rows.items())
+        if not self.rows:
+            self.rows.line_numbers = array('i', [line_number for line_number, row in items])
+            self.rows.row_ids = array('i', [row for line_number, row in items])
+            return
+        # In line order, so the rows are mostly appended
+        for line_number, row in items:
+            old = self.rows.get(line_number)
+            if old != None and old != row:
+                self.change_set.discard(old)
+            self.rows[line_number] = row
+
+    def __getitem__(self, line_number):
+        return self.change_set.view(self.rows[line_number])
+
+    def __setitem__(self, line_number, change):
+        if isinstance(change, LineChangeView) and change.change_set is self.change_set:
+            row = change.row
+        else:
+            row = self.change_set.append_change(change)
+        self.update_rows({line_number: row})
+
+    def __delitem__(self, line_number):
+        self.change_set.discard(self.rows.pop(line_number))
+
+    def __contains__(self, line_number):
+        return line_number in self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+class RowIndex(MutableMapping):
+    """Line number -> row mapping of a ChangeIndex, stored as sorted columns.
+
+    Takes 8 bytes per line instead of a dict entry, lookups bisect the line
+    numbers. Lines are mostly added in ascending order, which only appends.
+    Iterates in line order.
+    """
+
+    def __init__(self, items=None):
+        self.line_numbers, self.row_ids = array('i'), array('i')
+        if items != None:
+            self.update(items)
+
+    def _find(self, line_number):
+        """Index of line_number, -1 if it is not there"""
+        line_numbers = self.line_numbers
+        i = bisect.bisect_left(line_numbers, line_number)
+        if i < len(line_numbers) and line_numbers[i] == line_number:
+            return i
+        return -1
+
+    def __getitem__(self, line_number):
+        i = self._find(line_number)
+        if i < 0:
+            raise KeyError(line_number)
+        return self.row_ids[i]
+
+    def get(self, line_number, default=None):
+        i = self._find(line_number)
+        return self.row_ids[i] if i >= 0 else default
+
+    def __setitem__(self, line_number, row):
+        line_numbers = self.line_numbers
+        if not line_numbers or line_number > line_numbers[-1]:
+            line_numbers.append(line_number)
+            self.row_ids.append(row)
+            return
+
+        i = bisect.bisect_left(line_numbers, line_number)
+        if line_numbers[i] == line_number:
+            self.row_ids[i] = row
+        else:
+            line_numbers.insert(i, line_number)
+            self.row_ids.insert(i, row)
+
+    def __delitem__(self, line_number):
+        i = self._find(line_number)
+        if i < 0:
+            raise KeyError(line_number)
+        del self.line_numbers[i]
+        del self.row_ids[i]
+
+    def __contains__(self, line_number):
+        return isinstance(line_number, int) and self._find(line_number) >= 0
+
+    def __iter__(self):
+        return iter(self.line_numbers)
+
+    def __len__(self):
+        return len(self.line_numbers)
+
+    def items(self):
+        return RowItems(self)
+
+    def values(self):
+        return RowValues(self)
+
+    def clear(self):
+        self.line_numbers, self.row_ids = array('i'), array('i')
+
+    def remap(self, rows):
+        """Replace every row by rows[row]"""
+        self.row_ids = array('i', [rows[row] for row in self.row_ids])
+
+class RowItems(ItemsView):
+    def __iter__(self):
+        return zip(self._mapping.line_numbers, self._mapping.row_ids)
+
+class RowValues(ValuesView):
+    def __iter__(self):
+        return iter(self._mapping.row_ids)
+
+class BlameRanges(MutableMapping):
+    """Line number -> LineBlame mapping of a blame page, stored as sorted ranges of lines.
+
+    Consecutive lines of equal hunks share one (start, end, hunk) range,
+    kept in columns and looked up by bisecting the starts, so a page takes
+    memory per hunk instead of per line. Lines are mostly added in
+    ascending order, which only extends or appends the last range.
+    Iterates in line order.
+    """
+
+    def __init__(self, items=None):
+        self.starts, self.ends, self.hunks = array('i'), array('i'), []
+        self.count = 0
+        # Range of the last lookup, lookups of nearby lines mostly hit it again
+        self._last = 0
+        if items != None:
+            self.update(items)
+
+    def _find(self, line_number):
+        """Index of the range containing line_number, -1 if there is none"""
+        last = self._last
+        if last < len(self.starts) and self.starts[last] <= line_number <= self.ends[last]:
+            return last
+        i = bisect.bisect_right(self.starts, line_number) - 1
+        if i >= 0 and self.ends[i] >= line_number:
+            self._last = i
+            return i
+        return -1
+
+    def _insert(self, i, start, end, hunk):
+        self.starts.insert(i, start)
+        self.ends.insert(i, end)
+        self.hunks.insert(i, hunk)
+
+    def _remove(self, i):
+        del self.starts[i]
+        del self.ends[i]
+        del self.hunks[i]
+
+    def _merge(self, i):
+        """Merge range i with equal adjacent ranges"""
+        starts, ends, hunks = self.starts, self.ends, self.hunks
+        if i + 1 < len(starts) and ends[i] + 1 == starts[i + 1] and hunks[i] == hunks[i + 1]:
+            ends[i] = ends[i + 1]
+            self._remove(i + 1)
+        if i > 0 and ends[i - 1] + 1 == starts[i] and hunks[i - 1] == hunks[i]:
+            ends[i - 1] = ends[i]
+            self._remove(i)
+
+    def __getitem__(self, line_number):
+        i = self._find(line_number)
+        if i < 0:
+            raise KeyError(line_number)
+        return self.hunks[i]
+
+    def get(self, line_number, default=None):
+        # The lookup of blame_line, so _find is inlined
+        last = self._last
+        starts, ends = self.starts, self.ends
+        if last < len(starts) and starts[last] <= line_number <= ends[last]:
+            return self.hunks[last]
+        i = bisect.bisect_right(starts, line_number) - 1
+        if i >= 0 and ends[i] >= line_number:
+            self._last = i
+            return self.hunks[i]
+        return default
+
+    def __setitem__(self, line_number, blame):
+        ends, hunks = self.ends, self.hunks
+        if not ends or line_number > ends[-1]:
+            if ends and line_number == ends[-1] + 1 and (hunks[-1] is blame or hunks[-1] == blame):
+                ends[-1] = line_number
+            else:
+                self.starts.append(line_number)
+                ends.append(line_number)
+                hunks.append(blame)
+            self.count += 1
+            return
+
+        i = self._find(line_number)
+        if i >= 0:
+            if hunks[i] == blame:
+                return
+            del self[line_number]
+        i = bisect.bisect_right(self.starts, line_number)
+        self._insert(i, line_number, line_number, blame)
+        self.count += 1
+        self._merge(i)
+
+    def __delitem__(self, line_number):
+        i = self._find(line_number)
+        if i < 0:
+            raise KeyError(line_number)
+        start, end = self.starts[i], self.ends[i]
+        if start == end:
+            self._remove(i)
+        elif line_number == start:
+            self.starts[i] += 1
+        elif line_number == end:
+            self.ends[i] -= 1
+        else:
+            self.ends[i] = line_number - 1
+            self._insert(i + 1, line_number + 1, end, self.hunks[i])
+        self.count -= 1
+
+    def __contains__(self, line_number):
+        return isinstance(line_number, int) and self._find(line_number) >= 0
+
+    def __iter__(self):
+        for start, end in zip(self.starts, self.ends):
+            yield from range(start, end + 1)
+
+    def __len__(self):
+        return self.count
+
+    def items(self):
+        return BlameItems(self)
+
+    def values(self):
+        return BlameValues(self)
+
+    def clear(self):
+        self.starts, self.ends, self.hunks = array('i'), array('i'), []
+        self.count = 0
+
+    def ranges(self):
+        """(start, end, hunk) of every range, in line order"""
+        return list(zip(self.starts, self.ends, self.hunks))
+
+    def span(self, start, end):
+        """(start, end, hunk) ranges of the lines from start to end, cut to them"""
+        i = max(0, bisect.bisect_right(self.starts, start) - 1)
+        ranges = []
+        while i < len(self.starts) and self.starts[i] <= end:
+            if self.ends[i] >= start:
+                ranges.append((max(start, self.starts[i]), min(end, self.ends[i]), self.hunks[i]))
+            i += 1
+        return ranges
+
+class BlameItems(ItemsView):
+    def __iter__(self):
+        for start, end, hunk in self._mapping.ranges():
+            for line_number in range(start, end + 1):
+                yield line_number, hunk
+
+class BlameValues(ValuesView):
+    def __iter__(self):
+        for start, end, hunk in self._mapping.ranges():
+            for line_number in range(start, end + 1):
+                yield hunk
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+
+import sys
+import bisect
+import logging
+import operator
+import threading
+from array import array
+from collections import OrderedDict
+
+from models import LineBlame, BlameRanges
+from scoring import DEFAULT_WEIGHTS
+
+module = sys.modules['__main__'].__file__
+log = logging.getLogger(module)
+
+def blame_ranges(blame_data):
+    """Sorted (start, end, LineBlame) runs of consecutive lines blamed on the same hunk"""
+    if isinstance(blame_data, BlameRanges):
+        return blame_data.ranges()
+    ranges = []
+    for line_number, blame in sorted(blame_data.items()):
+        if ranges and ranges[-1][1] == line_number - 1 and ranges[-1][2] == blame:
+            ranges[-1][1] = line_number
+        else:
+            ranges.append([line_number, line_number, blame])
+    return [tuple(r) for r in ranges]
+
+class FileOwnership:
+    """Blame of one file as non-overlapping line ranges, sorted by their first line.
+
+    The ranges are kept in columns, lookups bisect the first lines. Lines
+    per hunk are summed up front, so the owners of a file do not depend on
+    its number of ranges.
+    """
+
+    def __init__(self, revision=None, ranges=()):
+        self.revision = revision
+        self.set_ranges(ranges)
+
+    def set_ranges(self, ranges):
+        self.starts, self.ends, self.hunks = array('i'), array('i'), []
+        self.lines = {}
+        for start, end, blame in ranges:
+            self.starts.append(start)
+            self.ends.append(end)
+            self.hunks.append(blame)
+            self.lines[blame] = self.lines.get(blame, 0) + end - start + 1
+        # Newest commit time of any line, a page of a later revision has no older one
+        self.newest = max([blame.timestamp or 0 for blame in self.hunks] or [0])
+
+    def ranges(self):
+        return list(zip(self.starts, self.ends, self.hunks))
+
+    def line_count(self):
+        return self.ends[-1] if self.ends else 0
+
+    def blame_line(self, line_number):
+        i = bisect.bisect_right(self.starts, line_number) - 1
+        if i >= 0 and self.ends[i] >= line_number:
+            return self.hunks[i]
+        return None
+
+    def to_dict(self):
+        hunks, hunk_index = [], {}
+        ranges = []
+        for start, end, blame in self.ranges():
+            if not blame in hunk_index:
+                hunk_index[blame] = len(hunks)
+                hunks.append(list(blame))
+            ranges.append([start, end, hunk_index[blame]])
+        return {'revision': self.revision, 'hunks': hunks, 'ranges': ranges}
+
+    @classmethod
+    def from_dict(cls, stored):
+        hunks = [LineBlame.from_fields(hunk) for hunk in stored['hunks']]
+        return cls(stored['revision'], [(start, end, hunks[hunk]) for start, end, hunk in stored['ranges']])
+
+class OwnershipIndex:
+    """Who wrote which lines of a repository, as of the latest blame seen of every file.
+
+    Built up from complete blame pages of the revisions PRs are based on,
+    see Marvin._index_blame. A page of a file replaces the one of an older
+    revision, but not of a newer one, judged by their newest commits. With a
+    store, a BlameCache, every file is kept as one entry next to a list of
+    the indexed files, and save() only writes the files changed since.
+    """
+
+    def __init__(self, project_link, store=None):
+        self.project_link = project_link
+        self.store = store
+        self._lock = threading.RLock()
+        self.files = {}
+        # Indexed paths, sorted, so the files of a directory are a slice
+        self.paths = []
+        self.dirty = set([])
+        if store != None:
+            for file in store.get(project_link, '', '') or []:
+                stored = store.get(project_link, '', file)
+                if stored != None:
+                    self.files[file] = FileOwnership.from_dict(stored)
+                    self.paths.append(file)
+            self.paths.sort()
+
+    def update(self, file, revision, blame_data):
+        """Index the complete blame of file at revision, returns whether the index changed"""
+        ranges = blame_ranges(blame_data)
+        if not ranges:
+            return False
+
+        with self._lock:
+            ownership = self.files.get(file)
+            if ownership == None:
+                self.files[file] = FileOwnership(revision, ranges)
+                bisect.insort(self.paths, file)
+            elif ownership.revision == revision:
+                # The blame of a revision never changes
+                return False
+            else:
+                replacement = FileOwnership(revision, ranges)
+                if replacement.newest < ownership.newest:
+                    log.debug("Not indexing {} at {}, {} is newer".format(file, revision, ownership.revision))
+                    return False
+                self.files[file] = replacement
+            self.dirty.add(file)
+            return True
+
+    def blame_line(self, file, line_number):
+        ownership = self.files.get(file)
+        return ownership.blame_line(line_number) if ownership != None else None
+
+    def line_count(self, file):
+        ownership = self.files.get(file)
+        return ownership.line_count() if ownership != None else 0
+
+    def blamer(self, file):
+        return IndexedBlame(self, file)
+
+    def files_in(self, directory=''):
+        """Indexed paths below directory, all of them for ''"""
+        directory = directory.strip('/')
+        with self._lock:
+            if directory in self.files:
+                return [directory]
+            if directory in ('', '.'):
+                return list(self.paths)
+            # Paths starting with directory/ sort before directory0, as '0' follows '/'
+            start = bisect.bisect_left(self.paths, directory + '/')
+            return self.paths[start:bisect.bisect_left(self.paths, directory + '0')]
+
+    def owners(self, directory='', weights=DEFAULT_WEIGHTS):
+        """Weight of every author of the lines below directory, or of a single file, largest first.
+
+        Every line counts with the weight of its file class and, with a
+        half-life, the age of its commit.
+        """
+        owners = {}
+        with self._lock:
+            for file in self.files_in(directory):
+                file_weight = weights.file_weight(file)
+                lines = self.files[file].lines
+                hunks = list(lines)
+                for blame, recency in zip(hunks, weights.recency_array(hunks)):
+                    owners[blame.user_name] = owners.get(blame.user_name, 0) + lines[blame] * file_weight * recency
+        return OrderedDict((name, float(weight))
+            for name, weight in sorted(owners.items(), key=operator.itemgetter(1), reverse=True))
+
+    def save(self):
+        if self.store == None:
+            return
+        with self._lock:
+            for file in sorted(self.dirty):
+                self.store.put(self.project_link, '', file, self.files[file].to_dict())
+            if self.dirty:
+                self.store.put(self.project_link, '', '', self.paths)
+            self.dirty = set([])
+
+class OwnershipIndexes:
+    """The OwnershipIndex of every project, loaded from store when it is first asked for"""
+
+    def __init__(self, store=None):
+        self.store = store
+        self._lock = threading.Lock()
+        self.indexes = {}
+
+    def index(self, project_link):
+        with self._lock:
+            if not project_link in self.indexes:
+                self.indexes[project_link] = OwnershipIndex(project_link, self.store)
+            return self.indexes[project_link]
+
+class IndexedBlame:
+    """Stand-in for the blame page of a file, answering from an OwnershipIndex.
+
+    The lines may have moved since the indexed revision and their text is
+    not known, so no interesting lines are found. Nothing is taken as the
+    blame of a specific commit, so blame_data stays empty.
+    """
+
+    def __init__(self, index, file):
+        self.index = index
+        self.file = file
+        self.blame_data = {}
+        self.file_data = {}
+        self.line_count = index.line_count(file)
+
+    def blame_line(self, line):
+        return self.index.blame_line(self.file, line)
+
+    def line_text(self, line_number):
+        return ''
+
+    def find_interesting(self, start, stop, step=1):
+        return None
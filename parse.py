@@ -4,213 +4,315 @@ import argparse
 import sys
 import re
 import logging
+from collections import OrderedDict
 
-from models import LineChange
+from models import LineChange, ChangeSet, ChangeIndex
+from stats import NULL_STATS
 
 module = sys.modules['__main__'].__file__
 log = logging.getLogger(module)
 
+HUNK_RE = re.compile(r'^@@ -([0-9]+),([0-9]+) \+([0-9]+),([0-9]+) @@.*$')
+FILENAME_RE = re.compile(r'^diff --git a/(.*?) b/(.*?)$')
+LONG_COMMIT_RE = re.compile(r'^From ([a-f,0-9]{40}) [A-Z][a-z]{2} [A-Z][a-z]{2} [0-9]{2} [0-9]{2}:[0-9]{2}:[0-9]{2} [0-9]{4}$')
+
+ADDED = LineChange.ChangeType.added.value
+DELETED = LineChange.ChangeType.deleted.value
+MODIFIED = LineChange.ChangeType.modified.value
+
+# First characters of the lines that start a hunk, a file or a commit.
+# No other line needs to be matched against a regex.
+HEADER_CHARS = frozenset('@dF')
+
+class Hunk:
+    """Line counters of the hunk currently being parsed"""
+
+    def __init__(self, match):
+        self.before_line_n = int(match.group(1))
+        self.before_offset = int(match.group(2))
+        self.after_line_n = int(match.group(3))
+        self.after_offset = int(match.group(4))
+
+        self.before_finish_line_n = self.before_line_n + self.before_offset
+        self.after_finish_line_n = self.after_line_n + self.after_offset
+
+        self.removed_in_new_file = {}
+
 class DiffParser:
+    """Single pass parser of (multi-commit) git diffs.
 
-    def __init__(self, filename=None, diff_content=None):
+    Every line is routed by its first character, so only header lines are
+    matched against the precompiled regexes. Lines are consumed from any
+    iterator, so a diff never needs to be held in memory as a whole.
+    """
+
+    def __init__(self, filename=None, diff_content=None, replay=None, stats=None):
+        self.stats = stats if stats != None else NULL_STATS
         if filename != None:
             self.load_file(filename)
         elif diff_content != None:
             self.load_diff_content(diff_content)
 
+        # All changed lines are rows of change_set, changes maps every file
+        # to (added, removed, modified) indexes of line number -> row
+        self.change_set = ChangeSet()
         self.changes = {}
         self.added_files = set([])
         self.removed_files = set([])
 
-    def eof(self):
-        return self.line_idx >= len(self.lines)
+        self.current_file = None
+        self.current_commit = None
+        self.hunk = None
+        # Line number -> row of the file section currently being parsed
+        self.added, self.removed, self.modified = {}, {}, {}
+        # File sections completed, but not yet handed out by iter_file_changes
+        self.finished = []
+        self.store = True
+
+        # Incremental parsing: replay(commit_sha) returns the sections of a
+        # commit parsed before, as (file, added, removed, modified) with lists
+        # of (line number, author) each, or None if the commit is new
+        self.replay = replay
+        self.skipping = False
+        # (commit_sha, file, (added, removed, modified) line numbers) of
+        # every section that has actually been parsed, if replay is used
+        self.sections = []
+        self.replayed = set([])
+        # Commits in the order of the series -> files they touch
+        self.commits = OrderedDict()
 
     def load_diff_content(self, content):
+        # Any iterable of lines: a list, a file object or a streamed response
         self.lines = content
-        self.line_idx = 0
 
     def load_file(self, filename):
+        self.lines = self._read_file(filename)
+
+    def _read_file(self, filename):
         log.debug("Parsing {}".format(filename))
 
         with open(filename) as f:
-            self.lines = f.readlines()
-            self.line_idx = 0
-
-    def parse_short_commit_hash(self):
-        diff_commits_re = re.compile('^index ([a-f,0-9]{7})\.\.([a-f,0-9]{7}).*$')
-        new_file_re = re.compile('^new file mode [0-9]{6}$')
-        delete_file_re = re.compile('^deleted file mode [0-9]{6}$')
-
-        line = self.lines[self.line_idx]
-
-        if new_file_re.match(line) != None:
-            self.added_files.add(self.current_file)
-
-        elif delete_file_re.match(line) != None:
-            self.removed_files.add(self.current_file)
-
-        if new_file_re.match(line) != None or delete_file_re.match(line) != None:
-            self.line_idx += 1
-            line = self.lines[self.line_idx]
-
-        commits_match = diff_commits_re.match(line)
-        if commits_match != None:
-            pass
-        #    self.from_commit = commits_match.group(1)
-        #    self.to_commit  = commits_match.group(2)
-        else:
-            log.error("Something went wrong when parsing commit!")
-
-    def parse_next_commit(self, added, removed, modified):
-        if self.eof():
-            return None
-
-        commit_re = re.compile('^@@ -([0-9]+),([0-9]+) \+([0-9]+),([0-9]+) @@.*$')
-        filename_re = re.compile('^diff --git a/(.*?) b/(.*?)$')
-        long_re = re.compile('^From ([a-f,0-9]{40}) [A-Z][a-z]{2} [A-Z][a-z]{2} [0-9]{2} [0-9]{2}:[0-9]{2}:[0-9]{2} [0-9]{4}$')
-    
-        match = None
-
-        while not self.eof() and match == None:
-            if filename_re.match(self.lines[self.line_idx]) != None:
-                break
-
-            match = commit_re.match(self.lines[self.line_idx])
-            self.line_idx += 1
-
-        if match == None:
-            return None
-
-        before_line_n = int(match.group(1))
-        before_offset = int(match.group(2))
-        after_line_n = int(match.group(3))
-        after_offset = int(match.group(4))
-
-        before_finish_line_n = before_line_n + before_offset
-        after_finish_line_n = after_line_n + after_offset
-        
-        removed_in_new_file = {}
-
-        while not self.eof():
-            line = self.lines[self.line_idx]
-
-            match = commit_re.match(line)
+            for line in f:
+                yield line
+
+    def parse_line(self, line):
+        first = line[:1]
+        hunk = self.hunk
+
+        if self.skipping and first != 'F':
+            # Inside a commit that has been replayed
+            return
+
+        if hunk != None:
+            if first == '+':
+                self.parse_added_line(hunk)
+                return
+            if first == '-':
+                self.parse_removed_line(hunk)
+                return
+            if not first in HEADER_CHARS:
+                hunk.before_line_n += 1
+                hunk.after_line_n += 1
+                return
+        elif not first in HEADER_CHARS:
+            # Commit message, index and ---/+++ lines
+            return
+
+        if first == '@':
+            match = HUNK_RE.match(line)
             if match != None:
-                break
-            match = filename_re.match(line)
+                self.end_hunk()
+                if self.current_file != None:
+                    self.hunk = Hunk(match)
+                return
+        elif first == 'd':
+            match = FILENAME_RE.match(line)
             if match != None:
-                break
-            match = long_re.match(line)
+                self.end_file()
+                self.start_file(match.group(2))
+                return
+        elif first == 'F':
+            match = LONG_COMMIT_RE.match(line)
             if match != None:
-                # Remove empty line which is insert for spacing
-                after_line_n -= 1
-                before_line_n -= 1
-                break
-
-            if line.startswith("+"):
-                if after_line_n in removed_in_new_file and len(removed_in_new_file[after_line_n]) > 0:
-                    del removed[removed_in_new_file[after_line_n].pop()]
-                    modified[after_line_n] = LineChange(after_line_n, LineChange.ChangeType.modified, self.current_file, self.current_commit)
-                else:
-                    added[after_line_n] = LineChange(after_line_n, LineChange.ChangeType.added, self.current_file, self.current_commit)
-                
-                after_line_n += 1
-
-            elif line.startswith("-"):
-                if after_line_n in added:
-                    del added[after_line_n]
-                    modified[after_line_n] = LineChange(after_line_n, LineChange.ChangeType.modified, self.current_file, self.current_commit)
-                else:
-                    commit_hash = self.current_commit + "~1" if self.current_commit != None else None
-                    removed[before_line_n] = LineChange(before_line_n, LineChange.ChangeType.deleted, self.current_file, commit_hash)
-                    if not after_line_n in removed_in_new_file:
-                        removed_in_new_file[after_line_n] = []
-                    removed_in_new_file[after_line_n].append(before_line_n)
-
-                before_line_n += 1
-
-            else:
-                before_line_n += 1
-                after_line_n += 1
-
-            self.line_idx += 1
-
-        # Does not work when multiple commits change the same lines
-        if not (after_finish_line_n == after_line_n and before_finish_line_n == before_line_n) \
-            and not self.current_file in self.removed_files and not self.current_file in self.added_files:
-            log.warning("Something went wrong with parsing commits in {} {} S {} {} B {} v {} A {} v {}".format(
-                self.current_file, self.current_commit, before_finish_line_n - before_offset, after_finish_line_n - after_offset, before_finish_line_n, before_line_n, after_finish_line_n, after_line_n))
-
-    def parse_next_file_changes(self):
-        if self.eof():
-            return None
-
-        filename_re = re.compile('^diff --git a/(.*?) b/(.*?)$')
-        long_re = re.compile('^From ([a-f,0-9]{40}) [A-Z][a-z]{2} [A-Z][a-z]{2} [0-9]{2} [0-9]{2}:[0-9]{2}:[0-9]{2} [0-9]{4}$')
-        self.current_file = None
-        self.current_commit = None
-        #   self.to_commit = None
-        #   self.from_commit = None
-
-        match = None
-
-        while not self.eof() and match == None:
-            if long_re.match(self.lines[self.line_idx]) != None:
-                self.current_commit = long_re.match(self.lines[self.line_idx]).group(1)
-            else:
-                match = filename_re.match(self.lines[self.line_idx])
-            self.line_idx += 1
-
-        if match == None:
-            return None
-
-        self.current_file = match.group(2)
+                if hunk != None:
+                    # Remove empty line which is insert for spacing
+                    hunk.after_line_n -= 1
+                    hunk.before_line_n -= 1
+                self.end_file()
+                self.current_commit = match.group(1)
+                self.skipping = False
+                if self.replay != None:
+                    sections = self.replay(self.current_commit)
+                    if sections != None:
+                        self.replay_commit(sections)
+                return
+
+        # Not a header after all
+        if hunk != None:
+            hunk.before_line_n += 1
+            hunk.after_line_n += 1
+
+    def start_file(self, file):
+        self.current_file = file
         log.debug("Current file set to {} ".format(self.current_file))
-        added, removed, modified = {}, {}, {}
+        self.commits.setdefault(self.current_commit, []).append(file)
+
+        # Interned once per section instead of once per line
+        self.file_id = self.change_set.file_id(file)
+        self.commit_id = self.change_set.commit_id(self.current_commit)
+        self.parent_commit_id = self.change_set.commit_id(
+            self.current_commit + "~1" if self.current_commit != None else None)
+
+    def replay_commit(self, sections):
+        """Take the sections of the current commit from an earlier run, skipping its lines"""
+        log.debug("Replaying commit {}".format(self.current_commit))
+        self.stats.count('diff_commits_replayed')
+        self.replayed.add(self.current_commit)
+        self.skipping = True
+
+        for file, added, removed, modified in sections:
+            self.start_file(file)
+            for changes, lines, change_type, commit_id in [(self.added, added, ADDED, self.commit_id),
+                    (self.removed, removed, DELETED, self.parent_commit_id),
+                    (self.modified, modified, MODIFIED, self.commit_id)]:
+                for line_n, author in lines:
+                    changes[line_n] = self.change_set.append_row(line_n, change_type, self.file_id, commit_id)
+                    if author != None:
+                        self.change_set.set_author(changes[line_n], author)
+            self.end_file()
+
+    def record(self, changes, line_n, change_type, commit_id, reuse_row=None):
+        old = changes.get(line_n)
+        if old != None:
+            self.change_set.discard(old)
+        if reuse_row != None:
+            # A change turned into another one, overwrite its row in place
+            self.change_set.set_row(reuse_row, line_n, change_type, self.file_id, commit_id)
+            changes[line_n] = reuse_row
+        else:
+            changes[line_n] = self.change_set.append_row(line_n, change_type, self.file_id, commit_id)
 
-        # self.parse_short_commit_hash()
-        # if self.to_commit == None or self.from_commit == None:
-        #    log.error("Failure loading commits for {} from '{}'".format(self.current_file, self.lines[self.line_idx]))
-        #    return None
+    def parse_added_line(self, hunk):
+        after_line_n = hunk.after_line_n
+        removed_at = hunk.removed_in_new_file.get(after_line_n)
+        if removed_at:
+            self.record(self.modified, after_line_n, MODIFIED, self.commit_id, self.removed.pop(removed_at.pop()))
+        else:
+            self.record(self.added, after_line_n, ADDED, self.commit_id)
 
-        self.line_idx += 1
+        hunk.after_line_n += 1
 
-        while not self.eof():
-            match = filename_re.match(self.lines[self.line_idx])
-            if match != None:
-                break
+    def parse_removed_line(self, hunk):
+        after_line_n = hunk.after_line_n
+        if after_line_n in self.added:
+            self.record(self.modified, after_line_n, MODIFIED, self.commit_id, self.added.pop(after_line_n))
+        else:
+            self.record(self.removed, hunk.before_line_n, DELETED, self.parent_commit_id)
+            if not after_line_n in hunk.removed_in_new_file:
+                hunk.removed_in_new_file[after_line_n] = []
+            hunk.removed_in_new_file[after_line_n].append(hunk.before_line_n)
 
-            if long_re.match(self.lines[self.line_idx]) != None:
-                self.current_commit = None
-                break
+        hunk.before_line_n += 1
 
-            self.parse_next_commit(added, removed, modified)
+    def end_hunk(self):
+        hunk = self.hunk
+        if hunk == None:
+            return
+        self.hunk = None
 
-        if not self.current_file in self.changes:
-            self.changes[self.current_file] = added, removed, modified
+        # Does not work when multiple commits change the same lines
+        if not (hunk.after_finish_line_n == hunk.after_line_n and hunk.before_finish_line_n == hunk.before_line_n) \
+            and not self.current_file in self.removed_files and not self.current_file in self.added_files:
+            log.warning("Something went wrong with parsing commits in {} {} S {} {} B {} v {} A {} v {}".format(
+                self.current_file, self.current_commit, hunk.before_finish_line_n - hunk.before_offset,
+                hunk.after_finish_line_n - hunk.after_offset, hunk.before_finish_line_n, hunk.before_line_n,
+                hunk.after_finish_line_n, hunk.after_line_n))
+
+    def end_file(self):
+        self.end_hunk()
+        if self.current_file == None:
+            return
+
+        sections = self.added, self.removed, self.modified
+        self.stats.count('diff_sections')
+        if self.replay != None and not self.skipping:
+            self.sections.append((self.current_commit, self.current_file, tuple(list(section) for section in sections)))
+        self.finished.append((self.current_file, self.change_set,
+            [row for section in sections for row in section.values()]))
+
+        if not self.store:
+            # Nothing refers to the rows anymore, once the section is handed out
+            self.change_set = ChangeSet()
+        elif not self.current_file in self.changes:
+            self.changes[self.current_file] = tuple(ChangeIndex(self.change_set, section) for section in sections)
         else:
             # TODO maybe check for errors
-            self.changes[self.current_file][0].update(added)
-            self.changes[self.current_file][1].update(removed)
-            self.changes[self.current_file][2].update(modified)
+            for i in range(3):
+                self.changes[self.current_file][i].update_rows(sections[i])
 
         self.current_file = None
-        
-        return True
+        self.added, self.removed, self.modified = {}, {}, {}
 
-    def get_all_changes(self):
-        changes = []
-        for file in self.changes:        
-            changes += list(self.changes[file][0].values()) + \
-                        list(self.changes[file][1].values()) + \
-                        list(self.changes[file][2].values())
-
-        return changes
+    def compact(self):
+        self.change_set.compact([index for file in self.changes for index in self.changes[file]])
 
+    def get_all_changes(self):
+        view = self.change_set.view
+        return [view(row) for file in self.changes for i in range(3) for row in self.changes[file][i].rows.values()]
+
+    def iter_file_changes(self, store=True):
+        """Parse lazily, yielding (file, changes) as soon as a file section ends.
+
+        With store=False the sections are not collected in self.changes,
+        so arbitrarily long patch series are parsed in constant memory.
+        """
+        for file, change_set, rows in self.iter_file_rows(store):
+            yield file, [change_set.view(row) for row in rows]
+
+    def iter_file_rows(self, store=True):
+        """Like iter_file_changes, yielding (file, change_set, rows) without building views"""
+        self.store = store
+        finished = self.finished
+        parse_line = self.parse_line
+        parse_added_line = self.parse_added_line
+        parse_removed_line = self.parse_removed_line
+
+        # Hot loop: hunk bodies are handled without going through parse_line
+        for line in self.stats.counted('diff_lines', self.lines):
+            hunk = self.hunk
+            if hunk != None:
+                first = line[:1]
+                if first == '+':
+                    parse_added_line(hunk)
+                    continue
+                elif first == '-':
+                    if hunk.before_line_n == hunk.before_finish_line_n and line[:3] == '-- ':
+                        # Signature git format-patch writes after the last hunk of a commit
+                        self.end_file()
+                        continue
+                    parse_removed_line(hunk)
+                    continue
+                elif first == ' ':
+                    hunk.before_line_n += 1
+                    hunk.after_line_n += 1
+                    continue
+
+            # Only header lines can end a file section
+            parse_line(line)
+            if finished:
+                for section in finished:
+                    yield section
+                del finished[:]
+
+        self.end_file()
+        for section in finished:
+            yield section
+        del finished[:]
 
     def parse(self):
-        while not self.eof() and self.parse_next_file_changes():
+        for section in self.iter_file_rows():
             pass
+        self.compact()
 
         return self.get_all_changes()
 
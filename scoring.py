@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import heapq
+import logging
+import operator
+from collections import OrderedDict
+
+import numpy as np
+
+from models import LineChange
+
+module = sys.modules['__main__'].__file__
+log = logging.getLogger(module)
+
+ChangeType = LineChange.ChangeType
+
+DEFAULT_CHANGE_WEIGHTS = {
+    ChangeType.added: 1,
+    ChangeType.deleted: 2,
+    ChangeType.modified: 3,
+    ChangeType.interesting: 1,
+}
+
+# Files of any other extension are 'code'
+DEFAULT_EXTENSION_CLASSES = dict((extension, 'text') for extension in ['.conf', '.txt', '.md', '.cfg'])
+DEFAULT_CLASS_WEIGHTS = {'code': 1, 'text': 1 / 3}
+
+DAY = 24 * 60 * 60
+
+class WeightTable:
+    """Relevance of a changed line by its kind of change and the class of its file extension.
+
+    The relevance of a line is the product of both weights. Marvin takes
+    another table to change how reviewers are ranked.
+
+    With a half_life in days, the relevance of a line also halves with every
+    half_life its blamed commit is older than `now`, the time of scoring by
+    default. Lines without a commit time are not weighted by age.
+    """
+
+    def __init__(self, change_weights=None, extension_classes=None, class_weights=None, half_life=None, now=None):
+        self.change_weights = dict(DEFAULT_CHANGE_WEIGHTS)
+        self.change_weights.update(change_weights or {})
+        self.extension_classes = extension_classes if extension_classes != None else DEFAULT_EXTENSION_CLASSES
+        self.class_weights = dict(DEFAULT_CLASS_WEIGHTS)
+        self.class_weights.update(class_weights or {})
+        self.half_life = half_life
+        self.now = now
+
+    @classmethod
+    def from_dict(cls, table):
+        """Table of a JSON object like {"changes": {"deleted": 2}, "extensions": {".md": "text"}, "classes": {"text": 0.5},
+        "half_life": 365}"""
+        return cls(change_weights=dict((ChangeType[name], weight) for name, weight in table.get('changes', {}).items()),
+            extension_classes=table.get('extensions'), class_weights=table.get('classes'),
+            half_life=table.get('half_life'))
+
+    def file_class(self, path):
+        return self.extension_classes.get(os.path.splitext(path)[1], 'code')
+
+    def file_weight(self, path):
+        return self.class_weights[self.file_class(path)]
+
+    def relevance(self, change):
+        relevance = self.change_weights[change.change_type] * self.file_weight(change.file_path)
+        if self.half_life != None and change.author != None:
+            relevance *= self.recency_array([change.author])[0]
+        return relevance
+
+    def recency_array(self, authors, now=None):
+        """Age factor of every LineBlame of authors, 1 without a half_life"""
+        if self.half_life == None:
+            return np.ones(len(authors))
+        now = now or self.now or time.time()
+        timestamps = np.array([author.timestamp if author.timestamp != None else now for author in authors], dtype=float)
+        return 0.5 ** (np.maximum(now - timestamps, 0) / (self.half_life * DAY))
+
+    def change_type_array(self):
+        """Weights indexed by ChangeType value"""
+        weights = np.zeros(max(t.value for t in ChangeType) + 1)
+        for change_type, weight in self.change_weights.items():
+            weights[change_type.value] = weight
+        return weights
+
+DEFAULT_WEIGHTS = WeightTable()
+
+def live_columns(change_set, blamed_only=False):
+    """(change types, file ids, author ids) of the live rows of change_set as arrays.
+
+    None if a row is not blamed, unless blamed_only, which leaves such rows out.
+    """
+    n = len(change_set.line_numbers)
+    author_ids = np.full(n, -1, dtype=np.intc)
+    if len(change_set.author_ids) > 0:
+        author_ids[:len(change_set.author_ids)] = np.frombuffer(change_set.author_ids, dtype=np.intc)
+
+    columns = [np.frombuffer(change_set.change_types, dtype=np.int8, count=n),
+        np.frombuffer(change_set.file_ids, dtype=np.intc, count=n), author_ids]
+    if change_set.dead:
+        live = np.ones(n, dtype=bool)
+        live[list(change_set.dead)] = False
+        columns = [column[live] for column in columns]
+    if blamed_only:
+        blamed = columns[2] >= 0
+        columns = [column[blamed] for column in columns]
+    elif (columns[2] < 0).any():
+        return None
+    return columns
+
+def score(change_sets, weights=DEFAULT_WEIGHTS, blamed_only=False):
+    """Summed relevance of the changed lines per author user name, None if a line is not blamed.
+
+    Works on the columns of the change sets as a whole: the relevance of
+    every row is looked up from per-type, per-file and, with a half-life,
+    per-hunk weights, and summed per user with a single bincount.
+    """
+    type_weights = weights.change_type_array()
+    now = weights.now or time.time()
+    users = OrderedDict()
+    relevances, user_ids = [], []
+    for change_set in change_sets:
+        if len(change_set) == 0:
+            continue
+        columns = live_columns(change_set, blamed_only)
+        if columns == None:
+            return None
+        change_types, file_ids, author_ids = columns
+
+        file_weights = np.array([weights.file_weight(file) for file in change_set.files])
+        author_users = np.array([users.setdefault(author.user_name, len(users)) for author in change_set.authors],
+            dtype=np.intc)
+        relevance = type_weights[change_types] * file_weights[file_ids]
+        if weights.half_life != None:
+            relevance *= weights.recency_array(change_set.authors, now)[author_ids]
+        relevances.append(relevance)
+        user_ids.append(author_users[author_ids])
+
+    if not users:
+        return OrderedDict()
+    user_ids = np.concatenate(user_ids)
+    sums = np.bincount(user_ids, weights=np.concatenate(relevances), minlength=len(users))
+    present = np.bincount(user_ids, minlength=len(users)) > 0
+    return OrderedDict((name, float(sums[i])) for name, i in users.items() if present[i])
+
+def highest_scores(scores, k):
+    """The k highest (name, score) items of scores, highest first"""
+    return heapq.nlargest(k, scores.items(), key=operator.itemgetter(1))
+
+class RunningScores:
+    """Scores of the pairs blamed so far, and a bound of what the pairs not blamed yet can add.
+
+    Interesting lines are kept by file and line number, the one found for
+    the changed line latest in the diff wins, as in
+    Marvin.load_additional_lines. Until every pair of its file is blamed,
+    such a line may still be taken over, so it does not count towards the
+    lower bound of its author.
+    """
+
+    def __init__(self, weights=DEFAULT_WEIGHTS):
+        self.weights = weights
+        self.scores = {}
+        # User -> relevance of their interesting lines that may be taken over
+        self.at_risk = {}
+        # (file, line number) -> (position of the changed line, user, relevance)
+        self.interesting = {}
+        self.lines_of_file = {}
+        # File -> number of pairs not blamed yet
+        self.unfinished = {}
+        self.pairs = 0
+        self.remaining = 0.0
+
+    def upper_bound(self, change):
+        """Most a changed line and the two interesting lines around it can add, age can only lower it"""
+        weights = self.weights
+        return (weights.change_weights[change.change_type] + 2 * weights.change_weights[ChangeType.interesting]) \
+            * weights.file_weight(change.file_path)
+
+    def expect(self, file, bound):
+        """Count a pair of file that is not blamed yet, adding at most bound"""
+        self.unfinished[file] = self.unfinished.get(file, 0) + 1
+        self.pairs += 1
+        self.remaining += bound
+
+    def finish(self, file, bound):
+        self.unfinished[file] -= 1
+        self.pairs -= 1
+        self.remaining -= bound
+        if self.unfinished[file] == 0:
+            for line_number in self.lines_of_file.get(file, ()):
+                position, user, relevance = self.interesting[(file, line_number)]
+                self.at_risk[user] -= relevance
+
+    def bound(self):
+        return self.remaining if self.pairs > 0 else 0.0
+
+    def _add(self, user, relevance, file):
+        self.scores[user] = self.scores.get(user, 0) + relevance
+        if self.unfinished.get(file, 0) > 0:
+            self.at_risk[user] = self.at_risk.get(user, 0) + relevance
+
+    def add_change(self, change):
+        if change.author != None:
+            self._add(change.author.user_name, self.weights.relevance(change), None)
+
+    def add_interesting(self, position, line):
+        if line.author == None:
+            return
+        key = (line.file_path, line.line_number)
+        old = self.interesting.get(key)
+        if old != None:
+            if old[0] > position:
+                return
+            self._add(old[1], -old[2], line.file_path)
+        relevance = self.weights.relevance(line)
+        self.interesting[key] = (position, line.author.user_name, relevance)
+        self.lines_of_file.setdefault(line.file_path, set()).add(line.line_number)
+        self._add(line.author.user_name, relevance, line.file_path)
+
+    def settled(self, k):
+        """Whether the k highest scores keep their order, whatever the pairs not blamed yet add"""
+        remaining = self.bound()
+        top = highest_scores(self.scores, k + 1)
+        for i in range(k):
+            if i >= len(top):
+                return remaining == 0
+            user, score = top[i]
+            below = top[i + 1][1] if i + 1 < len(top) else 0
+            if score - self.at_risk.get(user, 0) <= below + remaining:
+                return False
+        return True
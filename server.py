@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+import sys
+import json
+import argparse
+import logging
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import requests
+
+from marvin import Marvin, add_common_arguments, setup_from_arguments, blame_factory_from_arguments, \
+    parse_pool_from_arguments, stats_from_arguments, weights_from_arguments, ownership_from_arguments, \
+    skip_tokens_from_arguments
+from blame import BlameParser
+from git_blame import GitError
+from cache import MemoryCache, DEFAULT_MAX_ENTRIES
+from scoring import DEFAULT_WEIGHTS
+
+module = sys.modules['__main__'].__file__
+log = logging.getLogger(module)
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8080
+# Seconds a downloaded PR diff is reused, PRs change when commits are pushed
+DEFAULT_DIFF_TTL = 60
+
+class BadRequest(Exception):
+    pass
+
+class ReviewerServer(ThreadingHTTPServer):
+    """Recommends reviewers over HTTP, keeping blame pages and diffs in memory between requests.
+
+    POST /reviewers takes a JSON object with project_link and either pr_n or
+    patch, the raw text of a patch. A text/plain body is taken as the patch,
+    with project_link in the query string. The response is a JSON object
+    with the ranked reviewers. GET /status reports cache and HTTP counters,
+    and the stage timings and counters of all requests if stats are given.
+    With ownership indexes, GET /owners?project_link=...&directory=... ranks
+    the authors of the indexed lines below a directory.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, http, cache=None, workers=None, partial_blame=False,
+            max_entries=DEFAULT_MAX_ENTRIES, diff_ttl=DEFAULT_DIFF_TTL, store=None, reuse_parents=True,
+            blame_factory=BlameParser, parse_pool=None, stats=None, weights=None, ownership_indexes=None,
+            skip_tokens=None):
+        super().__init__(address, ReviewerHandler)
+        self.http = http
+        self.blame_cache = MemoryCache(max_entries, backing=cache)
+        self.diff_cache = MemoryCache(max_entries, ttl=diff_ttl)
+        self.stats = stats
+        self.ownership_indexes = ownership_indexes
+        self.marvin_options = {'http': http, 'cache': self.blame_cache, 'partial_blame': partial_blame, 'store': store,
+            'reuse_parents': reuse_parents, 'blame_factory': blame_factory,
+            'parse_pool': parse_pool, 'stats': stats, 'weights': weights, 'skip_tokens': skip_tokens}
+        if workers != None:
+            self.marvin_options['workers'] = workers
+
+    def recommend(self, project_link, pr_n=None, patch=None):
+        ownership = self.ownership_indexes.index(project_link) if self.ownership_indexes != None else None
+        marvin = Marvin(project_link, pr_n, ownership=ownership, **self.marvin_options)
+        if patch != None:
+            marvin.raw_diff = patch.splitlines(True)
+        else:
+            marvin.raw_diff = self.diff_cache.get(project_link, pr_n)
+            if marvin.raw_diff == None:
+                marvin.load_diff_from_project()
+                self.diff_cache.put(project_link, pr_n, marvin.raw_diff)
+
+        marvin.parse_and_blame()
+        marvin.load_additional_lines()
+        marvin.save_analysis()
+        return marvin.reviewers()
+
+    def status(self):
+        status = {
+            'blame_cache': {'entries': len(self.blame_cache), 'hits': self.blame_cache.hits, 'misses': self.blame_cache.misses},
+            'diff_cache': {'entries': len(self.diff_cache), 'hits': self.diff_cache.hits, 'misses': self.diff_cache.misses},
+            'http': self.http.summary(),
+        }
+        if self.stats != None:
+            status['stats'] = self.stats.to_dict()
+        return status
+
+    def owners(self, project_link, directory=''):
+        if self.ownership_indexes == None:
+            raise BadRequest('No ownership index kept')
+        return self.ownership_indexes.index(project_link).owners(directory,
+            self.marvin_options['weights'] or DEFAULT_WEIGHTS)
+
+class ReviewerHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == '/owners':
+            query = parse_qs(url.query)
+            if not 'project_link' in query:
+                self.send_json(400, {'error': 'project_link missing in query string'})
+                return
+            try:
+                owners = self.server.owners(query['project_link'][0], query.get('directory', [''])[0])
+            except BadRequest as error:
+                self.send_json(400, {'error': str(error)})
+                return
+            except Exception as error:
+                log.exception("Querying owners failed")
+                self.send_json(500, {'error': str(error)})
+                return
+            self.send_json(200, {'owners': list(owners.items())})
+            return
+        if url.path != '/status':
+            self.send_json(404, {'error': 'Not found'})
+            return
+        self.send_json(200, self.server.status())
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path != '/reviewers':
+            self.send_json(404, {'error': 'Not found'})
+            return
+
+        try:
+            request = self.read_request(url)
+            reviewers = self.server.recommend(**request)
+        except BadRequest as error:
+            self.send_json(400, {'error': str(error)})
+            return
+        except (requests.RequestException, GitError) as error:
+            log.error("Blaming failed: {}".format(error))
+            self.send_json(502, {'error': str(error)})
+            return
+        except Exception as error:
+            log.exception("Recommending reviewers failed")
+            self.send_json(500, {'error': str(error)})
+            return
+
+        self.send_json(200, {'reviewers': reviewers})
+
+    def read_request(self, url):
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            raise BadRequest('Invalid Content-Length')
+        try:
+            body = self.rfile.read(length).decode('utf-8')
+        except UnicodeDecodeError as error:
+            raise BadRequest('Body is not UTF-8: {}'.format(error))
+        if self.headers.get_content_type() == 'text/plain':
+            project_link = parse_qs(url.query).get('project_link', [None])[0]
+            if project_link == None:
+                raise BadRequest('project_link missing in query string')
+            return {'project_link': project_link, 'patch': body}
+
+        try:
+            request = json.loads(body)
+        except ValueError as error:
+            raise BadRequest('Invalid JSON: {}'.format(error))
+        if not isinstance(request, dict) or not 'project_link' in request:
+            raise BadRequest('project_link missing')
+        if not isinstance(request['project_link'], str):
+            raise BadRequest('project_link must be a string')
+        if ('pr_n' in request) == ('patch' in request):
+            raise BadRequest('Either pr_n or patch is required')
+        if 'pr_n' in request and (not isinstance(request['pr_n'], int) or isinstance(request['pr_n'], bool)):
+            raise BadRequest('pr_n must be a number')
+        if 'patch' in request and not isinstance(request['patch'], str):
+            raise BadRequest('patch must be a string')
+        return dict((k, request[k]) for k in ['project_link', 'pr_n', 'patch'] if k in request)
+
+    def send_json(self, status, value):
+        body = json.dumps(value).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.info(format % args)
+
+def main():
+    parser = argparse.ArgumentParser(description='Serves reviewer recommendations over HTTP')
+    parser.add_argument('--host', type=str, default=DEFAULT_HOST, help='the address to listen on')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='the port to listen on')
+    parser.add_argument('--memory-entries', type=int, default=DEFAULT_MAX_ENTRIES, help='the number of blame pages and diffs kept in memory')
+    parser.add_argument('--diff-ttl', type=float, default=DEFAULT_DIFF_TTL, help='seconds a downloaded PR diff is reused')
+    add_common_arguments(parser)
+
+    args = parser.parse_args()
+    cache, http, store = setup_from_arguments(args, pool_size=args.jobs)
+    server = ReviewerServer((args.host, args.port), http, cache=cache, workers=args.jobs,
+        partial_blame=args.partial_blame, max_entries=args.memory_entries, diff_ttl=args.diff_ttl, store=store,
+        reuse_parents=not args.no_parent_reuse, blame_factory=blame_factory_from_arguments(args),
+        parse_pool=parse_pool_from_arguments(args), stats=stats_from_arguments(args),
+        weights=weights_from_arguments(args), ownership_indexes=ownership_from_arguments(args),
+        skip_tokens=skip_tokens_from_arguments(args))
+    log.warning("Listening on http://{}:{}".format(*server.server_address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    logging.basicConfig(stream=sys.stderr, format='%(name)s %(levelname)s %(message)s')
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+import sys
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+module = sys.modules['__main__'].__file__
+log = logging.getLogger(module)
+
+class Stats:
+    """Wall and CPU time per stage and counters of one or more runs.
+
+    Stages and counters may be recorded from any thread. The CPU time of a
+    stage is the one of the thread running it, so the CPU time of stages run
+    in worker threads adds up, while a stage waiting for workers uses none.
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Stage name -> [calls, wall time, CPU time]
+        self.stages = OrderedDict()
+        self.counters = OrderedDict()
+
+    def stage(self, name):
+        """Context manager timing a stage, the times of repeated stages add up"""
+        return Stage(self, name)
+
+    def add_time(self, name, wall, cpu):
+        with self._lock:
+            stage = self.stages.setdefault(name, [0, 0.0, 0.0])
+            stage[0] += 1
+            stage[1] += wall
+            stage[2] += cpu
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def counted(self, name, iterable, measure=None):
+        """Yield from iterable, counting its items, or the sum of measure(item), once it is exhausted"""
+        n = 0
+        try:
+            for item in iterable:
+                n += 1 if measure == None else measure(item)
+                yield item
+        finally:
+            self.count(name, n)
+
+    def to_dict(self):
+        with self._lock:
+            return OrderedDict([
+                ('stages', OrderedDict((name, OrderedDict([('calls', calls), ('wall', wall), ('cpu', cpu)]))
+                    for name, (calls, wall, cpu) in self.stages.items())),
+                ('counters', OrderedDict(self.counters)),
+            ])
+
+    def emit(self, output):
+        """Write the stats as one line of JSON"""
+        output.write(json.dumps(self.to_dict()) + '\n')
+        output.flush()
+
+class Stage:
+    __slots__ = ('stats', 'name', 'wall', 'cpu')
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stats.add_time(self.name, time.perf_counter() - self.wall, time.thread_time() - self.cpu)
+        return False
+
+class NullStats:
+    """Stats recording nothing, used when instrumentation is disabled"""
+
+    enabled = False
+
+    def stage(self, name):
+        return NULL_STAGE
+
+    def count(self, name, n=1):
+        pass
+
+    def counted(self, name, iterable, measure=None):
+        return iterable
+
+    def to_dict(self):
+        return OrderedDict()
+
+class NullStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_STAGE = NullStage()
+NULL_STATS = NullStats()
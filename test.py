@@ -14,12 +14,71 @@
 # assertIsInstance(a, b) 		isinstance(a, b)
 # assertNotIsInstance(a, b) 	not isinstance(a, b)
 
-import unittest, json, codecs, os, logging
-import parse, blame, marvin
-from models import LineChange
+import unittest, json, codecs, os, io, logging, threading, tempfile, shutil, subprocess, functools, contextlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ProcessPoolExecutor
+import requests
+import parse, blame, git_blame, marvin, cache, http_client, server, stats, generate, scoring, ownership, bench
+from models import LineChange, LineBlame, ChangeSet, ChangeIndex, RowIndex, BlameRanges, epoch
 
 TEST_DATA_DIR_NAME = 'test_data'
 
+# Blame pages of marvin_sample.patch, as served by GitHub
+SAMPLE_BLAME_PAGES = {
+  '/blame/3ac0f11ac948108eb4cb11c4f40b113f67479dd9/app/controllers/application_controller.rb':
+    'test_app_controllers_application_controller_20180215.html',
+  '/blame/6b426063f37aa28e14afe8979384e12c7018d819/config/initializers/devise.rb':
+    'test_config_initializers_devise_add_20180215.html',
+  '/blame/06ec0f98b2d98b8a7284fcee8f3232f558a55048~1/config/initializers/devise.rb':
+    'test_config_initializers_devise_deleted_20180215.html',
+  '/pull/1.patch': 'marvin_sample.patch',
+}
+
+# 06ec0f9 is the first commit touching devise.rb after 6b42606, so the page
+# of its parent is the one of 6b42606 and is not fetched
+PLANNED_BLAME_PAGES = [path for path in SAMPLE_BLAME_PAGES if path.startswith('/blame/') and not '~1' in path]
+
+class FixtureServer:
+  """Local stand-in for GitHub, serving files from the test data directory"""
+
+  def __init__(self, pages=SAMPLE_BLAME_PAGES, failures=None):
+    test_data_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), TEST_DATA_DIR_NAME)
+    self.requests = []
+    # Number of 503 responses sent for a path before it is served
+    self.failures = dict(failures or {})
+    fixture_server = self
+
+    class Handler(BaseHTTPRequestHandler):
+      def do_GET(self):
+        fixture_server.requests.append(self.path)
+        if fixture_server.failures.get(self.path, 0) > 0:
+          fixture_server.failures[self.path] -= 1
+          self.send_error(503)
+          return
+        if not self.path in pages:
+          self.send_error(404)
+          return
+        with open(os.path.join(test_data_dir, pages[self.path]), 'rb') as f:
+          body = f.read()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+      def log_message(self, *args):
+        pass
+
+    self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    self.link = 'http://127.0.0.1:{}'.format(self.httpd.server_address[1])
+
+  def __enter__(self):
+    threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+    return self
+
+  def __exit__(self, *args):
+    self.httpd.shutdown()
+    self.httpd.server_close()
+
 class MarvinTest(unittest.TestCase):
   def __init__(self, *args, **kwargs):
     super(MarvinTest, self).__init__(*args, **kwargs)
@@ -46,6 +105,96 @@ class TestLineChangeEquality(unittest.TestCase):
   def test_custom_ne(self):
     self.assertNotEqual(LineChange(), LineChange(line_number='1'))
 
+  def test_hash(self):
+    changes = {LineChange(1, LineChange.ChangeType.added, 'Gemfile', 'abc'),
+      LineChange(1, LineChange.ChangeType.added, 'Gemfile', 'abc'),
+      LineChange(2, LineChange.ChangeType.added, 'Gemfile', 'abc')}
+    self.assertEqual(len(changes), 2)
+
+  def test_slots(self):
+    self.assertFalse(hasattr(LineChange(), '__dict__'))
+
+class TestLineBlame(unittest.TestCase):
+  def setUp(self):
+    self.blame = LineBlame('abc', 'url/abc', 'avatar', 'message', 'chrisma', '2018-02-15T10:00:00Z')
+
+  def test_value_type(self):
+    same = LineBlame(*list(self.blame))
+    self.assertEqual(same, self.blame)
+    self.assertEqual(hash(same), hash(self.blame))
+    self.assertEqual(self.blame.user_name, 'chrisma')
+    self.assertFalse(hasattr(self.blame, '__dict__'))
+
+  def test_shared_author_entry(self):
+    change_set = ChangeSet()
+    for line in range(3):
+      row = change_set.append(line, LineChange.ChangeType.added, 'Gemfile', 'abc')
+      change_set.set_author(row, LineBlame(*list(self.blame)))
+    self.assertEqual(len(change_set.authors), 1)
+
+  def test_timestamp(self):
+    self.assertEqual(epoch('2018-02-15T10:00:00Z'), 1518688800)
+    self.assertEqual(epoch('2018-02-15T11:00:00+01:00'), 1518688800)
+    self.assertIsNone(epoch('yesterday'))
+    # Fields stored before the timestamp existed
+    self.assertEqual(LineBlame.from_fields(list(self.blame)).timestamp, 1518688800)
+    self.assertEqual(LineBlame.from_fields(list(self.blame._replace(timestamp=1))).timestamp, 1)
+
+class TestChangeSet(unittest.TestCase):
+  def setUp(self):
+    self.change_set = ChangeSet()
+    self.index = ChangeIndex(self.change_set)
+    self.index[3] = LineChange(3, LineChange.ChangeType.added, 'Gemfile', 'abc')
+    self.index[4] = LineChange(4, LineChange.ChangeType.added, 'Gemfile', 'abc')
+
+  def test_view(self):
+    self.assertEqual(self.index[3], LineChange(3, LineChange.ChangeType.added, 'Gemfile', 'abc'))
+    self.assertIsInstance(self.index[3], LineChange)
+    # Only the change set and row are kept per view, not the slots of LineChange
+    self.assertEqual([slot for klass in type(self.index[3]).__mro__ for slot in getattr(klass, '__slots__', ())],
+      ['change_set', 'row'])
+    self.assertEqual(list(self.index), [3, 4])
+
+  def test_interned(self):
+    self.assertEqual(self.change_set.files, ['Gemfile'])
+    self.assertEqual(list(self.change_set.file_ids), [0, 0])
+    self.assertEqual(self.change_set.commits, ['abc'])
+
+  def test_author_through_view(self):
+    self.index[3].author = 'blame'
+    self.assertEqual(self.index[3].author, 'blame')
+    self.assertIsNone(self.index[4].author)
+    self.assertEqual(list(self.change_set.author_ids), [0, -1])
+
+  def test_superseded_rows(self):
+    self.index[3] = LineChange(3, LineChange.ChangeType.modified, 'Gemfile', 'def')
+    del self.index[4]
+    self.assertEqual(len(self.index), 1)
+    self.assertEqual(len(self.change_set), 1)
+    self.assertEqual(list(self.change_set), [LineChange(3, LineChange.ChangeType.modified, 'Gemfile', 'def')])
+
+  def test_compact(self):
+    self.index[3] = LineChange(3, LineChange.ChangeType.modified, 'Gemfile', 'def')
+    self.index.update_rows({1: self.change_set.append(1, LineChange.ChangeType.added, 'Gemfile', 'abc')})
+    self.change_set.compact([self.index])
+    self.assertEqual(list(self.index.rows.items()), [(1, 2), (3, 1), (4, 0)])
+    self.assertEqual(self.index[3], LineChange(3, LineChange.ChangeType.modified, 'Gemfile', 'def'))
+
+  def test_row_index(self):
+    rows = RowIndex({5: 0, 2: 1})
+    rows[9] = 2
+    rows[3] = 3
+    rows[5] = 4
+    self.assertEqual(list(rows.items()), [(2, 1), (3, 3), (5, 4), (9, 2)])
+    self.assertEqual(list(rows.values()), [1, 3, 4, 2])
+    del rows[3]
+    self.assertEqual(rows, {2: 1, 5: 4, 9: 2})
+    self.assertNotIn(3, rows)
+    self.assertIsNone(rows.get(4))
+    self.assertEqual(rows.pop(9), 2)
+    with self.assertRaises(KeyError):
+      rows[9]
+
 class TestLineChangeRenameFile(MarvinTest):
   def setUp(self):
     self.parser = self.setup_parser('rename.diff')
@@ -55,6 +204,14 @@ class TestLineChangeRenameFile(MarvinTest):
     for line, added in self.parser.changes['sample.diff'][0].items():
       self.assertTrue(line in self.parser.changes['sample.patch'][1])
 
+  def test_commit_of_second_file(self):
+    # Both files are changed in the same commit
+    for file in ['sample.diff', 'sample.patch']:
+      for change in self.parser.changes[file][0].values():
+        self.assertEqual(change.commit_sha, '7b0321c5770f68d6bab4c10a2b5b0447cc71bb9c')
+      for change in self.parser.changes[file][1].values():
+        self.assertEqual(change.commit_sha, '7b0321c5770f68d6bab4c10a2b5b0447cc71bb9c~1')
+
 class TestReturnType(MarvinTest):
   def setUp(self):
     self.file_changes = self.setup_parser('modify.diff').parse()
@@ -249,6 +406,40 @@ class TestDiffMultipleFiles(MarvinTest):
     for e in expected:
       self.assertIn(e, single_file_changes)
 
+class TestDiffStreaming(MarvinTest):
+  def test_iterator_same_as_list(self):
+    with open(self.full_test_path('marvin_sample.patch')) as f:
+      lines = f.readlines()
+    expected = parse.DiffParser(diff_content=lines).parse()
+    self.assertEqual(parse.DiffParser(diff_content=iter(lines)).parse(), expected)
+    self.assertEqual(self.setup_parser('marvin_sample.patch').parse(), expected)
+
+  def test_file_sections(self):
+    parser = self.setup_parser('marvin_sample.patch')
+    sections = [(file, len(changes)) for file, changes in parser.iter_file_changes()]
+    self.assertEqual(sections, [('config/initializers/devise.rb', 27),
+      ('app/controllers/application_controller.rb', 7), ('config/initializers/devise.rb', 1)])
+    self.assertEqual(len(parser.changes), 2)
+
+  def test_sections_yielded_lazily(self):
+    consumed = []
+    def lines():
+      with open(self.full_test_path('marvin_sample.patch')) as f:
+        for line in f:
+          consumed.append(line)
+          yield line
+
+    parser = parse.DiffParser(diff_content=lines())
+    file, changes = next(parser.iter_file_changes())
+    self.assertEqual(file, 'config/initializers/devise.rb')
+    self.assertLess(len(consumed), 105)
+
+  def test_without_storing(self):
+    parser = self.setup_parser('marvin_sample.patch')
+    changes = [c for file, section in parser.iter_file_changes(store=False) for c in section]
+    self.assertEqual(len(changes), 35)
+    self.assertEqual(parser.changes, {})
+
 class TestMarvinMultipleCommitsForSameFile(MarvinTest):
   def setUp(self):
     self.parser = self.setup_parser('marvin_sample.patch')
@@ -353,6 +544,871 @@ class TestMarvinSetup(MarvinTest):
 
     self.assertEqual(self.marvin.reviewers().pop()[0], 'chrisma')
 
+class TestMarvinChangedIndex(MarvinTest):
+  def setUp(self):
+    self.marvin = self.setup_marvin('test', 1, 'marvin_sample.patch')
+    self.marvin.parse_diff()
+
+  def test_changed_lines(self):
+    changed, ordered = self.marvin.changed_index[('app/controllers/application_controller.rb', '3ac0f11ac948108eb4cb11c4f40b113f67479dd9')]
+    self.assertEqual(ordered, list(range(10, 17)))
+    self.assertEqual(changed, set(ordered))
+
+  def test_has_been_changed(self):
+    file = 'config/initializers/devise.rb'
+    self.assertTrue(self.marvin.has_been_changed(271, file, '06ec0f98b2d98b8a7284fcee8f3232f558a55048~1'))
+    self.assertTrue(self.marvin.has_been_changed(271, file, '6b426063f37aa28e14afe8979384e12c7018d819'))
+    self.assertFalse(self.marvin.has_been_changed(270, file, '06ec0f98b2d98b8a7284fcee8f3232f558a55048~1'))
+    self.assertFalse(self.marvin.has_been_changed(271, file, 'unknown'))
+
+  def test_neighbours_stop_at_changed_lines(self):
+    file, sha = 'config/initializers/devise.rb', '6b426063f37aa28e14afe8979384e12c7018d819'
+    self.marvin.load_blame_from_html(file, sha, self.full_test_path('test_config_initializers_devise_add_20180215.html'))
+
+    self.assertEqual(self.marvin._find_next_intersing_line(file, 10, sha), None)
+    self.assertEqual(self.marvin._find_previous_intersing_line(file, 3, sha).line_number, 2)
+    self.assertEqual(self.marvin._find_next_intersing_line(file, 22, sha).line_number, 23)
+
+class TestMarvinConcurrentBlame(MarvinTest):
+  def blame(self, workers, reuse_parents=True):
+    with FixtureServer() as server:
+      marvin_obj = marvin.Marvin(server.link, 1, workers=workers, reuse_parents=reuse_parents)
+      marvin_obj.load_diff_from_filename(filename=self.full_test_path('marvin_sample.patch'))
+      marvin_obj.parse_diff()
+      marvin_obj.blame_lines()
+      marvin_obj.load_additional_lines()
+    return marvin_obj, server.requests
+
+  def test_unique_pairs(self):
+    marvin_obj = self.setup_marvin('test', 1, 'marvin_sample.patch')
+    marvin_obj.parse_diff()
+    self.assertEqual(marvin_obj.blame_pairs(), [
+      ('config/initializers/devise.rb', '6b426063f37aa28e14afe8979384e12c7018d819'),
+      ('config/initializers/devise.rb', '06ec0f98b2d98b8a7284fcee8f3232f558a55048~1'),
+      ('app/controllers/application_controller.rb', '3ac0f11ac948108eb4cb11c4f40b113f67479dd9')])
+
+  def test_each_page_fetched_once(self):
+    marvin_obj, requests = self.blame(workers=4)
+    self.assertCountEqual(requests, PLANNED_BLAME_PAGES)
+
+  def test_without_parent_reuse(self):
+    marvin_obj, requests = self.blame(workers=4, reuse_parents=False)
+    self.assertCountEqual(requests, [p for p in SAMPLE_BLAME_PAGES if p.startswith('/blame/')])
+    self.assertEqual(marvin_obj.saved_fetches, 0)
+
+  def test_stream_from_project(self):
+    with FixtureServer() as server:
+      marvin_obj = marvin.Marvin(server.link, 1, workers=4)
+      marvin_obj.load_diff_from_project(stream=True)
+      marvin_obj.parse_and_blame()
+      marvin_obj.load_additional_lines()
+    self.assertEqual(len(server.requests), 1 + len(PLANNED_BLAME_PAGES))
+    self.assertEqual(marvin_obj.reviewers(), self.blame(workers=1)[0].reviewers())
+
+  def test_stream_line_endings(self):
+    patch = ['diff --git a/Gemfile b/Gemfile', 'index 647ad8d..d486669 100644', '--- a/Gemfile', '+++ b/Gemfile',
+      '@@ -1,4 +1,4 @@', ' source', ' \x0c', ' gem \'rails\'', '-# Datetime validations', '+# Datetime validation',
+      'diff --git a/README b/README', 'index 647ad8d..d486669 100644', '--- a/README', '+++ b/README',
+      '@@ -1,301 +1,301 @@'] + [' line {}'.format(n) for n in range(1, 301)] + ['-old', '+new']
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      filename = os.path.join(tmp_dir, '1.patch')
+      with open(filename, 'wb') as f:
+        f.write(''.join(line + '\r\n' for line in patch).encode('utf-8'))
+      chunk_size = marvin.DIFF_CHUNK_SIZE
+      try:
+        with FixtureServer({'/pull/1.patch': filename}) as server:
+          # Odd chunk sizes, so some end between \r and \n
+          for marvin.DIFF_CHUNK_SIZE in [7, 64, chunk_size]:
+            for stream in [True, False]:
+              marvin_obj = marvin.Marvin(server.link, 1)
+              marvin_obj.load_diff_from_project(stream=stream)
+              changes = parse.DiffParser(diff_content=marvin_obj.raw_diff).parse()
+              self.assertEqual(sorted((change.file_path, change.line_number) for change in changes
+                if change.change_type == LineChange.ChangeType.modified), [('Gemfile', 4), ('README', 301)])
+      finally:
+        marvin.DIFF_CHUNK_SIZE = chunk_size
+
+  def test_deterministic(self):
+    sequential, _ = self.blame(workers=1)
+    concurrent, _ = self.blame(workers=4)
+    for file in sequential.blame_data:
+      self.assertEqual(list(sequential.blame_data[file]), list(concurrent.blame_data[file]))
+    self.assertEqual(sequential.reviewers(), concurrent.reviewers())
+    self.assertEqual(concurrent.reviewers().pop()[0], 'chrisma')
+
+class TestBlamePlanner(MarvinTest):
+  def setUp(self):
+    self.marvin = self.setup_marvin('test', 1, 'marvin_sample.patch')
+    self.marvin.parse_diff()
+
+  def test_latest_earlier_commit(self):
+    self.assertEqual(self.marvin.blame_revision('config/initializers/devise.rb', '06ec0f98b2d98b8a7284fcee8f3232f558a55048~1'),
+      '6b426063f37aa28e14afe8979384e12c7018d819')
+
+  def test_base_of_series(self):
+    self.assertEqual(self.marvin.blame_revision('app/controllers/application_controller.rb', '3ac0f11ac948108eb4cb11c4f40b113f67479dd9~1'),
+      '6b426063f37aa28e14afe8979384e12c7018d819~1')
+    self.assertEqual(self.marvin.blame_revision('config/initializers/devise.rb', '6b426063f37aa28e14afe8979384e12c7018d819~1'),
+      '6b426063f37aa28e14afe8979384e12c7018d819~1')
+
+  def test_commits_unchanged(self):
+    self.assertEqual(self.marvin.blame_revision('config/initializers/devise.rb', '06ec0f98b2d98b8a7284fcee8f3232f558a55048'),
+      '06ec0f98b2d98b8a7284fcee8f3232f558a55048')
+    self.marvin.reuse_parents = False
+    self.assertEqual(self.marvin.blame_revision('config/initializers/devise.rb', '06ec0f98b2d98b8a7284fcee8f3232f558a55048~1'),
+      '06ec0f98b2d98b8a7284fcee8f3232f558a55048~1')
+
+  def test_same_result(self):
+    with FixtureServer() as server:
+      results = []
+      for reuse_parents in [True, False]:
+        marvin_obj = marvin.Marvin(server.link, 1, reuse_parents=reuse_parents)
+        marvin_obj.load_diff_from_filename(filename=self.full_test_path('marvin_sample.patch'))
+        marvin_obj.parse_and_blame()
+        marvin_obj.load_additional_lines()
+        results.append(marvin_obj)
+
+    planned, unplanned = results
+    self.assertEqual(planned.saved_fetches, 1)
+    self.assertEqual(planned.reviewers(), unplanned.reviewers())
+    self.assertEqual(list(planned.diff_parser.change_set), list(unplanned.diff_parser.change_set))
+    devise = planned.blame_data['config/initializers/devise.rb']
+    self.assertIs(devise['06ec0f98b2d98b8a7284fcee8f3232f558a55048~1'], devise['6b426063f37aa28e14afe8979384e12c7018d819'])
+
+@unittest.skipIf(shutil.which('git') == None, "git not installed")
+class TestGitBlame(MarvinTest):
+  def setUp(self):
+    self.tmp_dir = tempfile.TemporaryDirectory()
+    self.repo = self.tmp_dir.name
+    self.git('init', '-q')
+    self.commit('alice', ['class App', '  def run', '    start', '  end', 'end'])
+    self.base = self.git('rev-parse', 'HEAD').strip()
+    self.commit('bob', ['class App', '  def run', '    prepare', '    start', '  end', 'end'])
+
+  def tearDown(self):
+    self.tmp_dir.cleanup()
+
+  def git(self, *args, author='alice'):
+    env = dict(os.environ, GIT_AUTHOR_NAME=author, GIT_AUTHOR_EMAIL=author + '@example.com',
+      GIT_COMMITTER_NAME=author, GIT_COMMITTER_EMAIL=author + '@example.com',
+      GIT_AUTHOR_DATE='2018-02-15T10:00:00Z', GIT_COMMITTER_DATE='2018-02-15T10:00:00Z')
+    return subprocess.run(['git', '-C', self.repo] + list(args), env=env, check=True,
+      stdout=subprocess.PIPE).stdout.decode('utf-8')
+
+  def commit(self, author, lines):
+    with open(os.path.join(self.repo, 'app.rb'), 'w') as f:
+      f.write('\n'.join(lines) + '\n')
+    self.git('add', 'app.rb', author=author)
+    self.git('commit', '-q', '-m', 'Change by ' + author, author=author)
+
+  def test_blame(self):
+    blamer = git_blame.GitBlameParser('https://github.com/a/b', repository=self.repo)
+    blamer.get_blame_page('HEAD', 'app.rb')
+    self.assertEqual(blamer.line_count, 6)
+    self.assertEqual(blamer.file_data[3], '    prepare')
+    self.assertEqual([blamer.blame_line(n).user_name for n in range(1, 7)], ['alice', 'alice', 'bob', 'alice', 'alice', 'alice'])
+    self.assertIs(blamer.blame_line(1), blamer.blame_line(2))
+    self.assertEqual(blamer.blame_line(3).commit_message, 'Change by bob')
+    self.assertEqual(blamer.blame_line(3).time, '2018-02-15T10:00:00Z')
+    self.assertEqual(blamer.blame_line(3).timestamp, 1518688800)
+    self.assertTrue(blamer.blame_line(1).commit_url.startswith('https://github.com/a/b/commit/' + self.base[:7]))
+
+  def test_restricted(self):
+    blamer = git_blame.GitBlameParser('', repository=self.repo)
+    blamer.restrict([1], context=0)
+    blamer.get_blame_page('HEAD~1', 'app.rb')
+    self.assertEqual(list(blamer.file_data), [1])
+    self.assertEqual(blamer.line_text(4), '  end')
+
+  def test_unknown_revision(self):
+    blamer = git_blame.GitBlameParser('', repository=self.repo)
+    self.assertRaises(git_blame.GitError, blamer.get_blame_page, 'HEAD', 'missing.rb')
+
+  def test_malformed_output(self):
+    output = self.git('blame', '--porcelain', 'HEAD', '--', 'app.rb')
+    # Missing the first header, lines without a header of their own
+    for content in [output[output.index('\n') + 1:], '\tclass App\n',
+        output[:output.index('\tclass App')] + '\tclass App\n\t  def run\n']:
+      blamer = git_blame.GitBlameParser('', repository=self.repo)
+      self.assertRaises(git_blame.GitError, blamer.parse_html, content.encode('utf-8'))
+
+    # Output cut off after a line is the blame up to that line
+    blamer = git_blame.GitBlameParser('', repository=self.repo)
+    blamer.parse_html(output[:output.index('\n', output.index('prepare')) + 1].encode('utf-8'))
+    self.assertEqual(blamer.line_count, 3)
+
+  def test_marvin(self):
+    marvin_obj = marvin.Marvin('https://github.com/a/b', 1, workers=2,
+      blame_factory=functools.partial(git_blame.GitBlameParser, repository=self.repo))
+    marvin_obj.raw_diff = self.git('format-patch', '--stdout', '--no-signature', self.base + '..HEAD').splitlines(True)
+    marvin_obj.parse_and_blame()
+    marvin_obj.load_additional_lines()
+    self.assertEqual(marvin_obj.diff_parser.get_all_changes()[0].author.user_name, 'bob')
+    self.assertEqual(sorted(marvin_obj.additional_lines['app.rb']), [2, 4])
+    # bob added one line, alice wrote the two interesting lines around it
+    self.assertEqual(marvin_obj.reviewers(), [('bob', 1), ('alice', 2)])
+
+class TestBlameCache(MarvinTest):
+  def setUp(self):
+    self.tmp_dir = tempfile.TemporaryDirectory()
+    self.cache = cache.BlameCache(self.tmp_dir.name)
+
+  def tearDown(self):
+    self.cache.close()
+    self.tmp_dir.cleanup()
+
+  def test_compact_round_trip(self):
+    blamer = blame.BlameParser(project_link='')
+    blamer.load_html_file(self.full_test_path('test_blame_20180215.html'))
+    self.cache.put('test', 'sha', 'Gemfile', blamer.to_compact())
+
+    restored = blame.BlameParser(project_link='')
+    restored.load_compact(self.cache.get('test', 'sha', 'Gemfile'))
+    self.assertEqual(restored.file_data, blamer.file_data)
+    self.assertEqual(list(restored.blame_data.items()), list(blamer.blame_data.items()))
+    # Lines of the same hunk still share their blame
+    self.assertIs(restored.blame_line(1), restored.blame_line(2))
+
+  def test_miss(self):
+    self.cache.put('test', 'sha', 'Gemfile', {})
+    self.assertIsNone(self.cache.get('test', 'sha', 'README.md'))
+    self.assertIsNone(self.cache.get('other', 'sha', 'Gemfile'))
+
+  def test_lru_eviction(self):
+    value = {'lines': [os.urandom(512).hex()]}
+    self.cache.put('test', 'a', 'file', value)
+    self.cache.max_size = self.cache.size() * 2
+    self.cache.put('test', 'b', 'file', value)
+    self.cache.get('test', 'a', 'file')
+    self.cache.put('test', 'c', 'file', value)
+
+    self.assertEqual(len(self.cache), 2)
+    self.assertIsNotNone(self.cache.get('test', 'a', 'file'))
+    self.assertIsNone(self.cache.get('test', 'b', 'file'))
+    self.assertIsNotNone(self.cache.get('test', 'c', 'file'))
+
+  def test_rerun_without_network(self):
+    with FixtureServer() as server:
+      for run in range(2):
+        marvin_obj = marvin.Marvin(server.link, 1, cache=self.cache)
+        marvin_obj.load_diff_from_filename(filename=self.full_test_path('marvin_sample.patch'))
+        marvin_obj.parse_diff()
+        marvin_obj.blame_lines()
+        marvin_obj.load_additional_lines()
+        self.assertEqual(marvin_obj.reviewers().pop()[0], 'chrisma')
+    self.assertEqual(len(server.requests), len(PLANNED_BLAME_PAGES))
+
+class TestIncremental(MarvinTest):
+  def setUp(self):
+    self.tmp_dir = tempfile.TemporaryDirectory()
+    self.store = cache.BlameCache(self.tmp_dir.name, name='analysis')
+    with open(self.full_test_path('marvin_sample.patch')) as f:
+      self.patch = f.readlines()
+
+  def tearDown(self):
+    self.store.close()
+    self.tmp_dir.cleanup()
+
+  def analyse(self, server, patch, store):
+    marvin_obj = marvin.Marvin(server.link, 1, store=store)
+    marvin_obj.raw_diff = patch
+    marvin_obj.parse_and_blame()
+    marvin_obj.load_additional_lines()
+    marvin_obj.save_analysis()
+    return marvin_obj
+
+  def test_new_commits_only(self):
+    with FixtureServer() as server:
+      full = self.analyse(server, self.patch, None)
+      del server.requests[:]
+
+      # The PR had only its first commit before
+      self.analyse(server, self.patch[:54], self.store)
+      first_run = list(server.requests)
+      del server.requests[:]
+      second = self.analyse(server, self.patch, self.store)
+      second_run = list(server.requests)
+      del server.requests[:]
+      third = self.analyse(server, self.patch, self.store)
+
+    self.assertEqual(second.diff_parser.replayed, set(['6b426063f37aa28e14afe8979384e12c7018d819']))
+    self.assertEqual(set(commit for commit, file, sections in second.diff_parser.sections),
+      set(['3ac0f11ac948108eb4cb11c4f40b113f67479dd9', '06ec0f98b2d98b8a7284fcee8f3232f558a55048']))
+    self.assertEqual(first_run, ['/blame/6b426063f37aa28e14afe8979384e12c7018d819/config/initializers/devise.rb'])
+    # The replayed commit still provides the page of the parent of the last one
+    self.assertCountEqual(second_run, PLANNED_BLAME_PAGES)
+    self.assertEqual(third.diff_parser.sections, [])
+    self.assertEqual(server.requests, [])
+
+    for result in [second, third]:
+      self.assertEqual(result.reviewers(), full.reviewers())
+      for file in full.additional_lines:
+        self.assertEqual(dict(result.additional_lines[file]), dict(full.additional_lines[file]))
+      self.assertEqual(list(result.diff_parser.change_set), list(full.diff_parser.change_set))
+
+class TestHttpClient(MarvinTest):
+  def setUp(self):
+    self.http = http_client.HttpClient(pool_size=2, retries=2, backoff_factor=0)
+
+  def tearDown(self):
+    self.http.close()
+
+  def test_retry_on_server_error(self):
+    with FixtureServer(failures={'/pull/1.patch': 2}) as server:
+      response = self.http.get(server.link + '/pull/1.patch')
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(server.requests, ['/pull/1.patch'] * 3)
+
+  def test_retries_exhausted(self):
+    with FixtureServer(failures={'/pull/1.patch': 3}) as server:
+      self.assertRaises(requests.HTTPError, self.http.get, server.link + '/pull/1.patch')
+
+  def test_not_found(self):
+    with FixtureServer() as server:
+      self.assertRaises(requests.HTTPError, self.http.get, server.link + '/pull/2.patch')
+    self.assertEqual(len(server.requests), 1)
+
+  def test_shared_between_diff_and_blame(self):
+    with FixtureServer() as server:
+      marvin_obj = marvin.Marvin(server.link, 1, http=self.http)
+      marvin_obj.load_diff_from_project()
+      marvin_obj.parse_diff()
+      marvin_obj.blame_lines()
+
+    summary = self.http.summary()
+    self.assertEqual(summary['requests'], 1 + len(PLANNED_BLAME_PAGES))
+    self.assertGreater(summary['bytes'], 0)
+    self.assertGreaterEqual(summary['max_time'], summary['mean_time'])
+    self.assertGreaterEqual(summary['max_time'], summary['recent_p95_time'])
+
+  def test_recent_latencies(self):
+    http = http_client.HttpClient(retries=0, recent=2)
+    with FixtureServer() as server:
+      for i in range(3):
+        http.get(server.link + '/pull/1.patch')
+    http.close()
+    # Only the latest requests are kept, the counters cover all of them
+    self.assertEqual(len(http.latencies), 2)
+    summary = http.summary()
+    self.assertEqual(summary['requests'], 3)
+    self.assertGreaterEqual(summary['total_time'], sum(elapsed for url, status, elapsed in http.latencies))
+    self.assertLessEqual(summary['recent_median_time'], summary['max_time'])
+
+class TestBatch(MarvinTest):
+  def setUp(self):
+    self.tmp_dir = tempfile.TemporaryDirectory()
+    self.cache = cache.BlameCache(self.tmp_dir.name)
+    self.http = http_client.HttpClient(retries=0)
+
+  def tearDown(self):
+    self.cache.close()
+    self.http.close()
+    self.tmp_dir.cleanup()
+
+  def test_read_batch(self):
+    lines = ['# open PRs\n', 'https://github.com/a/b 1\n', '\n', 'https://github.com/a/c  23 # draft\n']
+    self.assertEqual(marvin.read_batch(lines), [('https://github.com/a/b', 1), ('https://github.com/a/c', 23)])
+
+  def test_read_batch_malformed(self):
+    lines = ['https://github.com/a/b 1\n', 'https://github.com/a/c\n', 'https://github.com/a/d x\n',
+      'https://github.com/a/e 5\n']
+    invalid = []
+    with self.assertLogs(marvin.log, logging.ERROR):
+      prs = marvin.read_batch(lines, invalid)
+    self.assertEqual(prs, [('https://github.com/a/b', 1), ('https://github.com/a/e', 5)])
+    self.assertEqual(invalid, [2, 3])
+
+  def test_run_batch(self):
+    pages = dict(SAMPLE_BLAME_PAGES)
+    pages['/pull/2.patch'] = 'marvin_sample.patch'
+    output = io.StringIO()
+    with FixtureServer(pages) as server:
+      prs = [(server.link, 1), (server.link, 3), (server.link, 2)]
+      failed = marvin.run_batch(prs, output, workers=2, cache=self.cache, http=self.http)
+
+    results = dict((result['pr_n'], result) for result in map(json.loads, output.getvalue().splitlines()))
+    self.assertEqual(failed, 1)
+    self.assertEqual(sorted(results), [1, 2, 3])
+    self.assertEqual(results[1]['reviewers'][-1][0], 'chrisma')
+    self.assertEqual(results[1]['reviewers'], results[2]['reviewers'])
+    self.assertIn('error', results[3])
+    # The blame pages of the second PR come from the shared cache
+    self.assertEqual(len([path for path in server.requests if '/blame/' in path]), len(PLANNED_BLAME_PAGES))
+
+class TestMemoryCache(unittest.TestCase):
+  def test_lru(self):
+    memory = cache.MemoryCache(max_entries=2)
+    memory.put('test', 'a', 'file', 1)
+    memory.put('test', 'b', 'file', 2)
+    memory.get('test', 'a', 'file')
+    memory.put('test', 'c', 'file', 3)
+    self.assertEqual(len(memory), 2)
+    self.assertEqual(memory.get('test', 'a', 'file'), 1)
+    self.assertIsNone(memory.get('test', 'b', 'file'))
+
+  def test_ttl(self):
+    memory = cache.MemoryCache(ttl=-1)
+    memory.put('test', 1, ['diff'])
+    self.assertIsNone(memory.get('test', 1))
+
+  def test_backing(self):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      disk = cache.BlameCache(tmp_dir)
+      disk.put('test', 'a', 'file', {'lines': []})
+      memory = cache.MemoryCache(backing=disk)
+      self.assertEqual(memory.get('test', 'a', 'file'), {'lines': []})
+      memory.get('test', 'a', 'file')
+      self.assertEqual((disk.hits, memory.hits), (1, 1))
+      memory.close()
+
+class TestServer(MarvinTest):
+  def setUp(self):
+    self.http = http_client.HttpClient(retries=0)
+    self.server = server.ReviewerServer(('127.0.0.1', 0), self.http, workers=2)
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+    self.link = 'http://127.0.0.1:{}/reviewers'.format(self.server.server_address[1])
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    self.http.close()
+
+  def test_pull_request(self):
+    with FixtureServer() as github:
+      first = requests.post(self.link, json={'project_link': github.link, 'pr_n': 1})
+      second = requests.post(self.link, json={'project_link': github.link, 'pr_n': 1})
+    self.assertEqual(first.status_code, 200)
+    self.assertEqual(first.json()['reviewers'][-1][0], 'chrisma')
+    self.assertEqual(first.json(), second.json())
+    # The second request is answered from memory
+    self.assertEqual(len(github.requests), 1 + len(PLANNED_BLAME_PAGES))
+
+  def test_patch(self):
+    with open(self.full_test_path('marvin_sample.patch')) as f:
+      patch = f.read()
+    with FixtureServer() as github:
+      by_pr = requests.post(self.link, json={'project_link': github.link, 'pr_n': 1})
+      by_json = requests.post(self.link, json={'project_link': github.link, 'patch': patch})
+      by_text = requests.post(self.link, params={'project_link': github.link}, data=patch.encode('utf-8'),
+        headers={'Content-Type': 'text/plain'})
+    self.assertEqual(by_pr.json(), by_json.json())
+    self.assertEqual(by_pr.json(), by_text.json())
+    self.assertEqual(len(github.requests), 1 + len(PLANNED_BLAME_PAGES))
+
+  def test_concurrent(self):
+    with FixtureServer() as github:
+      responses = [None] * 4
+      def post(i):
+        responses[i] = requests.post(self.link, json={'project_link': github.link, 'pr_n': 1})
+      threads = [threading.Thread(target=post, args=(i,)) for i in range(len(responses))]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+    self.assertEqual(len(set(json.dumps(response.json()) for response in responses)), 1)
+
+  def test_errors(self):
+    with FixtureServer() as github:
+      self.assertEqual(requests.post(self.link, data='{').status_code, 400)
+      self.assertEqual(requests.post(self.link, json={'project_link': github.link}).status_code, 400)
+      self.assertEqual(requests.post(self.link, json={'project_link': github.link, 'pr_n': 2}).status_code, 502)
+    status = requests.get(self.link.replace('/reviewers', '/status')).json()
+    self.assertEqual(status['http']['requests'], 1)
+
+  def test_invalid_requests(self):
+    self.assertEqual(requests.post(self.link, json={'project_link': 'x', 'patch': 5}).status_code, 400)
+    self.assertEqual(requests.post(self.link, json={'project_link': 5, 'pr_n': 1}).status_code, 400)
+    self.assertEqual(requests.post(self.link, json={'project_link': 'x', 'pr_n': True}).status_code, 400)
+    self.assertEqual(requests.post(self.link, data='{}', headers={'Content-Length': 'many'}).status_code, 400)
+
+  def test_internal_error(self):
+    def fail(**request):
+      raise RuntimeError('broken')
+    self.server.recommend = fail
+    with self.assertLogs(server.log, logging.ERROR):
+      response = requests.post(self.link, json={'project_link': 'x', 'pr_n': 1})
+    self.assertEqual(response.status_code, 500)
+    self.assertEqual(response.json(), {'error': 'broken'})
+
+class TestStats(MarvinTest):
+  def test_stage_and_counters(self):
+    recorded = stats.Stats()
+    with recorded.stage('work'):
+      sum(range(1000))
+    with recorded.stage('work'):
+      pass
+    recorded.count('pages')
+    recorded.count('bytes', 10)
+    self.assertEqual(list(recorded.counted('lines', ['a', 'b', 'c'])), ['a', 'b', 'c'])
+
+    result = json.loads(json.dumps(recorded.to_dict()))
+    self.assertEqual(result['stages']['work']['calls'], 2)
+    self.assertGreaterEqual(result['stages']['work']['wall'], 0)
+    self.assertEqual(result['counters'], {'pages': 1, 'bytes': 10, 'lines': 3})
+
+  def test_disabled(self):
+    lines = ['a']
+    self.assertIs(stats.NULL_STATS.counted('lines', lines), lines)
+    with stats.NULL_STATS.stage('work'):
+      stats.NULL_STATS.count('pages')
+    self.assertEqual(stats.NULL_STATS.to_dict(), {})
+    self.assertIs(marvin.Marvin('', 1).stats, stats.NULL_STATS)
+
+  def test_marvin(self):
+    recorded = stats.Stats()
+    with FixtureServer() as server:
+      marvin_obj = marvin.Marvin(server.link, 1, stats=recorded)
+      marvin_obj.load_diff_from_project(stream=True)
+      marvin_obj.parse_and_blame()
+      marvin_obj.load_additional_lines()
+      reviewers = marvin_obj.reviewers()
+
+    self.assertEqual(reviewers[-1][0], 'chrisma')
+    result = recorded.to_dict()
+    for stage in ['diff_fetch', 'diff_parse', 'blame_fetch', 'blame_parse', 'blame_wait', 'blame_lines',
+        'additional_lines', 'reviewers']:
+      self.assertIn(stage, result['stages'])
+    self.assertEqual(result['stages']['blame_fetch']['calls'], len(PLANNED_BLAME_PAGES))
+    counters = result['counters']
+    self.assertEqual(counters['blame_pages_fetched'], len(PLANNED_BLAME_PAGES))
+    self.assertEqual(counters['blame_pages_reused'], marvin_obj.saved_fetches)
+    with open(self.full_test_path('marvin_sample.patch'), 'rb') as f:
+      patch = f.read()
+    self.assertEqual(counters['diff_bytes'], len(patch))
+    self.assertEqual(counters['diff_lines'], len(patch.splitlines()))
+    self.assertEqual(counters['neighbour_searches'], 2 * len(marvin_obj.diff_parser.change_set))
+    self.assertGreater(counters['blame_lines_parsed'], 0)
+    self.assertGreater(counters['blame_bytes'], 0)
+
+  def test_cli(self):
+    with tempfile.TemporaryDirectory() as tmp_dir, FixtureServer() as server:
+      stats_path = os.path.join(tmp_dir, 'stats.json')
+      with contextlib.redirect_stdout(io.StringIO()):
+        marvin.main([server.link, '1', '--no-cache', '--stats', stats_path])
+      with open(stats_path) as f:
+        result = json.load(f)
+    self.assertEqual(result['counters']['blame_pages_fetched'], len(PLANNED_BLAME_PAGES))
+
+class TestGenerate(MarvinTest):
+  def setUp(self):
+    self.pr = generate.SyntheticPR(files=6, commits=3, hunks=4, hunk_size=5, file_length=120, seed=1)
+
+  def test_patch_matches_blame(self):
+    changes = parse.DiffParser(diff_content=self.pr.patch()).parse()
+    self.assertEqual(len(set(change.commit_sha for change in changes if not change.commit_sha.endswith('~1'))), 3)
+    for change in changes:
+      text, blame = self.pr.blame(change.commit_sha, change.file_path)[change.line_number - 1]
+      if change.change_type != LineChange.ChangeType.deleted:
+        self.assertEqual(blame.user_name, generate.PR_AUTHOR)
+
+  def test_blame_page(self):
+    revision, file = list(self.pr.revisions)[-1]
+    for streaming in [True, False]:
+      blamer = blame.BlameParser('', streaming=streaming)
+      blamer.parse_html(self.pr.blame_page(revision, file))
+      self.assertEqual([(blamer.file_data[n], blamer.blame_data[n]) for n in blamer.blame_data],
+        self.pr.blame(revision, file))
+
+  def test_marvin(self):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      pages = self.pr.write(tmp_dir)
+      with FixtureServer(pages) as server:
+        reviewers = marvin.recommend(server.link, 1)
+    # Every page asked for has been generated
+    self.assertTrue(set(server.requests) <= set(pages))
+    self.assertIn(generate.PR_AUTHOR, dict(reviewers))
+    self.assertTrue(set(dict(reviewers)) - set([generate.PR_AUTHOR]))
+
+  def test_patch_downloaded(self):
+    prs = dict((seed, generate.SyntheticPR(files=12 + seed % 10, commits=1 + seed % 3, hunks=3, hunk_size=6,
+      file_length=120, authors=3 + seed % 4, seed=seed)) for seed in range(30, 40))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      pages = {}
+      for seed, pr in prs.items():
+        pages['/pull/{}.patch'.format(seed)] = os.path.join(tmp_dir, '{}.patch'.format(seed))
+        with open(pages['/pull/{}.patch'.format(seed)], 'w') as f:
+          f.writelines(pr.patch())
+      with FixtureServer(pages) as server:
+        for seed, pr in prs.items():
+          # The whole patch downloaded at once, then split into lines
+          marvin_obj = marvin.Marvin(server.link, seed)
+          marvin_obj.load_diff_from_project()
+          with self.assertLogs(parse.log, logging.DEBUG) as logs:
+            changes = parse.DiffParser(diff_content=marvin_obj.raw_diff).parse()
+          self.assertEqual([record.getMessage() for record in logs.records if record.levelno >= logging.WARNING], [])
+          self.assertEqual(len(changes), len(parse.DiffParser(diff_content=pr.patch()).parse()))
+
+  def test_changed_lines(self):
+    pr = generate.with_changed_lines(2000, hunks=5, hunk_size=4)
+    self.assertGreater(pr.changed_lines(), 1000)
+    self.assertLess(pr.changed_lines(), 4000)
+
+class TestBench(unittest.TestCase):
+  def setUp(self):
+    self.benchmarks = bench.BENCHMARKS.copy()
+    # bench.main sets the level of the shared logger
+    self.level = bench.log.level
+    bench.BENCHMARKS.clear()
+    bench.benchmark('test/steady')(lambda args: 1.0)
+    bench.benchmark('test/slower')(lambda args: 1.4)
+    bench.benchmark('test/pages', unit='pages')(lambda args: 3.0)
+    bench.benchmark('test/lines', per='lines')(lambda args: (0.5, 1000))
+    self.tmp_dir = tempfile.mkdtemp()
+    self.baseline = os.path.join(self.tmp_dir, 'baseline.json')
+    with open(self.baseline, 'w') as f:
+      json.dump({'benchmarks': {'test/steady': {'value': 1.0, 'unit': 's'}, 'test/slower': {'value': 1.0, 'unit': 's'},
+        'test/pages': {'value': 1.0, 'unit': 's'}}}, f)
+
+  def tearDown(self):
+    bench.BENCHMARKS.clear()
+    bench.BENCHMARKS.update(self.benchmarks)
+    bench.log.setLevel(self.level)
+    shutil.rmtree(self.tmp_dir)
+
+  def main(self, *argv):
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+      status = bench.main(list(argv))
+    return status, output.getvalue()
+
+  def test_regressions(self):
+    results = {'test/steady': (1.05, 's'), 'test/slower': (1.4, 's'), 'test/pages': (3.0, 'pages'), 'test/new': (9.0, 's')}
+    with open(self.baseline) as f:
+      baseline = json.load(f)
+    self.assertEqual(bench.regressions(results, baseline, 0.1), ['test/slower'])
+    self.assertEqual(bench.regressions(results, baseline, 0.5), [])
+    # Results in other units and without a baseline are not compared
+    self.assertEqual(bench.regressions(results, {}, 0.1), [])
+
+  def test_main_threshold(self):
+    with self.assertLogs(bench.log, logging.ERROR) as logs:
+      status, output = self.main('--baseline', self.baseline, '--threshold', '0.1')
+    self.assertEqual(status, 1)
+    self.assertEqual(len(logs.records), 1)
+    self.assertIn('test/slower', logs.records[0].getMessage())
+    self.assertIn('test/slower\t1.4 s\t+40.0%', output)
+    self.assertIn('test/steady\t1 s\t+0.0%', output)
+    self.assertIn('test/lines\t0.5 s\t2,000 lines/s\n', output)
+
+    status, output = self.main('--baseline', self.baseline, '--threshold', '0.5')
+    self.assertEqual(status, 0)
+
+  def test_main_saved_baseline(self):
+    saved = os.path.join(self.tmp_dir, 'saved.json')
+    self.assertEqual(self.main('--save', saved)[0], 0)
+    with open(saved) as f:
+      self.assertEqual(json.load(f)['benchmarks']['test/lines'],
+        {'value': 0.5, 'unit': 's', 'rate': {'value': 2000.0, 'unit': 'lines/s'}})
+    self.assertEqual(self.main('--baseline', saved, '--threshold', '0')[0], 0)
+    bench.benchmark('test/steady')(lambda args: 2.0)
+    self.assertEqual(self.main('--baseline', saved, '-k', 'pages')[0], 0)
+    with self.assertLogs(bench.log, logging.ERROR):
+      self.assertEqual(self.main('--baseline', saved, '-k', 'steady')[0], 1)
+
+class TestScoring(MarvinTest):
+  def setUp(self):
+    self.pr = generate.SyntheticPR(files=9, commits=2, hunks=3, hunk_size=4, file_length=80, seed=2)
+    self.marvin = marvin.Marvin('', 1)
+    self.marvin.raw_diff = self.pr.patch()
+    self.marvin.parse_diff()
+    change_set = self.marvin.diff_parser.change_set
+    for row in change_set.rows():
+      text, line_blame = self.pr.blame(change_set.commit_sha(row), change_set.file_path(row))[change_set.line_numbers[row] - 1]
+      change_set.set_author(row, line_blame)
+
+  def scores(self, weights=scoring.DEFAULT_WEIGHTS):
+    expected = {}
+    for change in self.marvin.diff_parser.change_set:
+      expected[change.author.user_name] = expected.get(change.author.user_name, 0) + weights.relevance(change)
+    return expected
+
+  def test_matches_per_line(self):
+    scores = scoring.score([self.marvin.diff_parser.change_set])
+    expected = self.scores()
+    self.assertEqual(sorted(scores), sorted(expected))
+    for name in expected:
+      self.assertAlmostEqual(scores[name], expected[name])
+    self.assertEqual(dict(self.marvin.reviewers()), scores)
+
+  def test_weight_table(self):
+    weights = scoring.WeightTable(change_weights={LineChange.ChangeType.deleted: 10},
+      extension_classes={'.py': 'text'}, class_weights={'text': 0})
+    self.assertEqual(weights.relevance(LineChange(1, LineChange.ChangeType.deleted, 'a.rb')), 10)
+    self.assertEqual(weights.relevance(LineChange(1, LineChange.ChangeType.deleted, 'a.py')), 0)
+    self.assertAlmostEqual(scoring.DEFAULT_WEIGHTS.relevance(LineChange(1, LineChange.ChangeType.modified, 'README.md')), 1)
+
+    self.assertEqual(scoring.WeightTable.from_dict({'changes': {'deleted': 10}, 'extensions': {'.py': 'text'},
+      'classes': {'text': 0}}).__dict__, weights.__dict__)
+
+    self.marvin.weights = weights
+    scores = dict(self.marvin.reviewers())
+    expected = self.scores(weights)
+    for name in expected:
+      self.assertAlmostEqual(scores[name], expected[name])
+
+  def test_timestamps_parsed(self):
+    for streaming in [True, False]:
+      blamer = blame.BlameParser('', streaming=streaming)
+      blamer.load_html_file(self.full_test_path('test_blame_20180215.html'))
+      for line_blame in set(blamer.blame_data.values()):
+        self.assertEqual(line_blame.timestamp, epoch(line_blame.time))
+        self.assertIsInstance(line_blame.timestamp, int)
+
+  def test_recency(self):
+    now = 1518688800
+    old = LineBlame('a', '', None, '', 'alice', '', now - 2 * 365 * scoring.DAY)
+    new = LineBlame('b', '', None, '', 'bob', '', now)
+    unknown = LineBlame('c', '', None, '', 'carol', 'unknown')
+    change_set = ChangeSet()
+    for line_blame in [old, old, new, unknown]:
+      change_set.append(1, LineChange.ChangeType.added, 'a.rb', 'sha', line_blame)
+
+    self.assertEqual(scoring.score([change_set]), {'alice': 2, 'bob': 1, 'carol': 1})
+    weights = scoring.WeightTable(half_life=365, now=now)
+    self.assertEqual(scoring.score([change_set], weights), {'alice': 0.5, 'bob': 1, 'carol': 1})
+    self.assertEqual(weights.relevance(change_set.view(0)), 0.25)
+
+    # Recent changes of the synthetic PR outweigh older lines
+    self.marvin.weights = scoring.WeightTable(half_life=30, now=generate.BASE_TIME.timestamp())
+    self.assertEqual(self.marvin.reviewers()[-1][0], generate.PR_AUTHOR)
+
+  def test_dead_and_unblamed(self):
+    change_set = ChangeSet()
+    author = LineBlame('a', '', None, '', 'alice', '')
+    change_set.append(1, LineChange.ChangeType.added, 'a.rb', 'sha', author)
+    change_set.append(2, LineChange.ChangeType.modified, 'a.rb', 'sha', author)
+    change_set.discard(1)
+    self.assertEqual(scoring.score([change_set]), {'alice': 1})
+    change_set.append(3, LineChange.ChangeType.added, 'a.rb', 'sha')
+    self.assertIsNone(scoring.score([change_set]))
+    self.assertEqual(scoring.score([ChangeSet()]), {})
+
+class TestTopK(MarvinTest):
+  def setUp(self):
+    self.pr = generate.SyntheticPR(files=24, commits=2, hunks=4, hunk_size=6, file_length=150, seed=0)
+
+  def test_top_k(self):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      with FixtureServer(self.pr.write(tmp_dir)) as server:
+        reviewers = marvin.recommend(server.link, 1)
+        top = marvin.recommend(server.link, 1, top_k=2)
+    self.assertEqual(top, list(reversed(reviewers))[:2])
+    self.assertEqual(scoring.highest_scores({'a': 1, 'b': 3, 'c': 2}, 2), [('b', 3), ('c', 2)])
+
+  def test_early_exit(self):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      with FixtureServer(self.pr.write(tmp_dir)) as server:
+        full = marvin.recommend(server.link, 1, top_k=1, workers=2)
+        full_requests = len(server.requests)
+        del server.requests[:]
+
+        m = marvin.Marvin(server.link, 1, workers=2)
+        m.load_diff_from_project()
+        m.parse_diff()
+        bound = m.blame_top_k(1)
+        m.load_additional_lines()
+        early = m.top_k(1)
+    self.assertLess(len(server.requests), full_requests)
+    self.assertTrue(m.skipped_pairs)
+    self.assertGreater(bound, 0)
+    self.assertIsNone(m.reviewers())
+    self.assertEqual(early[0][0], full[0][0])
+    # The skipped lines could not have closed the gap
+    self.assertLessEqual(full[0][1] - early[0][1], bound)
+
+  def test_bound(self):
+    running = scoring.RunningScores()
+    author = lambda name: LineBlame(name, '', None, '', name, '')
+    change = LineChange(1, LineChange.ChangeType.modified, 'a.rb', 'sha')
+    change.author = author('alice')
+    running.add_change(change)
+    self.assertTrue(running.settled(1))
+    self.assertEqual(running.upper_bound(change), 5)
+
+    running.expect('a.rb', 2)
+    interesting = LineChange(5, LineChange.ChangeType.interesting, 'a.rb', 'sha')
+    interesting.author = author('bob')
+    running.add_interesting(0, interesting)
+    # alice leads by 2, but bob may still get 2 more
+    self.assertFalse(running.settled(1))
+    running.finish('a.rb', 2)
+    self.assertTrue(running.settled(2))
+    self.assertEqual(running.bound(), 0)
+    self.assertEqual(running.scores, {'alice': 3, 'bob': 1})
+
+class TestOwnership(MarvinTest):
+  def setUp(self):
+    self.alice = LineBlame('a', '', None, '', 'alice', '', 100)
+    self.bob = LineBlame('b', '', None, '', 'bob', '', 200)
+    self.index = ownership.OwnershipIndex('project')
+    self.index.update('lib/a.rb', 'r1', dict((n, self.alice) for n in range(1, 11)))
+    self.index.update('lib/b.md', 'r1', {1: self.bob, 2: self.bob, 3: self.bob})
+    self.index.update('lib0.rb', 'r1', {1: self.bob})
+
+  def test_ranges(self):
+    self.assertEqual(ownership.blame_ranges({1: self.alice, 2: self.alice, 4: self.alice, 5: self.bob}),
+      [(1, 2, self.alice), (4, 4, self.alice), (5, 5, self.bob)])
+    self.assertEqual(self.index.blame_line('lib/a.rb', 4), self.alice)
+    self.assertIsNone(self.index.blame_line('lib/a.rb', 11))
+    # The same revision is not indexed again, an older one is ignored, a newer one replaces
+    self.assertFalse(self.index.update('lib/a.rb', 'r1', {1: self.bob}))
+    self.assertFalse(self.index.update('lib/a.rb', 'r0', {1: LineBlame('c', '', None, '', 'carol', '', 50)}))
+    self.assertEqual(self.index.files['lib/a.rb'].ranges(), [(1, 10, self.alice)])
+    self.assertTrue(self.index.update('lib/a.rb', 'r2', {1: self.bob, 2: self.alice}))
+    self.assertEqual(self.index.files['lib/a.rb'].ranges(), [(1, 1, self.bob), (2, 2, self.alice)])
+
+  def test_owners(self):
+    self.assertEqual(self.index.files_in('lib'), ['lib/a.rb', 'lib/b.md'])
+    self.assertEqual(self.index.files_in('lib0.rb'), ['lib0.rb'])
+    self.assertEqual(self.index.owners('lib/'), {'alice': 10, 'bob': 1})
+    self.assertEqual(list(self.index.owners()), ['alice', 'bob'])
+    # A day old lines of alice count half
+    aged = self.index.owners('lib', scoring.WeightTable(half_life=1, now=100 + scoring.DAY))
+    self.assertEqual(aged['alice'], 5)
+    self.assertAlmostEqual(aged['bob'], 0.5, places=2)
+
+  def test_store(self):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      store = cache.BlameCache(tmp_dir, name='ownership')
+      self.index.store = store
+      self.index.save()
+      loaded = ownership.OwnershipIndexes(store).index('project')
+      self.assertEqual(loaded.paths, self.index.paths)
+      self.assertEqual(loaded.owners(), self.index.owners())
+      self.assertEqual(loaded.blame_line('lib/b.md', 2), self.bob)
+      store.close()
+
+  def test_base_revision_only(self):
+    pr = generate.SyntheticPR(files=6, commits=3, hunks=3, hunk_size=4, file_length=80, seed=3)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      pages = pr.write(tmp_dir)
+      with FixtureServer(pages) as github:
+        restricted = ownership.OwnershipIndex(github.link)
+        marvin.recommend(github.link, 1, ownership=restricted, partial_blame=True)
+        index = ownership.OwnershipIndex(github.link)
+        marvin.recommend(github.link, 1, ownership=index)
+
+      # Restricted pages and pages of the commits of the PR are not indexed
+      self.assertEqual(restricted.files, {})
+      self.assertEqual(sorted(index.files), sorted(pr.files))
+      for file in pr.files:
+        self.assertEqual(index.files[file].revision, pr.commits[0] + '~1')
+      self.assertNotIn(generate.PR_AUTHOR, index.owners())
+
+      http = http_client.HttpClient(retries=0)
+      with FixtureServer({'/pull/1.patch': pages['/pull/1.patch']}) as github:
+        index.project_link = github.link
+        fallback = marvin.Marvin(github.link, 1, ownership=index, http=http, stats=stats.Stats())
+        fallback.load_diff_from_project()
+        with self.assertLogs(marvin.log, logging.WARNING):
+          fallback.parse_and_blame()
+        with self.assertRaises(requests.RequestException):
+          marvin.recommend(github.link, 1, http=http)
+      http.close()
+    self.assertGreater(fallback.stats.counters['ownership_fallbacks'], 0)
+    for change in fallback.diff_parser.change_set:
+      self.assertEqual(change.author, index.blame_line(change.file_path, change.line_number))
+
 @unittest.skip("Not refactored yet")
 class TestDiffLarge(MarvinTest):
   def setUp(self):
@@ -428,6 +1484,185 @@ class TestBlame(MarvinTest):
     self.assertIsNone(blame_info_after)
     logging.disable(logging.NOTSET)
 
+  def test_ranges(self):
+    ranges = self.blamer.blame_data.ranges()
+    self.assertLess(len(ranges), self.line_count)
+    self.assertEqual(sum(end - start + 1 for start, end, hunk in ranges), self.line_count)
+    self.assertEqual([line_blame.user_name for line_blame in self.blamer.authors(1, 1)], ['jaSunny'])
+    authors = self.blamer.authors(1, self.line_count)
+    self.assertEqual(len(authors), len(set(authors)))
+    self.assertEqual(set(authors), set(self.blamer.blame_data.values()))
+    self.assertIn('WGierke', [line_blame.user_name for line_blame in self.blamer.authors(40, 44)])
+
+class TestBlameRanges(MarvinTest):
+  def test_mapping(self):
+    ranges = BlameRanges({1: 'a', 2: 'a', 3: 'b', 5: 'b'})
+    self.assertEqual(ranges.ranges(), [(1, 2, 'a'), (3, 3, 'b'), (5, 5, 'b')])
+    ranges[4] = 'b'
+    self.assertEqual(ranges.ranges(), [(1, 2, 'a'), (3, 5, 'b')])
+    ranges[4] = 'c'
+    self.assertEqual(ranges.ranges(), [(1, 2, 'a'), (3, 3, 'b'), (4, 4, 'c'), (5, 5, 'b')])
+    del ranges[1]
+    self.assertEqual(len(ranges), 4)
+    self.assertEqual(list(ranges.items()), [(2, 'a'), (3, 'b'), (4, 'c'), (5, 'b')])
+    self.assertEqual(ranges, {2: 'a', 3: 'b', 4: 'c', 5: 'b'})
+    self.assertNotIn(1, ranges)
+    self.assertIsNone(ranges.get(6))
+    with self.assertRaises(KeyError):
+      ranges[0]
+
+  def test_span(self):
+    ranges = BlameRanges(dict((n, 'a' if n < 10 else 'b') for n in range(1, 20)))
+    self.assertEqual(ranges.span(5, 12), [(5, 9, 'a'), (10, 12, 'b')])
+    self.assertEqual(ranges.span(20, 30), [])
+
+class TestBlameStreaming(MarvinTest):
+  def test_same_as_tree_parser(self):
+    for file in sorted(os.listdir(self.test_data_dir)):
+      if not file.endswith('_20180215.html'):
+        continue
+      tree_blamer = blame.BlameParser(project_link='', streaming=False)
+      tree_blamer.load_html_file(self.full_test_path(file))
+      stream_blamer = blame.BlameParser(project_link='', streaming=True)
+      stream_blamer.load_html_file(self.full_test_path(file))
+
+      self.assertEqual(stream_blamer.file_data, tree_blamer.file_data)
+      self.assertEqual(list(stream_blamer.blame_data.items()), list(tree_blamer.blame_data.items()))
+
+  def test_hunk_shared(self):
+    blamer = blame.BlameParser(project_link='', streaming=True)
+    blamer.load_html_file(self.full_test_path('test_blame_20180215.html'))
+    self.assertIs(blamer.blame_line(1), blamer.blame_line(2))
+
+class TestBlameRestricted(MarvinTest):
+  def setUp(self):
+    self.full = blame.BlameParser(project_link='')
+    self.full.load_html_file(self.full_test_path('test_blame_20180215.html'))
+    self.blamer = blame.BlameParser(project_link='')
+    self.blamer.restrict([10, 50], context=2)
+    self.blamer.load_html_file(self.full_test_path('test_blame_20180215.html'))
+
+  def test_only_wanted_lines(self):
+    self.assertEqual(sorted(self.blamer.file_data), [8, 9, 10, 11, 12, 48, 49, 50, 51, 52])
+    self.assertEqual(sorted(self.blamer.blame_data), sorted(self.blamer.file_data))
+    self.assertEqual(self.blamer.line_count, 116)
+
+  def test_same_as_full(self):
+    for line in [8, 10, 52]:
+      self.assertEqual(self.blamer.line_text(line), self.full.file_data[line])
+      self.assertEqual(self.blamer.blame_line(line), self.full.blame_line(line))
+
+  def test_widen(self):
+    self.assertEqual(self.blamer.line_text(100), self.full.file_data[100])
+    self.assertEqual(self.blamer.blame_line(101), self.full.blame_line(101))
+    self.assertIn(98, self.blamer.file_data)
+    self.assertNotIn(80, self.blamer.file_data)
+    self.assertIsNone(self.blamer.line_text(self.blamer.line_count + 1))
+
+  def test_marvin_partial_blame(self):
+    results = []
+    for partial_blame in [False, True]:
+      with FixtureServer() as server:
+        marvin_obj = marvin.Marvin(server.link, 1, partial_blame=partial_blame)
+        marvin_obj.load_diff_from_filename(filename=self.full_test_path('marvin_sample.patch'))
+        marvin_obj.parse_diff()
+        marvin_obj.blame_lines()
+        marvin_obj.load_additional_lines()
+      results.append(marvin_obj)
+
+    full, partial = results
+    for file in full.additional_lines:
+      self.assertEqual(sorted(full.additional_lines[file]), sorted(partial.additional_lines[file]))
+    self.assertEqual(full.reviewers(), partial.reviewers())
+    blamer = partial.blame_data['config/initializers/devise.rb']['06ec0f98b2d98b8a7284fcee8f3232f558a55048~1']
+    self.assertLess(len(blamer.file_data), blamer.line_count)
+
+class TestBlameProcesses(MarvinTest):
+  @classmethod
+  def setUpClass(cls):
+    cls.pool = ProcessPoolExecutor(2)
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.pool.shutdown()
+
+  def setUp(self):
+    self.full = blame.BlameParser(project_link='')
+    self.full.load_html_file(self.full_test_path('test_blame_20180215.html'))
+    with open(self.full_test_path('test_blame_20180215.html'), 'rb') as f:
+      self.content = f.read()
+
+  def test_columns_round_trip(self):
+    restored = blame.BlameParser(project_link='')
+    restored.load_columns(self.full.to_columns())
+    self.assertEqual(restored.file_data, self.full.file_data)
+    self.assertEqual(list(restored.blame_data.items()), list(self.full.blame_data.items()))
+    self.assertIs(restored.blame_line(1), restored.blame_line(2))
+    self.assertEqual(restored.line_count, self.full.line_count)
+
+  def test_same_as_in_process(self):
+    blamer = blame.BlameParser(project_link='')
+    blamer.parse_html(self.content, self.pool)
+    self.assertEqual(blamer.file_data, self.full.file_data)
+    self.assertEqual(list(blamer.blame_data.items()), list(self.full.blame_data.items()))
+
+  def test_restricted(self):
+    blamer = blame.BlameParser(project_link='')
+    blamer.restrict([10], context=2)
+    blamer.parse_html(self.content, self.pool)
+    self.assertEqual(sorted(blamer.file_data), [8, 9, 10, 11, 12])
+    self.assertEqual(blamer.line_text(100), self.full.file_data[100])
+
+  def test_marvin(self):
+    results = []
+    with FixtureServer() as server:
+      for parse_pool in [None, self.pool]:
+        marvin_obj = marvin.Marvin(server.link, 1, parse_pool=parse_pool)
+        marvin_obj.load_diff_from_filename(filename=self.full_test_path('marvin_sample.patch'))
+        marvin_obj.parse_and_blame()
+        marvin_obj.load_additional_lines()
+        results.append(marvin_obj.reviewers())
+    self.assertEqual(results[0], results[1])
+
+class TestBlameInteresting(MarvinTest):
+  def setUp(self):
+    self.full = blame.BlameParser(project_link='')
+    self.full.load_html_file(self.full_test_path('test_blame_20180215.html'))
+
+  def test_index(self):
+    expected = [n for n, text in self.full.file_data.items() if not text.strip() in blame.DEFAULT_SKIP_TOKENS]
+    self.assertEqual(self.full.interesting_lines(), expected)
+    self.assertLess(len(expected), self.full.line_count)
+
+  def test_find(self):
+    interesting = self.full.interesting_lines()
+    self.assertEqual(self.full.find_interesting(1, self.full.line_count + 1, 1), interesting[0])
+    self.assertEqual(self.full.find_interesting(self.full.line_count, 0, -1), interesting[-1])
+    self.assertEqual(self.full.find_interesting(interesting[0], interesting[0], 1), None)
+
+  def test_restricted_same_as_full(self):
+    for start in range(1, self.full.line_count + 1):
+      blamer = blame.BlameParser(project_link='')
+      blamer.restrict([start], context=1)
+      blamer.load_html_file(self.full_test_path('test_blame_20180215.html'))
+      self.assertEqual(blamer.find_interesting(start, self.full.line_count + 1, 1),
+        self.full.find_interesting(start, self.full.line_count + 1, 1))
+      self.assertEqual(blamer.find_interesting(start, 0, -1), self.full.find_interesting(start, 0, -1))
+
+  def test_skip_tokens_by_extension(self):
+    self.assertEqual(blame.skip_tokens_for('app/models/user.rb'), blame.DEFAULT_SKIP_TOKENS)
+    # The tokens per language are opt-in
+    self.assertEqual(blame.skip_tokens_for('setup.py'), blame.DEFAULT_SKIP_TOKENS)
+    self.assertIn('pass', blame.skip_tokens_for('setup.py', blame.SKIP_TOKENS))
+    self.assertEqual(blame.skip_tokens_for('app/models/user.rb', blame.SKIP_TOKENS), blame.DEFAULT_SKIP_TOKENS)
+    self.assertEqual(blame.skip_tokens_for('user.rb', {'.rb': ['end']}), frozenset(['end']))
+
+  def test_custom_skip_tokens(self):
+    blamer = blame.BlameParser(project_link='', skip_tokens=frozenset(self.full.file_data[n].strip() for n in [1, 2]))
+    blamer.load_html_file(self.full_test_path('test_blame_20180215.html'))
+    self.assertNotIn(1, blamer.interesting_lines())
+    self.assertNotIn(2, blamer.interesting_lines())
+
 @unittest.skip("Not refactored yet")
 class TestBlameInsert(MarvinTest):
   def setUp(self):